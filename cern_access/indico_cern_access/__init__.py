@@ -21,3 +21,20 @@ def scheduled_sanitization():
     sanitize_personal_data()
     cleanup_archived_requests()
     db.session.commit()
+
+
+@celery.task
+def update_adams_requests(event):
+    """Send the current event data of all active access requests to ADaMS."""
+    from indico_cern_access.models.access_requests import CERNAccessRequestState
+    from indico_cern_access.plugin import CERNAccessPlugin
+    from indico_cern_access.util import get_requested_registrations, iter_adams_post_requests, update_access_requests
+    registrations = get_requested_registrations(event=event, only_active=True)
+    total = len(registrations)
+    done = 0
+    for chunk_registrations, __, __ in iter_adams_post_requests(event, registrations, update=True):
+        # commit each chunk so the requests already sent are not lost if a later one fails
+        update_access_requests(chunk_registrations, CERNAccessRequestState.active)
+        db.session.commit()
+        done += len(chunk_registrations)
+        CERNAccessPlugin.logger.info('Updated ADaMS access requests of %r: %d/%d', event, done, total)
@@ -13,8 +13,8 @@ from flask import g, request, session
 from flask_pluginengine import render_plugin_template
 from marshmallow import ValidationError
 from werkzeug.exceptions import Forbidden
-from wtforms.fields import StringField, URLField
-from wtforms.validators import DataRequired, Optional
+from wtforms.fields import IntegerField, StringField, URLField
+from wtforms.validators import DataRequired, NumberRange, Optional
 from wtforms_sqlalchemy.fields import QuerySelectField
 
 from indico.core import signals
@@ -43,7 +43,7 @@ from indico.web.forms.base import IndicoForm
 from indico.web.forms.fields import (IndicoDateTimeField, IndicoPasswordField, MultipleItemsField, PrincipalListField,
                                      TimeDeltaField)
 
-from indico_cern_access import _
+from indico_cern_access import _, update_adams_requests
 from indico_cern_access.blueprint import blueprint
 from indico_cern_access.definition import CERNAccessRequestDefinition, CERNTicketCode
 from indico_cern_access.models.access_requests import CERNAccessRequest, CERNAccessRequestState
@@ -52,8 +52,8 @@ from indico_cern_access.placeholders import (AccessCodePlaceholder, AccessPeriod
 from indico_cern_access.schemas import RequestAccessSchema
 from indico_cern_access.util import (build_access_request_data_from_reg, get_access_dates, get_last_request,
                                      get_requested_forms, get_requested_registrations, handle_event_time_update,
-                                     notify_access_withdrawn, sanitize_accompanying_persons, send_adams_delete_request,
-                                     send_adams_post_request, update_access_requests, withdraw_access_requests)
+                                     notify_access_withdrawn, sanitize_accompanying_persons, schedule_adams_update,
+                                     send_adams_delete_request, send_adams_post_request, withdraw_access_requests)
 from indico_cern_access.views import WPAccessRequestDetails
 
 
@@ -64,6 +64,12 @@ class PluginSettingsForm(IndicoForm):
                            description=_('The login used to authenticate with ADaMS service'))
     password = IndicoPasswordField(_('Password'), [DataRequired()],
                                    description=_('The password used to authenticate with ADaMS service'))
+    adams_chunk_size = IntegerField(_('ADaMS chunk size'), [DataRequired(), NumberRange(min=1)],
+                                    description=_('The maximum number of visitors sent to ADaMS in a single '
+                                                  'request'))
+    adams_max_parallel = IntegerField(_('ADaMS parallel requests'), [DataRequired(), NumberRange(min=1)],
+                                      description=_('The maximum number of requests sent to ADaMS at the same '
+                                                    'time when updating the visitors of large events'))
     authorized_users = PrincipalListField(_('Authorized users'), allow_groups=True,
                                           description=_('List of users/groups who can send requests'))
     excluded_categories = MultipleItemsField('Excluded categories', fields=[{'id': 'id', 'caption': 'Category ID'}])
@@ -103,6 +109,8 @@ class CERNAccessPlugin(IndicoPlugin):
         'adams_url': '',
         'username': '',
         'password': '',
+        'adams_chunk_size': 500,
+        'adams_max_parallel': 4,
         'excluded_categories': [],
         'access_ticket_template': None,
         'earliest_start_dt': None,
@@ -140,6 +148,7 @@ class CERNAccessPlugin(IndicoPlugin):
         self.connect(signals.event.is_ticket_blocked, self._is_ticket_blocked)
         self.connect(signals.event.is_field_data_locked, self._is_field_data_locked)
         self.connect(signals.core.form_validated, self._form_validated)
+        self.connect(signals.core.after_commit, self._after_commit)
         self.connect(signals.event.designer.print_badge_template, self._print_badge_template)
         self.connect(signals.event.registration.generate_accompanying_person_id, self._generate_accompanying_person_id)
         self.connect(signals.event.registration.generate_ticket_qr_code, self._generate_ticket_qr_code)
@@ -363,11 +372,11 @@ class CERNAccessPlugin(IndicoPlugin):
         if 'title' not in changes:
             return
 
-        requested_registrations = get_requested_registrations(event=event, only_active=True)
-        if requested_registrations:
-            state = send_adams_post_request(event, requested_registrations, update=True)[0]
-            if state == CERNAccessRequestState.active:
-                update_access_requests(requested_registrations, state)
+        schedule_adams_update(event)
+
+    def _after_commit(self, sender, **kwargs):
+        for event in g.pop('cern_access_adams_updates', ()):
+            update_adams_requests.delay(event)
 
     def _is_ticketing_handled(self, regform, **kwargs):
         """
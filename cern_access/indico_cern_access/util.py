@@ -7,11 +7,12 @@
 
 import random
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 
 import dateutil.parser
 import requests
-from flask import session
+from flask import current_app, g, session
 from jinja2.filters import do_truncate
 from pytz import timezone
 from werkzeug.exceptions import Forbidden
@@ -66,11 +67,17 @@ def get_requested_registrations(event, regform=None, only_active=False):
     return query.all()
 
 
-def _send_adams_http_request(method, data):
+def _get_adams_settings():
     from indico_cern_access.plugin import CERNAccessPlugin
-
     url = CERNAccessPlugin.settings.get('adams_url')
     credentials = (CERNAccessPlugin.settings.get('username'), CERNAccessPlugin.settings.get('password'))
+    return url, credentials
+
+
+def _send_adams_http_request(method, data, adams_settings=None):
+    from indico_cern_access.plugin import CERNAccessPlugin
+
+    url, credentials = adams_settings or _get_adams_settings()
 
     if method == 'DELETE':
         # deletion is weird. after a change on the ADaMS side, it no longer accepts DELETE with a payload.
@@ -94,25 +101,89 @@ def _send_adams_http_request(method, data):
     return r
 
 
+def _chunk_access_request_data(event, registrations, generate_code, chunk_size):
+    """Build the ADaMS data of registrations, split into chunks.
+
+    A registration and its accompanying persons are always sent in the
+    same chunk, so a chunk may exceed `chunk_size` if a registration has
+    many accompanying persons.
+    """
+    event_data = get_event_access_data(event)
+    chunk_registrations = []
+    chunk_data = {}
+    for reg in registrations:
+        reg_data = build_access_request_data_list_from_reg(reg, event, generate_code, event_data=event_data)
+        if chunk_data and len(chunk_data) + len(reg_data) > chunk_size:
+            yield chunk_registrations, chunk_data
+            chunk_registrations = []
+            chunk_data = {}
+        chunk_registrations.append(reg)
+        chunk_data.update(reg_data)
+    if chunk_registrations:
+        yield chunk_registrations, chunk_data
+
+
+def iter_adams_post_requests(event, registrations, update=False):
+    """Send POST requests to ADaMS API in chunks
+
+    The chunk size and the number of chunks sent at the same time are
+    configured in the plugin settings.  All data is built before sending
+    anything, so the database is not used while the requests are running.
+
+    :param update: if True, send request updating already stored data
+    :return: an iterator yielding ``(registrations, data, nonces_by_access_id)``
+             for each chunk as soon as it has been sent
+    """
+    from indico_cern_access.plugin import CERNAccessPlugin
+    chunk_size = CERNAccessPlugin.settings.get('adams_chunk_size')
+    max_parallel = CERNAccessPlugin.settings.get('adams_max_parallel')
+    chunks = list(_chunk_access_request_data(event, registrations, not update, chunk_size))
+    if not chunks:
+        return
+    adams_settings = _get_adams_settings()
+    if len(chunks) == 1 or max_parallel == 1:
+        for chunk_registrations, data in chunks:
+            r = _send_adams_http_request('POST', list(data.values()), adams_settings)
+            yield chunk_registrations, data, {x['ticketid']: x['nonce'] for x in r.json()['tickets']}
+        return
+
+    app = current_app._get_current_object()
+
+    def _send_chunk(data):
+        with app.app_context():
+            return _send_adams_http_request('POST', list(data.values()), adams_settings)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = {executor.submit(_send_chunk, data): (chunk_registrations, data)
+                   for chunk_registrations, data in chunks}
+        for future in as_completed(futures):
+            chunk_registrations, data = futures[future]
+            r = future.result()
+            yield chunk_registrations, data, {x['ticketid']: x['nonce'] for x in r.json()['tickets']}
+
+
 def send_adams_post_request(event, registrations, update=False):
     """Send POST request to ADaMS API
 
     :param update: if True, send request updating already stored data
     """
     data = {}
-    for reg in registrations:
-        data.update(build_access_request_data_list_from_reg(reg, event, not update))
-    r = _send_adams_http_request('POST', list(data.values()))
-    nonces_by_access_id = {x['ticketid']: x['nonce'] for x in r.json()['tickets']}
+    nonces_by_access_id = {}
+    for __, chunk_data, chunk_nonces in iter_adams_post_requests(event, registrations, update=update):
+        data.update(chunk_data)
+        nonces_by_access_id.update(chunk_nonces)
     return CERNAccessRequestState.active, data, nonces_by_access_id
 
 
 def send_adams_delete_request(registrations):
     """Send DELETE request to ADaMS API."""
     data = [generate_access_id(registration.id) for registration in registrations]
+    requests_by_event = {}
     for registration in registrations:
-        accompanying, accompanying_persons = get_accompanying_persons(registration,
-                                                                      get_last_request(registration.event))
+        event = registration.event
+        if event not in requests_by_event:
+            requests_by_event[event] = get_last_request(event)
+        accompanying, accompanying_persons = get_accompanying_persons(registration, requests_by_event[event])
         if not accompanying:
             break
         data += [generate_access_id(person['id']) for person in accompanying_persons]
@@ -137,23 +208,42 @@ def generate_access_id(person_id):
     return f'in{person_id}'
 
 
-def build_access_request_data(id, first_name, last_name, event, license_plate=None, reservation_code=None):
-    """Return a dictionary with data required by ADaMS API."""
-    start_dt, end_dt = get_access_dates(get_last_request(event))
+def get_event_access_data(event):
+    """Return the parts of the ADaMS data which are the same for everyone in an event.
+
+    When building the data of many people, this should be called once
+    and passed to the ``build_access_request_data*`` functions.
+    """
+    req = get_last_request(event)
+    start_dt, end_dt = get_access_dates(req)
     tz = timezone('Europe/Zurich')
+    return {'request': req,
+            'title': do_truncate(None, str_to_ascii(remove_accents(event.title)), 100, leeway=0),
+            'start_dt': start_dt.astimezone(tz).strftime('%Y-%m-%dT%H:%M'),
+            'end_dt': end_dt.astimezone(tz).strftime('%Y-%m-%dT%H:%M')}
+
+
+def build_access_request_data(id, first_name, last_name, event, license_plate=None, reservation_code=None, *,
+                              event_data=None):
+    """Return a dictionary with data required by ADaMS API.
+
+    :param event_data: the result of :func:`get_event_access_data`
+    """
+    if event_data is None:
+        event_data = get_event_access_data(event)
     data = {'$id': generate_access_id(id),
             '$rc': reservation_code or get_random_reservation_code(),
-            '$gn': do_truncate(None, str_to_ascii(remove_accents(event.title)), 100, leeway=0),
+            '$gn': event_data['title'],
             '$fn': str_to_ascii(remove_accents(first_name)),
             '$ln': str_to_ascii(remove_accents(last_name)),
-            '$sd': start_dt.astimezone(tz).strftime('%Y-%m-%dT%H:%M'),
-            '$ed': end_dt.astimezone(tz).strftime('%Y-%m-%dT%H:%M')}
+            '$sd': event_data['start_dt'],
+            '$ed': event_data['end_dt']}
     if license_plate:
         data['$lp'] = license_plate
     return data
 
 
-def build_access_request_data_from_reg(registration, event, generate_code, for_qr_code=False):
+def build_access_request_data_from_reg(registration, event, generate_code, for_qr_code=False, *, event_data=None):
     """Build the access request data dictionary from a registration."""
     if for_qr_code:
         return {'_adams_nonce': registration.cern_access_request.adams_nonce}
@@ -161,14 +251,18 @@ def build_access_request_data_from_reg(registration, event, generate_code, for_q
     reservation_code = None if generate_code else registration.cern_access_request.reservation_code
     license_plate = registration.cern_access_request.license_plate if registration.cern_access_request else None
     return build_access_request_data(registration.id, registration.first_name, registration.last_name, event,
-                                     license_plate=license_plate, reservation_code=reservation_code)
+                                     license_plate=license_plate, reservation_code=reservation_code,
+                                     event_data=event_data)
 
 
-def build_access_request_data_list_from_reg(registration, event, generate_code):
+def build_access_request_data_list_from_reg(registration, event, generate_code, *, event_data=None):
     """Build the access request data from a registration including accompanying persons."""
+    if event_data is None:
+        event_data = get_event_access_data(event)
     # since we don't support updates to accompanying persons, we always generate new codes
-    data = {registration.id: build_access_request_data_from_reg(registration, event, generate_code)}
-    accompanying_persons = get_accompanying_persons(registration, get_last_request(registration.event))[1]
+    data = {registration.id: build_access_request_data_from_reg(registration, event, generate_code,
+                                                                event_data=event_data)}
+    accompanying_persons = get_accompanying_persons(registration, event_data['request'])[1]
     for person in accompanying_persons:
         if generate_code:
             reservation_code = None
@@ -176,17 +270,27 @@ def build_access_request_data_list_from_reg(registration, event, generate_code):
             person_request = registration.cern_access_request.accompanying_persons.get(person['id'])
             reservation_code = person_request.get('reservation_code') if person_request else None
         data[person['id']] = build_access_request_data(person['id'], person['firstName'], person['lastName'], event,
-                                                       reservation_code=reservation_code)
+                                                       reservation_code=reservation_code, event_data=event_data)
     return data
 
 
+def schedule_adams_update(event):
+    """Send the event data of all active access requests to ADaMS.
+
+    The requests are sent by a Celery task once the current transaction
+    has been committed, since large events may have thousands of them.
+    """
+    has_active_requests = (Registration.query.with_parent(event)
+                           .join(CERNAccessRequest)
+                           .filter(CERNAccessRequest.is_active)
+                           .has_rows())
+    if has_active_requests:
+        g.setdefault('cern_access_adams_updates', set()).add(event)
+
+
 def handle_event_time_update(event):
     """Update access requests after an event time change"""
-    registrations = get_requested_registrations(event=event, only_active=True)
-    if registrations:
-        state = send_adams_post_request(event, registrations, update=True)[0]
-        if state == CERNAccessRequestState.active:
-            update_access_requests(registrations, state)
+    schedule_adams_update(event)
 
 
 def update_access_request(req):
@@ -228,11 +332,15 @@ def remove_access_template(regform):
 
 def add_access_requests(registrations, data, state, nonces):
     """Add CERN access requests for registrations."""
+    requests_by_event = {}
     for registration in registrations:
         create_access_request(registration, state, data[registration.id]['$rc'],
                               nonces[generate_access_id(registration.id)])
         # save the accompanying persons' reservation codes and nonces
-        accompanying_persons = get_accompanying_persons(registration, get_last_request(registration.event))[1]
+        event = registration.event
+        if event not in requests_by_event:
+            requests_by_event[event] = get_last_request(event)
+        accompanying_persons = get_accompanying_persons(registration, requests_by_event[event])[1]
         request_persons = deepcopy(registration.cern_access_request.accompanying_persons)
         for person in accompanying_persons:
             reservation_code = data[person['id']]['$rc']
@@ -164,3 +164,18 @@ def test_registration_modified_inactive(dummy_regform, api_delete, api_post):
     })
     assert api_delete.call_count == 0
     assert api_post.call_count == 0
+
+
+@setup_fixtures
+def test_event_title_changed(dummy_regform, api_delete, api_post, mocker):
+    """Change the event title, ADAMS contacted in the background after committing."""
+    task = mocker.patch('indico_cern_access.plugin.update_adams_requests')
+    registration = dummy_regform.registrations[0]
+    grant_access([registration], dummy_regform, email_body='body', email_subject='subject')
+    assert api_post.call_count == 1
+
+    signals.event.updated.send(dummy_regform.event, changes={'title': ('Dummy', 'Conan')})
+    assert not task.delay.called
+    signals.core.after_commit.send()
+    task.delay.assert_called_once_with(dummy_regform.event)
+    assert api_post.call_count == 1
@@ -5,10 +5,13 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
+from types import SimpleNamespace
+
 import pytest
 from conftest import generate_personal_data
 
 from indico_cern_access.models.access_requests import CERNAccessRequestState
+from indico_cern_access.plugin import CERNAccessPlugin
 from indico_cern_access.util import (get_accompanying_persons, get_last_request, sanitize_license_plate,
                                      send_adams_post_request)
 
@@ -90,3 +93,41 @@ def test_adams_post_request_not_include_accompanying(dummy_regform, mocker):
     state, data = send_adams_post_request(dummy_regform.event, dummy_regform.registrations)[:2]
     assert state == CERNAccessRequestState.active
     assert len(data) == 1
+
+
+@pytest.mark.parametrize('mock_access_request', [{  # noqa: PT007
+    'during_registration': True,
+    'during_registration_required': False,
+    'personal_data': generate_personal_data(True),
+    'include_accompanying_persons': True,
+}], indirect=True)
+@pytest.mark.usefixtures('smtp', 'mock_access_request', 'dummy_access_request')
+def test_adams_post_request_chunks(dummy_regform, mocker):
+    CERNAccessPlugin.settings.set('adams_chunk_size', 1)
+    mock = mocker.patch('indico_cern_access.util._send_adams_http_request', return_value=_Response())
+    data = send_adams_post_request(dummy_regform.event, dummy_regform.registrations)[1]
+    # accompanying persons are always sent together with their registration
+    assert mock.call_count == 1
+    assert len(mock.call_args.args[1]) == 3
+    assert len(data) == 3
+
+
+def test_adams_post_request_large_event(dummy_event, mocker):
+    """Micro-benchmark building the data of 5k visitors (use ``--durations`` to see the time taken)."""
+    CERNAccessPlugin.settings.set('adams_max_parallel', 1)
+    req = SimpleNamespace(event=dummy_event, data={'start_dt_override': None, 'end_dt_override': None,
+                                                   'include_accompanying_persons': False})
+    lookup = mocker.patch('indico_cern_access.util.get_last_request', return_value=req)
+    send = mocker.patch('indico_cern_access.util._send_adams_http_request', return_value=_Response())
+    registrations = [SimpleNamespace(id=i, first_name='Ren\xe9', last_name=f'Visitor {i}',
+                                     cern_access_request=SimpleNamespace(reservation_code=f'I{i:06}',
+                                                                         license_plate=None))
+                     for i in range(5000)]
+    data = send_adams_post_request(dummy_event, registrations, update=True)[1]
+    # the access request and dates are resolved once for the whole event
+    assert lookup.call_count == 1
+    assert send.call_count == 10
+    assert len(data) == 5000
+    assert data[42]['$fn'] == 'Rene'
+    assert data[42]['$rc'] == 'I000042'
+    assert len({(x['$gn'], x['$sd'], x['$ed']) for x in data.values()}) == 1
@@ -5,10 +5,50 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
+from contextlib import contextmanager, suppress
+from functools import cache
+
+from redis import Redis
+from redis.exceptions import LockNotOwnedError
+
 from indico.core.cache import make_scoped_cache
+from indico.core.config import config
 from indico.util.i18n import make_bound_gettext
 
 
 _ = make_bound_gettext('conversion')
 pdf_state_cache = make_scoped_cache('pdf-conversion')
 cloudconvert_task_cache = make_scoped_cache('pdf-conversion-cloudconvert-tasks')
+cloudconvert_queue_cache = make_scoped_cache('pdf-conversion-cloudconvert-queue')
+metrics_cache = make_scoped_cache('pdf-conversion-metrics')
+
+
+@cache
+def get_redis_client():
+    """Get a redis client connected to the server of Indico's cache.
+
+    The metrics and locks of the plugin need commands that the cache API
+    does not provide.
+    """
+    return Redis.from_url(config.REDIS_CACHE_URL)
+
+
+@contextmanager
+def redis_lock(name, timeout, *, blocking=True):
+    """Lock a section across all Celery workers of the instance.
+
+    The context manager yields whether the lock is held; without
+    `blocking` it does not wait for another process to release it.
+
+    :param timeout: After how long the lock is released automatically,
+                    e.g. if the worker holding it was killed.
+    """
+    lock = get_redis_client().lock(f'indico-plugin-conversion:{name}', timeout=timeout.total_seconds())
+    acquired = lock.acquire(blocking=blocking)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            # nothing to do if it timed out and another worker took it over already
+            with suppress(LockNotOwnedError):
+                lock.release()
@@ -7,6 +7,7 @@
 
 from indico.core.plugins import IndicoPluginBlueprint
 
+from indico_conversion.controllers import RHMetrics, RHMetricsAdmin
 from indico_conversion.conversion import RHCloudConvertFinished, RHConversionCheck, RHDoconverterFinished
 
 
@@ -16,3 +17,5 @@ blueprint.add_url_rule('/conversion/doconverter/finished', 'doconverter_callback
 blueprint.add_url_rule('/conversion/cloudconvert/finished', 'cloudconvert_callback',
                        RHCloudConvertFinished, methods=('POST',))
 blueprint.add_url_rule('/conversion/check', 'check', RHConversionCheck)
+blueprint.add_url_rule('/conversion/metrics', 'metrics', RHMetrics)
+blueprint.add_url_rule('/admin/conversion/metrics', 'metrics_admin', RHMetricsAdmin)
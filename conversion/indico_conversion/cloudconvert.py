@@ -6,8 +6,12 @@
 # the LICENSE file for more details.
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
+#: The maximum number of connections kept open per host
+POOL_SIZE = 10
+
 endpoints = {
     'live': 'https://api.cloudconvert.com/v2',
     'sandbox': 'https://api.sandbox.cloudconvert.com/v2',
@@ -23,12 +27,27 @@ class Resource:
 
     def find(self, id):
         url = f'{self.api_client.endpoint}/{self.resource}/{id}'
-        response = requests.get(url, headers=self.api_client.headers)
+        response = self.api_client.session.get(url, headers=self.api_client.headers)
         return self._process_response(response)
 
+    def list(self, *, per_page=100, max_pages=None, **filters):
+        """Iterate over all resources matching the filters, newest first."""
+        url = f'{self.api_client.endpoint}/{self.resource}'
+        params = {f'filter[{key}]': value for key, value in filters.items()} | {'per_page': per_page}
+        page = 0
+        while url and (max_pages is None or page < max_pages):
+            response = self.api_client.session.get(url, params=params, headers=self.api_client.headers)
+            response.raise_for_status()
+            json = response.json()
+            yield from json['data']
+            # the link to the next page already contains all parameters
+            url = json.get('links', {}).get('next')
+            params = None
+            page += 1
+
     def create(self, payload):
         url = f'{self.api_client.endpoint}/{self.resource}'
-        response = requests.post(url, json=payload, headers=self.api_client.headers)
+        response = self.api_client.session.post(url, json=payload, headers=self.api_client.headers)
         return self._process_response(response)
 
     def _process_response(self, response):
@@ -46,7 +65,7 @@ class Task(Resource):
 
     def find(self, id):
         url = f'{self.api_client.endpoint}/{self.resource}/{id}'
-        response = requests.get(url, headers=self.api_client.headers)
+        response = self.api_client.session.get(url, headers=self.api_client.headers)
         return self._process_response(response)
 
     def upload(self, task, filename, fd, mimetype):
@@ -54,7 +73,8 @@ class Task(Resource):
             raise Exception('The task operation is not import/upload')
 
         form = task['result']['form']
-        response = requests.post(url=form['url'], files={'file': (filename, fd, mimetype)}, data=form['parameters'])
+        response = self.api_client.session.post(url=form['url'], files={'file': (filename, fd, mimetype)},
+                                                data=form['parameters'])
         response.raise_for_status()
         if response.status_code != 201:
             raise requests.RequestException(f'Unexpected response status from server: {response.status_code}',
@@ -62,6 +82,9 @@ class Task(Resource):
 
 
 class CloudConvertRestClient:
+    #: the session shared by all clients in the current process, so connections are reused
+    _session = None
+
     def __init__(self, *, api_key=None, sandbox=False):
         self.api_key = api_key
         self.sandbox = sandbox
@@ -72,6 +95,15 @@ class CloudConvertRestClient:
     def endpoint(self):
         return endpoints['sandbox' if self.sandbox else 'live']
 
+    @property
+    def session(self):
+        if (session := CloudConvertRestClient._session) is None:
+            session = CloudConvertRestClient._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
     @property
     def headers(self):
         return {
@@ -81,6 +113,6 @@ class CloudConvertRestClient:
         }
 
     def get_remaining_credits(self):
-        response = requests.get(endpoints['user'], headers=self.headers)
+        response = self.session.get(endpoints['user'], headers=self.headers)
         response.raise_for_status()
         return response.json()['data']['credits']
@@ -0,0 +1,48 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from secrets import compare_digest
+
+from flask import Response, request
+from werkzeug.exceptions import Forbidden, NotFound
+
+from indico.modules.admin import RHAdminBase
+from indico.web.rh import RH
+
+from indico_conversion.metrics import DURATION_BUCKETS, get_summary, render_prometheus
+from indico_conversion.views import WPConversionAdmin
+
+
+class RHMetrics(RH):
+    """Let Prometheus scrape the conversion metrics.
+
+    The scraper authenticates with the static token from the plugin
+    settings.  Without a token the endpoint does not exist.
+    """
+
+    # Indico would otherwise try to validate the bearer token as an OAuth token and fail
+    _DISABLE_CORE_AUTH = True
+
+    def _check_access(self):
+        from indico_conversion.plugin import ConversionPlugin
+        token = ConversionPlugin.settings.get('metrics_token')
+        if not token:
+            raise NotFound
+        scheme, __, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not compare_digest(credentials, token):
+            raise Forbidden
+
+    def _process(self):
+        return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+class RHMetricsAdmin(RHAdminBase):
+    """Show an overview of the conversion metrics."""
+
+    def _process(self):
+        return WPConversionAdmin.render_template('metrics.html', 'conversion_metrics', summary=get_summary(),
+                                                 max_bucket=DURATION_BUCKETS[-1])
@@ -7,8 +7,7 @@
 
 import os
 from datetime import timedelta
-from io import BytesIO
-from urllib.parse import parse_qs, urlparse, urlsplit
+from urllib.parse import urlparse
 
 import dateutil.parser
 import requests
@@ -16,8 +15,8 @@ from celery.exceptions import MaxRetriesExceededError, Retry
 from celery.schedules import crontab
 from flask import jsonify, request, session
 from itsdangerous import BadData
-from pypdf import PdfReader, PdfWriter
-from pypdf.generic import NameObject, TextStringObject
+from pypdf.errors import PyPdfError
+from sqlalchemy.orm import joinedload
 
 from indico.core import signals
 from indico.core.celery import celery
@@ -25,6 +24,7 @@ from indico.core.config import config
 from indico.core.db import db
 from indico.core.notifications import make_email, send_email
 from indico.core.plugins import url_for_plugin
+from indico.core.storage import StorageError
 from indico.modules.attachments.models.attachments import Attachment
 from indico.util.date_time import now_utc
 from indico.util.fs import secure_filename
@@ -33,16 +33,32 @@ from indico.web.flask.templating import get_template_module
 from indico.web.flask.util import url_for
 from indico.web.rh import RH
 
-from indico_conversion import cloudconvert_task_cache, pdf_state_cache
+from indico_conversion import cloudconvert_task_cache, pdf_state_cache, redis_lock
 from indico_conversion.cloudconvert import CloudConvertRestClient
-from indico_conversion.util import save_pdf
+from indico_conversion.local import LocalConversionError, convert_to_pdf
+from indico_conversion.metrics import track_cloudconvert_result, track_failure, track_retry, track_stage
+from indico_conversion.models.converted_pdfs import ConvertedPDF
+from indico_conversion.pdf import strip_google_tracking
+from indico_conversion.scheduler import (get_watched_tasks, release_slot, take_queued_conversions, unwatch_tasks,
+                                         watch_task)
+from indico_conversion.util import buffer_response, save_pdf
 
 
 MAX_TRIES = 20
 DELAYS = [30, 60, 120, 300, 600, 1800, 3600, 3600, 7200]
+#: The maximum number of pages of recent tasks listed when checking submitted conversions
+MAX_POLL_PAGES = 5
+#: How long a single process may check submitted conversions
+POLL_LOCK_TIMEOUT = timedelta(minutes=10)
 
 
-def retry_task(task, attachment, exception):
+def retry_task(task, attachment, exception, engine):
+    """Retry a task which could not submit an attachment's file.
+
+    Once there are no retries left, the file is passed on to the engine
+    following the given one, unless it is not a conversion engine.
+    """
+    from indico_conversion.engines import get_engine, submit_attachments
     from indico_conversion.plugin import ConversionPlugin
 
     attempt = task.request.retries + 1
@@ -55,16 +71,105 @@ def retry_task(task, attachment, exception):
         task.retry(countdown=delay, max_retries=(MAX_TRIES - 1))
     except MaxRetriesExceededError:
         response_text = exception.response.text if exception.response else '<no response>'
-        ConversionPlugin.logger.error('Could not submit attachment %d (attempt %d/%d); giving up [%s]: %s',
-                                      attachment.id, attempt, MAX_TRIES, exception, response_text)
-        pdf_state_cache.delete(str(attachment.id))
+        _release_cloudconvert_slot(attachment.id)
+        if (engine_cls := get_engine(engine)) is None:
+            ConversionPlugin.logger.error('Could not submit attachment %d (attempt %d/%d); giving up [%s]: %s',
+                                          attachment.id, attempt, MAX_TRIES, exception, response_text)
+            pdf_state_cache.delete(str(attachment.id))
+            track_failure(attachment.id, engine, 'gave_up')
+            return
+        ConversionPlugin.logger.error('Could not submit attachment %d (attempt %d/%d); using the next engine '
+                                      '[%s]: %s', attachment.id, attempt, MAX_TRIES, exception, response_text)
+        track_failure(attachment.id, engine, 'gave_up', final=False)
+        submit_attachments([attachment], after=engine_cls)
     except Retry:
+        track_retry(engine)
         response_text = exception.response.text if exception.response else '<no response>'
         ConversionPlugin.logger.warning('Could not submit attachment %d (attempt %d/%d); retry in %ds [%s]: %s',
                                         attachment.id, attempt, MAX_TRIES, delay, exception, response_text)
         raise
 
 
+@celery.task
+def submit_attachment(attachment):
+    """Convert the file of a new attachment using the first enabled engine."""
+    from indico_conversion.engines import submit_attachments
+    submit_attachments([attachment])
+
+
+@celery.task
+def copy_converted_pdf(attachment, converted_pdf_id):
+    """Attach a copy of the PDF converted from a file with the same content."""
+    from indico_conversion.engines import submit_attachments
+    from indico_conversion.plugin import ConversionPlugin
+    if attachment.is_deleted or attachment.folder.is_deleted:
+        ConversionPlugin.logger.info('Attachment has been deleted: %s', attachment)
+        pdf_state_cache.delete(str(attachment.id))
+        track_failure(attachment.id, 'copy', 'deleted')
+        return
+    if converted_pdf := ConvertedPDF.get(converted_pdf_id):
+        try:
+            with converted_pdf.file.open() as fd:
+                save_pdf(attachment, fd, index=False)
+        except StorageError:
+            ConversionPlugin.logger.exception('Could not copy %r for %r; converting it instead', converted_pdf,
+                                              attachment)
+            db.session.rollback()
+            db.session.delete(converted_pdf)
+            track_failure(attachment.id, 'copy', 'storage_error', final=False)
+        else:
+            converted_pdf.use()
+            signals.core.after_process.send()
+            db.session.commit()
+            return
+    # the converted file is gone, so we need to convert the original one after all
+    db.session.commit()
+    submit_attachments([attachment])
+
+
+@celery.periodic_task(run_every=crontab(minute='30', hour='3'))
+def delete_expired_converted_pdfs():
+    """Remove converted PDFs that have not been used recently from the index."""
+    from indico_conversion.plugin import ConversionPlugin
+    retention = ConversionPlugin.settings.get('converted_pdf_retention')
+    if count := ConvertedPDF.delete_expired(retention):
+        ConversionPlugin.logger.info('Removed %d expired converted PDFs from the index', count)
+    db.session.commit()
+
+
+@celery.task(bind=True, max_retries=None)
+def convert_attachment_locally(task, attachment):
+    """Convert an attachment's file using the office suite on the worker.
+
+    If the file cannot be converted, it is passed on to the next engine.
+    """
+    from indico_conversion.engines import LocalEngine, submit_attachments
+    from indico_conversion.plugin import ConversionPlugin
+    if ConversionPlugin.settings.get('maintenance'):
+        task.retry(countdown=900)
+    if attachment.is_deleted or attachment.folder.is_deleted:
+        ConversionPlugin.logger.info('Attachment has been deleted: %s', attachment)
+        pdf_state_cache.delete(str(attachment.id))
+        track_failure(attachment.id, 'local', 'deleted')
+        return
+    ext = os.path.splitext(attachment.file.filename)[1].lstrip('.').lower()
+    try:
+        with attachment.file.open() as fd:
+            pdf = convert_to_pdf(fd, ext, binary=ConversionPlugin.settings.get('local_office_path'),
+                                 slots=ConversionPlugin.settings.get('local_max_jobs'),
+                                 timeout=ConversionPlugin.settings.get('local_timeout').total_seconds())
+    except LocalConversionError as exc:
+        ConversionPlugin.logger.warning('Could not convert %r locally; using the next engine: %s', attachment, exc)
+        track_failure(attachment.id, 'local', exc.reason, final=False)
+        submit_attachments([attachment], after=LocalEngine)
+        return
+    track_stage(attachment.id, 'converted')
+    with pdf:
+        save_pdf(attachment, pdf)
+    signals.core.after_process.send()
+    db.session.commit()
+
+
 @celery.task(bind=True, max_retries=None)
 def submit_attachment_doconverter(task, attachment):
     """Send an attachment's file to the Doconverter conversion service."""
@@ -92,9 +197,10 @@ def submit_attachment_doconverter(task, attachment):
             if 'ok' not in response.text:
                 raise requests.RequestException(f'Unexpected response from server: {response.text}', response=response)
         except requests.RequestException as exc:
-            retry_task(task, attachment, exc)
+            retry_task(task, attachment, exc, 'doconverter')
         else:
             ConversionPlugin.logger.info('Submitted %r to Doconverter', attachment)
+            track_stage(attachment.id, 'uploaded')
 
 
 @celery.task(bind=True, max_retries=None)
@@ -117,60 +223,56 @@ def request_pdf_from_googledrive(task, attachment):
     api_key = ConversionPlugin.settings.get('googledrive_api_key')
     request_text = f'https://www.googleapis.com/drive/v3/files/{file_id}/export?mimeType={mime_type}'
     try:
-        response = requests.get(request_text, headers={'x-goog-api-key': api_key})
+        response = requests.get(request_text, headers={'x-goog-api-key': api_key}, stream=True)
     except requests.HTTPError as exc:
         if exc.response.status_code == 404:
             ConversionPlugin.logger.warning('Google Drive file %s not found', attachment.link_url)
             pdf_state_cache.delete(str(attachment.id))
             return
-        retry_task(task, attachment, exc)
+        retry_task(task, attachment, exc, 'googledrive')
     else:
-        content_type = response.headers['Content-type']
-        if content_type.startswith('application/json'):
-            payload = response.json()
+        with response:
+            content_type = response.headers['Content-type']
+            if content_type.startswith('application/json'):
+                payload = response.json()
+                try:
+                    error_code = payload['error']['code']
+                except (TypeError, KeyError):
+                    error_code = 0
+                if error_code == 404:
+                    ConversionPlugin.logger.info('Google Drive file %s not found (or not public)',
+                                                 attachment.link_url)
+                else:
+                    ConversionPlugin.logger.warning('Google Drive file %s could not be converted: %s',
+                                                    attachment.link_url, payload)
+                pdf_state_cache.delete(str(attachment.id))
+                return
+            elif content_type != 'application/pdf':
+                ConversionPlugin.logger.warning('Google Drive file %s conversion response is not a PDF: %s',
+                                                attachment.link_url, content_type)
+                pdf_state_cache.delete(str(attachment.id))
+                return
             try:
-                error_code = payload['error']['code']
-            except (TypeError, KeyError):
-                error_code = 0
-            if error_code == 404:
-                ConversionPlugin.logger.info('Google Drive file %s not found (or not public)', attachment.link_url)
+                pdf = buffer_response(response)
+            except requests.RequestException as exc:
+                retry_task(task, attachment, exc, 'googledrive')
+                return
+        with pdf:
+            try:
+                stripped_pdf = strip_google_tracking(pdf)
+            except PyPdfError:
+                # the tracking links are annoying, but not worth losing the PDF over
+                ConversionPlugin.logger.exception('Could not strip Google tracking links from %s',
+                                                  attachment.link_url)
+                pdf.seek(0)
+                save_pdf(attachment, pdf)
             else:
-                ConversionPlugin.logger.warning('Google Drive file %s could not be converted: %s', attachment.link_url,
-                                                payload)
-            pdf_state_cache.delete(str(attachment.id))
-            return
-        elif content_type != 'application/pdf':
-            ConversionPlugin.logger.warning('Google Drive file %s conversion response is not a PDF: %s',
-                                            attachment.link_url, content_type)
-            pdf_state_cache.delete(str(attachment.id))
-            return
-        pdf = BytesIO(response.content)
-        pdf = _strip_google_tracking(pdf)
-        save_pdf(attachment, pdf)
+                with stripped_pdf:
+                    save_pdf(attachment, stripped_pdf)
         signals.core.after_process.send()
         db.session.commit()
 
 
-def _strip_google_tracking(pdf: BytesIO) -> BytesIO:
-    reader = PdfReader(pdf)
-    writer = PdfWriter()
-    for page in reader.pages:
-        for annot in (page.annotations or ()):
-            obj = annot.get_object()
-            if (
-                (link := obj.get('/A'))
-                and (uri := link.get('/URI'))
-                and uri.startswith('https://www.google.com/url?q=')
-            ):
-                q = parse_qs(urlsplit(uri).query)['q'][0]
-                link[NameObject('/URI')] = TextStringObject(q)
-        writer.add_page(page)
-    buf = BytesIO()
-    writer.write(buf)
-    buf.seek(0)
-    return buf.getvalue()
-
-
 class RHDoconverterFinished(RH):
     """Callback to attach a converted file."""
 
@@ -186,15 +288,44 @@ class RHDoconverterFinished(RH):
         attachment = Attachment.get(payload['attachment_id'])
         if not attachment or attachment.is_deleted or attachment.folder.is_deleted:
             ConversionPlugin.logger.info('Attachment has been deleted: %s', attachment)
+            track_failure(payload['attachment_id'], 'doconverter', 'deleted')
             return jsonify(success=True)
         elif request.form['status'] != '1':
             ConversionPlugin.logger.error('Received invalid status %s for %s', request.form['status'], attachment)
+            track_failure(attachment.id, 'doconverter', 'conversion_error')
             return jsonify(success=False)
-        pdf = request.files['content'].stream.read()
-        save_pdf(attachment, pdf)
+        track_stage(attachment.id, 'converted')
+        # werkzeug already buffers large uploads on disk, so we just pass on the file
+        save_pdf(attachment, request.files['content'].stream)
         return jsonify(success=True)
 
 
+def _release_cloudconvert_slot(attachment_id):
+    if release_slot(attachment_id):
+        submit_queued_cloudconvert.delay()
+
+
+@celery.periodic_task(run_every=crontab(minute='*/5'))
+def submit_queued_cloudconvert():
+    """Submit queued attachments to CloudConvert while there are free slots.
+
+    This runs whenever a slot is released and periodically in case a
+    slot was released without submitting the next attachment.
+    """
+    from indico_conversion.plugin import ConversionPlugin
+    while ids := take_queued_conversions(ConversionPlugin.settings.get('cloudconvert_max_jobs')):
+        attachments = {a.id: a for a in Attachment.query.filter(Attachment.id.in_(ids))}
+        for attachment_id in ids:
+            attachment = attachments.get(attachment_id)
+            if attachment and not attachment.is_deleted and not attachment.folder.is_deleted:
+                submit_attachment_cloudconvert.delay(attachment)
+                continue
+            ConversionPlugin.logger.info('Queued attachment has been deleted: %s', attachment_id)
+            pdf_state_cache.delete(str(attachment_id))
+            track_failure(attachment_id, 'cloudconvert', 'deleted')
+            release_slot(attachment_id)
+
+
 @celery.task(bind=True, max_retries=None)
 def submit_attachment_cloudconvert(task, attachment):
     """Send an attachment's file to the CloudConvert conversion service."""
@@ -239,88 +370,174 @@ def submit_attachment_cloudconvert(task, attachment):
         assert export_task['operation'] == 'export/url'
         with attachment.file.open() as fd:
             client.Task.upload(upload_task, f'attachment{file_ext}', fd, attachment.file.content_type)
+        track_stage(attachment.id, 'uploaded')
         # add polling in case we miss a webhook
         export_task_id = export_task['id']
         cloudconvert_task_cache.set(export_task_id, 'pending')
-        check_attachment_cloudconvert.apply_async(args=(attachment.id, export_task_id), countdown=15)
+        watch_task(attachment.id, export_task_id)
     except requests.RequestException as exc:
-        retry_task(task, attachment, exc)
+        retry_task(task, attachment, exc, 'cloudconvert')
     else:
         ConversionPlugin.logger.info('Submitted %r to CloudConvert', attachment)
 
 
-@celery.task(bind=True, max_retries=None)
-def check_attachment_cloudconvert(task, attachment_id, export_task_id):
-    from indico_conversion.plugin import ConversionPlugin
+def _download_pdf(url):
+    with requests.get(url, stream=True) as resp:
+        if not resp.ok:
+            # load the (small) error response while the connection is still open so it can be logged
+            resp.content  # noqa: B018
+        resp.raise_for_status()
+        return buffer_response(resp)
 
-    api_key = ConversionPlugin.settings.get('cloudconvert_api_key')
-    sandbox = ConversionPlugin.settings.get('cloudconvert_sandbox')
-    client = CloudConvertRestClient(api_key=api_key, sandbox=sandbox)
-    status = cloudconvert_task_cache.get(export_task_id, '<unknown>')
 
-    if status == 'done':
-        ConversionPlugin.logger.info('Converted file for attachment %d (task %s) already received via webhook',
-                                     attachment_id, export_task_id)
-        return
-    elif status == 'failed':
-        ConversionPlugin.logger.info('Converted file for attachment %d (task %s) already failed via webhook',
-                                     attachment_id, export_task_id)
-        return
-    elif status == 'processing':
-        ConversionPlugin.logger.info('Converted file for attachment %d (task %s) already being processed via webhook',
-                                     attachment_id, export_task_id)
-        task.retry(countdown=30)  # retry the task in case something fails during the webhook though
-        return
-    elif status != 'pending':
-        ConversionPlugin.logger.warning('Unexpected conversion state for attachment %d (task %s): %s',
-                                        attachment_id, export_task_id, status)
-        return
+@celery.task
+def check_attachment_cloudconvert(attachment_id, export_task_id):
+    """Check a submitted conversion in :func:`poll_cloudconvert_tasks`.
 
-    try:
-        export_task = client.Task.find(export_task_id)
-    except requests.RequestException:
-        task.retry(countdown=30)
+    Submitted conversions are now checked by the periodic poller, but this
+    task is kept for any that were scheduled before updating the plugin.
+    """
+    watch_task(attachment_id, export_task_id)
+
+
+@celery.periodic_task(run_every=crontab(minute='*'))
+def poll_cloudconvert_tasks():
+    """Check all submitted conversions in case we missed a webhook.
+
+    Instead of fetching each export task separately, the most recent
+    tasks are listed, which covers all pending ones with a few requests.
+    """
+    from indico_conversion.plugin import ConversionPlugin
+
+    if not (watched := get_watched_tasks()):
         return
+    with redis_lock('cloudconvert-poll', POLL_LOCK_TIMEOUT, blocking=False) as locked:
+        if not locked:
+            ConversionPlugin.logger.info('CloudConvert tasks are already being checked')
+            return
+        _poll_cloudconvert_tasks(watched)
+
+
+def _poll_cloudconvert_tasks(watched):
+    from indico_conversion.plugin import ConversionPlugin
+
+    handled = set()
+    pending = {}
+    statuses = cloudconvert_task_cache.get_many(*watched)
+    for (export_task_id, (attachment_id, __)), status in zip(watched.items(), statuses, strict=True):
+        status = status or '<unknown>'
+        if status in {'done', 'failed'}:
+            # we usually got a webhook, so there is nothing left to do
+            handled.add(export_task_id)
+        elif status == 'processing':
+            # check again later in case something fails during the webhook
+            ConversionPlugin.logger.info('Converted file for attachment %d (task %s) already being processed via '
+                                         'webhook', attachment_id, export_task_id)
+        elif status == 'pending':
+            pending[export_task_id] = attachment_id
+        else:
+            ConversionPlugin.logger.warning('Unexpected conversion state for attachment %d (task %s): %s',
+                                            attachment_id, export_task_id, status)
+            handled.add(export_task_id)
+
+    if pending:
+        api_key = ConversionPlugin.settings.get('cloudconvert_api_key')
+        sandbox = ConversionPlugin.settings.get('cloudconvert_sandbox')
+        client = CloudConvertRestClient(api_key=api_key, sandbox=sandbox)
+        try:
+            export_tasks = _find_export_tasks(client, pending)
+        except requests.RequestException as exc:
+            ConversionPlugin.logger.warning('Could not check %d CloudConvert tasks: %s', len(pending), exc)
+            export_tasks = {}
+        finished = [attachment_id for export_task_id, attachment_id in pending.items()
+                    if export_tasks.get(export_task_id, {}).get('status') == 'finished']
+        attachments = {}
+        if finished:
+            query = Attachment.query.filter(Attachment.id.in_(finished)).options(joinedload(Attachment.folder))
+            attachments = {attachment.id: attachment for attachment in query}
+        for export_task_id, export_task in export_tasks.items():
+            attachment_id = pending[export_task_id]
+            if _process_export_task(attachment_id, attachments.get(attachment_id), export_task):
+                handled.add(export_task_id)
+
+    unwatch_tasks(handled)
+
+
+def _find_export_tasks(client, pending):
+    found = {}
+    for export_task in client.Task.list(operation='export/url', max_pages=MAX_POLL_PAGES):
+        if export_task['id'] in pending:
+            found[export_task['id']] = export_task
+            if len(found) == len(pending):
+                return found
+    # tasks which are not listed (e.g. because there are many newer ones) are fetched separately
+    for export_task_id in pending.keys() - found.keys():
+        try:
+            found[export_task_id] = client.Task.find(export_task_id)
+        except requests.HTTPError as exc:
+            if exc.response.status_code != 404:
+                raise
+            # cloudconvert deletes tasks after a day, so we will never get a result for this one
+            found[export_task_id] = {'id': export_task_id, 'status': 'error', 'code': 'NOT_FOUND'}
+    return found
 
+
+def _process_export_task(attachment_id, attachment, export_task):
+    """Process the result of a conversion found while polling.
+
+    :return: Whether the conversion has been handled, i.e. its export
+             task does not need to be checked anymore.
+    """
+    from indico_conversion.plugin import ConversionPlugin
+
+    export_task_id = export_task['id']
     if export_task['status'] == 'error':
         ConversionPlugin.logger.warning('Conversion for attachment %d (task %s) failed (%s)',
                                         attachment_id, export_task_id, export_task['code'])
         pdf_state_cache.delete(str(attachment_id))
-        return
+        track_failure(attachment_id, 'cloudconvert', 'not_found' if export_task['code'] == 'NOT_FOUND'
+                      else 'conversion_error')
+        _release_cloudconvert_slot(attachment_id)
+        return True
     if export_task['status'] != 'finished':
         ConversionPlugin.logger.info('Conversion for attachment %d (task %s) not finished yet (%s)',
                                      attachment_id, export_task_id, export_task['status'])
-        task.retry(countdown=30)
-        return
+        return False
 
     if (now_utc() - dateutil.parser.parse(export_task['ended_at'])) < timedelta(seconds=10):
         # it's possible that the webhook and task run at the same time, and in that case we
         # want to avoid duplicate files, so we never process the file if it *just* finished
         ConversionPlugin.logger.info('Got successful conversion for attachment %d (task %s) via polling, waiting a bit',
                                      attachment_id, export_task_id)
-        task.retry(countdown=5)
+        return False
 
     ConversionPlugin.logger.warning('Got successful conversion for attachment %d (task %s) via polling',
                                     attachment_id, export_task_id)
     url = export_task['result']['files'][0]['url']
-    attachment = Attachment.get(attachment_id)
     if not attachment or attachment.is_deleted or attachment.folder.is_deleted:
         ConversionPlugin.logger.info('Attachment has been deleted: %s', attachment)
         cloudconvert_task_cache.delete(export_task_id)
-        return
-    resp = requests.get(url)
+        track_failure(attachment_id, 'cloudconvert', 'deleted')
+        _release_cloudconvert_slot(attachment_id)
+        return True
+    track_stage(attachment_id, 'converted')
     try:
-        resp.raise_for_status()
+        pdf = _download_pdf(url)
     except requests.RequestException as exc:
         response_text = exc.response.text if exc.response else '<no response>'
         ConversionPlugin.logger.warning('Could not download converted file for attachment %d (task %s): %s [%s]',
                                         attachment_id, export_task_id, exc, response_text)
-        task.retry(countdown=60)
-        return
-    save_pdf(attachment, resp.content)
+        track_failure(attachment_id, 'cloudconvert', 'download_error', final=False)
+        return False
+    track_stage(attachment_id, 'downloaded')
+    with pdf:
+        save_pdf(attachment, pdf)
     signals.core.after_process.send()
-    cloudconvert_task_cache.delete(export_task_id)
+    cloudconvert_task_cache.set(export_task_id, 'done', 3600)
     db.session.commit()
+    track_cloudconvert_result('polling')
+    _release_cloudconvert_slot(attachment_id)
+    return True
 
 
 class RHCloudConvertFinished(RH):
@@ -346,34 +563,43 @@ class RHCloudConvertFinished(RH):
             ConversionPlugin.logger.error('CloudConvert conversion job failed: %s', request.json)
             cloudconvert_task_cache.set(task['id'], 'failed', 3600)
             pdf_state_cache.delete(str(attachment_id))
+            track_failure(attachment_id, 'cloudconvert', 'conversion_error')
+            _release_cloudconvert_slot(attachment_id)
             return jsonify(success=False)
 
         attachment = Attachment.get(attachment_id)
         if not attachment or attachment.is_deleted or attachment.folder.is_deleted:
             ConversionPlugin.logger.info('Attachment has been deleted: %s', attachment)
             cloudconvert_task_cache.set(task['id'], 'done', 3600)
+            track_failure(attachment_id, 'cloudconvert', 'deleted')
+            _release_cloudconvert_slot(attachment_id)
             return jsonify(success=True)
 
         # make sure polling task doesn't also process the file in case of a race condition
         cloudconvert_task_cache.set(task['id'], 'processing', 3600)
 
+        track_stage(attachment_id, 'converted')
         try:
             url = task['result']['files'][0]['url']
-            resp = requests.get(url)
             try:
-                resp.raise_for_status()
+                pdf = _download_pdf(url)
             except requests.RequestException as exc:
                 response_text = exc.response.text if exc.response else '<no response>'
                 ConversionPlugin.logger.error('Could not download converted file for attachment %d (task %s): %s [%s]',
                                               attachment_id, task['id'], exc, response_text)
+                track_failure(attachment_id, 'cloudconvert', 'download_error', final=False)
                 return jsonify(success=False)
 
-            save_pdf(attachment, resp.content)
+            track_stage(attachment_id, 'downloaded')
+            with pdf:
+                save_pdf(attachment, pdf)
         except Exception:
             # if anything goes wrong here give the polling task a chance to succeed
             cloudconvert_task_cache.set(task['id'], 'pending', 3600)
             raise
         cloudconvert_task_cache.set(task['id'], 'done', 3600)
+        track_cloudconvert_result('webhook')
+        _release_cloudconvert_slot(attachment_id)
         return jsonify(success=True)
 
 
@@ -382,16 +608,22 @@ class RHConversionCheck(RH):
 
     def _process(self):
         ids = request.args.getlist('a')
-        results = {int(id_): pdf_state_cache.get(id_) for id_ in ids}
+        results = dict(zip(map(int, ids), pdf_state_cache.get_many(*ids), strict=True)) if ids else {}
         finished = [id_ for id_, status in results.items() if status == 'finished']
         pending = [id_ for id_, status in results.items() if status == 'pending']
         containers = {}
         if finished:
             tpl = get_template_module('attachments/_display.html')
-            for attachment in Attachment.query.filter(Attachment.id.in_(finished)):
+            rendered = {}
+            query = Attachment.query.filter(Attachment.id.in_(finished)).options(joinedload(Attachment.folder))
+            for attachment in query:
                 if not attachment.folder.can_view(session.user):
                     continue
-                containers[attachment.id] = tpl.render_attachments_folders(item=attachment.folder.object)
+                # all attachments in the same container (e.g. a contribution) share the same html
+                item = attachment.folder.object
+                if item not in rendered:
+                    rendered[item] = tpl.render_attachments_folders(item=item)
+                containers[attachment.id] = rendered[item]
         return jsonify(finished=finished, pending=pending, containers=containers)
 
 
@@ -402,6 +634,12 @@ def check_cloudconvert_credits(task):
     if not ConversionPlugin.settings.get('use_cloudconvert'):
         return
 
+    # every converted file is indexed once, and every copied one is a conversion we did not pay for
+    converted, copied = ConvertedPDF.get_stats()
+    hit_rate = copied / (converted + copied) if copied else 0
+    ConversionPlugin.logger.info('Converted PDF index: %d files, %d copies (hit rate %.1f%%)',
+                                 converted, copied, hit_rate * 100)
+
     api_key = ConversionPlugin.settings.get('cloudconvert_api_key')
     client = CloudConvertRestClient(api_key=api_key, sandbox=False)
     notify_threshold = ConversionPlugin.settings.get('cloudconvert_notify_threshold')
@@ -421,7 +659,8 @@ def check_cloudconvert_credits(task):
         if notify_email:
             plugin_settings_url = url_for('plugins.details', plugin=ConversionPlugin.name, _external=True)
             template = get_template_module('conversion:emails/cloudconvert_low_credits.html', credits=credits,
-                                           plugin_settings_url=plugin_settings_url)
+                                           plugin_settings_url=plugin_settings_url, converted=converted,
+                                           copied=copied, hit_rate=hit_rate)
             email = make_email(to_list=notify_email, template=template, html=True)
             send_email(email)
     else:
@@ -0,0 +1,135 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import os
+
+from indico_conversion import pdf_state_cache
+from indico_conversion.conversion import (convert_attachment_locally, copy_converted_pdf,
+                                          submit_attachment_doconverter, submit_queued_cloudconvert)
+from indico_conversion.metrics import track_failure, track_stage
+from indico_conversion.models.converted_pdfs import ConvertedPDF
+from indico_conversion.scheduler import queue_conversion
+
+
+class ConversionEngine:
+    """Base class for the services converting attachment files to PDF."""
+
+    #: The name of the engine, used in log messages
+    name = None
+
+    @classmethod
+    def is_enabled(cls):
+        """Whether the engine is enabled in the plugin settings."""
+        raise NotImplementedError
+
+    @classmethod
+    def submit(cls, attachments):
+        """Start converting the files of the given attachments.
+
+        The conversion runs in the background, and the converted files
+        are attached using :func:`~indico_conversion.util.save_pdf`.
+        If the engine gives up on a file, it should be passed on to the
+        next engine using :func:`submit_attachments`.
+        """
+        raise NotImplementedError
+
+
+class LocalEngine(ConversionEngine):
+    """Convert files using a headless office suite on the Celery workers."""
+
+    name = 'local'
+
+    @classmethod
+    def is_enabled(cls):
+        from indico_conversion.plugin import ConversionPlugin
+        return ConversionPlugin.settings.get('use_local')
+
+    @classmethod
+    def submit(cls, attachments):
+        for attachment in attachments:
+            convert_attachment_locally.delay(attachment)
+
+
+class CloudConvertEngine(ConversionEngine):
+    """Convert files using the CloudConvert API."""
+
+    name = 'cloudconvert'
+
+    @classmethod
+    def is_enabled(cls):
+        from indico_conversion.plugin import ConversionPlugin
+        return ConversionPlugin.settings.get('use_cloudconvert')
+
+    @classmethod
+    def submit(cls, attachments):
+        for attachment in attachments:
+            queue_conversion(attachment)
+        submit_queued_cloudconvert.delay()
+
+
+class DoconverterEngine(ConversionEngine):
+    """Convert files using a Doconverter server."""
+
+    name = 'doconverter'
+
+    @classmethod
+    def is_enabled(cls):
+        from indico_conversion.plugin import ConversionPlugin
+        # always used if configured, so it can convert files CloudConvert gave up on
+        return bool(ConversionPlugin.settings.get('server_url'))
+
+    @classmethod
+    def submit(cls, attachments):
+        for attachment in attachments:
+            submit_attachment_doconverter.delay(attachment)
+
+
+#: All conversion engines, in the order in which they are used
+ENGINES = [LocalEngine, CloudConvertEngine, DoconverterEngine]
+
+
+def get_engines():
+    """Get the enabled conversion engines, in the order in which they are used."""
+    return [engine for engine in ENGINES if engine.is_enabled()]
+
+
+def get_engine(name):
+    """Get the conversion engine with the given name, or ``None`` if there is none."""
+    return next((engine for engine in ENGINES if engine.name == name), None)
+
+
+def submit_attachments(attachments, *, after=None):
+    """Convert the files of attachments using the first enabled engine.
+
+    Files with the same content as a previously converted one get a copy
+    of that PDF instead of being converted again.
+
+    :param after: Only use the engines following this one, e.g. when it
+                  could not convert the files.
+    """
+    from indico_conversion.plugin import ConversionPlugin
+    engines = get_engines()
+    if after is not None:
+        engines = [engine for engine in engines if ENGINES.index(engine) > ENGINES.index(after)]
+    if not engines:
+        for attachment in attachments:
+            ConversionPlugin.logger.error('No conversion engine left to convert %r', attachment)
+            pdf_state_cache.delete(str(attachment.id))
+            track_failure(attachment.id, 'none', 'no_engine')
+        return
+    retention = ConversionPlugin.settings.get('converted_pdf_retention')
+    remaining = []
+    for attachment in attachments:
+        ext = os.path.splitext(attachment.file.filename)[1].lstrip('.').lower()
+        if after is None and (converted_pdf := ConvertedPDF.find(attachment.file, retention)):
+            track_stage(attachment.id, 'submitted', engine='copy', ext=ext)
+            copy_converted_pdf.delay(attachment, converted_pdf.id)
+        else:
+            track_stage(attachment.id, 'submitted', engine=engines[0].name, ext=ext)
+            remaining.append(attachment)
+    if remaining:
+        engines[0].submit(remaining)
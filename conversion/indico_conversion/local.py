@@ -0,0 +1,132 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import fcntl
+import os
+import shutil
+import signal
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+
+from indico.core.config import config
+
+from indico_conversion.util import CHUNK_SIZE, MAX_MEMORY_SIZE
+
+
+class LocalConversionError(Exception):
+    """A file could not be converted using the local office installation."""
+
+    def __init__(self, message, reason='failed'):
+        super().__init__(message)
+        #: A short description of the problem used in metrics
+        self.reason = reason
+
+
+def _get_base_dir():
+    return os.path.join(config.TEMP_DIR, 'conversion-office')
+
+
+def _lock_slot(path):
+    os.makedirs(path, exist_ok=True)
+    fd = os.open(os.path.join(path, 'lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _lock_free_slot(slots):
+    for slot in range(slots):
+        path = os.path.join(_get_base_dir(), f'slot-{slot}')
+        if (fd := _lock_slot(path)) is not None:
+            return path, fd
+    return None
+
+
+@contextmanager
+def _acquire_slot(slots, wait):
+    """Wait for a free slot to run the office suite in.
+
+    The slots are shared by all worker processes on the same machine, so
+    at most `slots` conversions run at the same time.  Each slot has its
+    own profile directory since it cannot be used by more than one process.
+    """
+    deadline = time.monotonic() + wait
+    while not (slot := _lock_free_slot(slots)):
+        if time.monotonic() > deadline:
+            raise LocalConversionError('No free conversion slot', 'busy')
+        time.sleep(0.5)
+    path, fd = slot
+    try:
+        yield path
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _run(args, timeout):
+    # the office launcher starts the actual office process as a child, so we need to kill the whole group
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    try:
+        output = proc.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.communicate()
+        raise LocalConversionError(f'Timed out after {timeout}s', 'timeout') from None
+    if proc.returncode:
+        raise LocalConversionError(f'Exited with code {proc.returncode}: {output.decode(errors="replace")}')
+    return output
+
+
+def _get_args(binary, profile_dir):
+    return [binary, '--headless', '--invisible', '--norestore', '--nodefault', '--nolockcheck',
+            f'-env:UserInstallation={Path(profile_dir).as_uri()}']
+
+
+def _get_profile(binary, slot_dir, timeout):
+    # creating a new profile takes much longer than starting the office suite with an existing one,
+    # so each slot keeps its profile for all future conversions
+    profile_dir = os.path.join(slot_dir, 'profile')
+    if not os.path.exists(profile_dir):
+        _run([*_get_args(binary, profile_dir), '--terminate_after_init'], timeout)
+    return profile_dir
+
+
+def convert_to_pdf(fd, ext, *, binary, slots, timeout):
+    """Convert a file to PDF using a local headless office suite.
+
+    :param fd: A file-like object containing the file to convert.
+    :param ext: The extension of the file, which determines its format.
+    :param binary: The name or path of the office executable.
+    :param slots: The maximum number of concurrent conversions.
+    :param timeout: The number of seconds after which the conversion is
+                    aborted.  This is also the maximum time to wait for
+                    a free slot.
+    :return: A temporary file containing the PDF file.
+    """
+    if not (binary := shutil.which(binary)):
+        raise LocalConversionError('Office suite not found', 'not_installed')
+    with _acquire_slot(slots, timeout) as slot_dir, TemporaryDirectory(dir=config.TEMP_DIR) as tmp_dir:
+        profile_dir = _get_profile(binary, slot_dir, timeout)
+        source = os.path.join(tmp_dir, f'document.{ext}')
+        with open(source, 'wb') as f:
+            shutil.copyfileobj(fd, f, CHUNK_SIZE)
+        output = _run([*_get_args(binary, profile_dir), '--convert-to', 'pdf', '--outdir', tmp_dir, source], timeout)
+        target = os.path.join(tmp_dir, 'document.pdf')
+        if not os.path.exists(target):
+            raise LocalConversionError(f'No PDF file created: {output.decode(errors="replace")}')
+        with open(target, 'rb') as f:
+            pdf = SpooledTemporaryFile(max_size=MAX_MEMORY_SIZE)  # noqa: SIM115
+            shutil.copyfileobj(f, pdf, CHUNK_SIZE)
+    pdf.seek(0)
+    return pdf
@@ -0,0 +1,223 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import re
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from indico_conversion import get_redis_client, metrics_cache
+
+
+#: Upper bounds of the duration histogram buckets (in seconds)
+DURATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600)
+
+#: The stages of a conversion, in the order in which they are reached
+STAGES = ('submitted', 'uploaded', 'converted', 'downloaded', 'saved')
+
+#: How long the timings of a conversion are kept before it is considered lost
+TIMINGS_TTL = timedelta(days=1)
+
+#: The redis hash in which all workers add up their metrics
+TOTALS_KEY = 'indico-plugin-conversion:metrics'
+
+#: All metrics with their type and description
+METRICS = {
+    'conversion_submitted_total': ('counter', 'Number of files submitted for conversion by engine and extension'),
+    'conversion_duration_seconds': ('histogram', 'Time between submitting a file and attaching the converted PDF'),
+    'conversion_stage_duration_seconds': ('histogram', 'Time between reaching a conversion stage and the previous one'),
+    'conversion_failures_total': ('counter', 'Number of failed conversions by engine and reason'),
+    'conversion_retries_total': ('counter', 'Number of retried submissions by engine'),
+    'conversion_cloudconvert_results_total': ('counter', 'Number of CloudConvert results by how they were received'),
+}
+
+
+def _sample_key(name, labels):
+    """Get the name of a sample as written in the Prometheus format.
+
+    The samples are stored under this name, e.g.
+    ``conversion_retries_total{engine="local"}``, so they can be
+    exported without any further processing.
+    """
+    if not labels:
+        return name
+    label_list = ','.join(f'{key}="{labels[key]}"' for key in sorted(labels))
+    return f'{name}{{{label_list}}}'
+
+
+def _parse_labels(key):
+    return dict(re.findall(r'(\w+)="([^"]*)"', key.partition('{')[2]))
+
+
+def _get_family(key):
+    """Get the metric a sample belongs to, e.g. the histogram of a bucket."""
+    name = key.partition('{')[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and (family := name.removesuffix(suffix)) in METRICS:
+            return family
+    return name
+
+
+def inc(name, value=1, **labels):
+    """Increment a counter."""
+    get_redis_client().hincrbyfloat(TOTALS_KEY, _sample_key(name, labels), value)
+
+
+def observe(name, value, **labels):
+    """Add an observation to a histogram."""
+    bounds = [f'{bound:g}' for bound in DURATION_BUCKETS if value <= bound]
+    # MULTI/EXEC, so nobody reads a histogram containing only part of an observation
+    with get_redis_client().pipeline() as pipe:
+        for bound in (*bounds, '+Inf'):
+            pipe.hincrbyfloat(TOTALS_KEY, _sample_key(f'{name}_bucket', labels | {'le': bound}), 1)
+        pipe.hincrbyfloat(TOTALS_KEY, _sample_key(f'{name}_sum', labels), value)
+        pipe.hincrbyfloat(TOTALS_KEY, _sample_key(f'{name}_count', labels), 1)
+        pipe.execute()
+
+
+def track_stage(attachment_id, stage, *, engine=None, ext=None):
+    """Record that the conversion of an attachment reached a stage.
+
+    The time since the previous stage is added to the histogram of the
+    stage, and once the PDF has been saved, the time since the file was
+    first submitted.  When a file is submitted again to another engine,
+    the total time still includes the time spent in the previous one.
+
+    :param engine: The name of the conversion engine, only needed when
+                   the file is submitted.
+    :param ext: The extension of the file, only needed when the file is
+                submitted.
+    """
+    key = f'timings-{attachment_id}'
+    now = time.time()
+    timings = metrics_cache.get(key)
+    if stage == 'submitted':
+        inc('conversion_submitted_total', engine=engine, ext=ext)
+        start = timings['start'] if timings else now
+        metrics_cache.set(key, {'engine': engine, 'ext': ext, 'start': start, 'last': now}, timeout=TIMINGS_TTL)
+        return
+    elif not timings:
+        # not submitted by us (e.g. google drive links) or submitted a long time ago
+        return
+    labels = {'engine': timings['engine'], 'ext': timings['ext']}
+    observe('conversion_stage_duration_seconds', now - timings['last'], stage=stage, **labels)
+    if stage == 'saved':
+        observe('conversion_duration_seconds', now - timings['start'], **labels)
+        metrics_cache.delete(key)
+    else:
+        metrics_cache.set(key, timings | {'last': now}, timeout=TIMINGS_TTL)
+
+
+def track_failure(attachment_id, engine, reason, *, final=True):
+    """Record that the conversion of an attachment failed.
+
+    :param final: Whether the file will not be converted anymore, as
+                  opposed to being passed on to another engine.
+    """
+    inc('conversion_failures_total', engine=engine, reason=reason)
+    if final:
+        metrics_cache.delete(f'timings-{attachment_id}')
+
+
+def track_retry(engine):
+    """Record that submitting a file to a conversion engine is retried."""
+    inc('conversion_retries_total', engine=engine)
+
+
+def track_cloudconvert_result(source):
+    """Record how the result of a CloudConvert job was received.
+
+    :param source: Either ``'webhook'`` or ``'polling'``.
+    """
+    inc('conversion_cloudconvert_results_total', source=source)
+
+
+def get_totals():
+    """Get the aggregated metrics of all conversions."""
+    totals = {}
+    for key, value in get_redis_client().hgetall(TOTALS_KEY).items():
+        # redis stores floats, but most metrics are counts
+        value = float(value)
+        totals[key.decode()] = int(value) if value.is_integer() else value
+    return totals
+
+
+def get_value(totals, name, **labels):
+    """Get the value of a metric with the given labels."""
+    return totals.get(_sample_key(name, labels), 0)
+
+
+def get_label_sets(totals, name):
+    """Get all combinations of labels which have values for a metric.
+
+    For histograms, `name` needs to include the ``_count`` suffix.
+    """
+    return [_parse_labels(key) for key in sorted(totals) if key.partition('{')[0] == name]
+
+
+def estimate_quantile(totals, name, quantile, **labels):
+    """Estimate a quantile of a duration histogram.
+
+    Since only the number of observations per bucket is known, the result
+    is the upper bound of the first bucket reaching the quantile (and
+    infinity if only the last bucket does).  If the histogram is empty,
+    `None` is returned.
+    """
+    if not (count := get_value(totals, f'{name}_count', **labels)):
+        return None
+    return next((bound for bound in DURATION_BUCKETS
+                 if get_value(totals, f'{name}_bucket', le=f'{bound:g}', **labels) >= quantile * count),
+                float('inf'))
+
+
+def _get_histogram_summary(totals, name, **labels):
+    count = get_value(totals, f'{name}_count', **labels)
+    return {'count': count,
+            'mean': get_value(totals, f'{name}_sum', **labels) / count,
+            'p50': estimate_quantile(totals, name, 0.5, **labels),
+            'p95': estimate_quantile(totals, name, 0.95, **labels)}
+
+
+def _get_counters(totals, name):
+    return [labels | {'count': get_value(totals, name, **labels)} for labels in get_label_sets(totals, name)]
+
+
+def get_summary():
+    """Get an overview of the metrics of all conversions.
+
+    :return: A dict containing lists of dicts with the labels of each
+             metric and their values.  For histograms the values are the
+             number of observations, the mean and two percentiles.
+    """
+    totals = get_totals()
+    return {
+        'durations': [labels | _get_histogram_summary(totals, 'conversion_duration_seconds', **labels)
+                      for labels in get_label_sets(totals, 'conversion_duration_seconds_count')],
+        'stages': sorted((labels | _get_histogram_summary(totals, 'conversion_stage_duration_seconds', **labels)
+                          for labels in get_label_sets(totals, 'conversion_stage_duration_seconds_count')),
+                         key=lambda x: (x['engine'], x['ext'], STAGES.index(x['stage']))),
+        'submitted': _get_counters(totals, 'conversion_submitted_total'),
+        'failures': _get_counters(totals, 'conversion_failures_total'),
+        'retries': _get_counters(totals, 'conversion_retries_total'),
+        'cloudconvert_results': _get_counters(totals, 'conversion_cloudconvert_results_total'),
+    }
+
+
+def render_prometheus():
+    """Get the metrics to be scraped by Prometheus.
+
+    The samples are grouped by metric, each group preceded by the type
+    and description of the metric, as required by the text format.
+    """
+    samples = defaultdict(list)
+    for key, value in sorted(get_totals().items()):
+        samples[_get_family(key)].append(f'{key} {value}')
+    lines = []
+    for name, (type_, help_) in METRICS.items():
+        if name in samples:
+            lines += [f'# HELP {name} {help_}', f'# TYPE {name} {type_}', *samples[name]]
+    return '\n'.join(lines) + '\n'
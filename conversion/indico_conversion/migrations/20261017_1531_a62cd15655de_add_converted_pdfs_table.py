@@ -0,0 +1,43 @@
+"""Add converted PDFs table
+
+Revision ID: a62cd15655de
+Revises:
+Create Date: 2026-10-17 15:31:08.412667
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.sql.ddl import CreateSchema, DropSchema
+
+from indico.core.db.sqlalchemy import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'a62cd15655de'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateSchema('plugin_conversion'))
+    op.create_table(
+        'converted_pdfs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('md5', sa.String(), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('extension', sa.String(), nullable=False),
+        sa.Column('file_id', sa.Integer(), nullable=False, index=True),
+        sa.Column('created_dt', UTCDateTime, nullable=False),
+        sa.Column('last_used_dt', UTCDateTime, nullable=False, index=True),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['file_id'], ['attachments.files.id']),
+        sa.UniqueConstraint('md5', 'size', 'extension'),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_conversion',
+    )
+
+
+def downgrade():
+    op.drop_table('converted_pdfs', schema='plugin_conversion')
+    op.execute(DropSchema('plugin_conversion'))
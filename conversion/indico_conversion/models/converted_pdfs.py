@@ -0,0 +1,134 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import os
+
+from sqlalchemy.dialects.postgresql import insert
+
+from indico.core.db.sqlalchemy import UTCDateTime, db
+from indico.util.date_time import now_utc
+from indico.util.string import format_repr
+
+
+def _get_extension(file):
+    return os.path.splitext(file.filename)[1].lstrip('.').lower()
+
+
+class ConvertedPDF(db.Model):
+    """Converted PDF files, indexed by the content of the original file."""
+
+    __tablename__ = 'converted_pdfs'
+    __table_args__ = (db.UniqueConstraint('md5', 'size', 'extension'),
+                      {'schema': 'plugin_conversion'})
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+    #: MD5 hash of the original file
+    md5 = db.Column(
+        db.String,
+        nullable=False
+    )
+    #: Size of the original file
+    size = db.Column(
+        db.BigInteger,
+        nullable=False
+    )
+    #: Extension of the original file, since it determines how the file is converted
+    extension = db.Column(
+        db.String,
+        nullable=False
+    )
+    #: ID of the attachment file containing the converted PDF
+    file_id = db.Column(
+        db.ForeignKey('attachments.files.id'),
+        index=True,
+        nullable=False
+    )
+    #: When the file was converted
+    created_dt = db.Column(
+        UTCDateTime,
+        nullable=False,
+        default=now_utc
+    )
+    #: When the converted file was last used, either when converting or copying it
+    last_used_dt = db.Column(
+        UTCDateTime,
+        index=True,
+        nullable=False,
+        default=now_utc
+    )
+    #: How often the converted file has been copied instead of converting the original file again
+    hits = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    #: The attachment file containing the converted PDF
+    file = db.relationship(
+        'AttachmentFile',
+        lazy=False
+    )
+
+    def __repr__(self):
+        return format_repr(self, 'id', 'md5', 'size', 'extension', 'file_id', hits=0)
+
+    @classmethod
+    def find(cls, file, retention):
+        """Find a converted PDF for a file with the same content.
+
+        :param file: The `AttachmentFile` which should be converted.
+        :param retention: The time after which unused entries expire.
+        """
+        return cls.query.filter(cls.md5 == file.md5,
+                                cls.size == file.size,
+                                cls.extension == _get_extension(file),
+                                cls.last_used_dt > now_utc() - retention).first()
+
+    @classmethod
+    def create(cls, file, pdf_file):
+        """Store the converted PDF for a file.
+
+        If there is already an entry for the same content (e.g. when the
+        same file was converted concurrently or the entry expired but was
+        not deleted yet), it is updated to use the new PDF.
+
+        :param file: The original `AttachmentFile`.
+        :param pdf_file: The `AttachmentFile` containing the converted PDF.
+        """
+        stmt = (insert(cls.__table__)
+                .values(md5=file.md5, size=file.size, extension=_get_extension(file), file_id=pdf_file.id,
+                        created_dt=now_utc(), last_used_dt=now_utc(), hits=0)
+                .on_conflict_do_update(index_elements=[cls.md5, cls.size, cls.extension],
+                                       set_={'file_id': pdf_file.id, 'last_used_dt': now_utc()}))
+        db.session.execute(stmt)
+
+    def use(self):
+        """Record that the converted PDF has been copied."""
+        self.hits += 1
+        self.last_used_dt = now_utc()
+
+    @classmethod
+    def delete_expired(cls, retention):
+        """Delete all entries which have not been used for the retention period.
+
+        The converted files themselves are not deleted since they still
+        belong to their attachments.
+
+        :return: The number of deleted entries.
+        """
+        return cls.query.filter(cls.last_used_dt <= now_utc() - retention).delete(synchronize_session=False)
+
+    @classmethod
+    def get_stats(cls):
+        """Get the number of entries and how often they have been used.
+
+        :return: A ``(entries, hits)`` tuple.
+        """
+        return db.session.query(db.func.count(cls.id), db.func.coalesce(db.func.sum(cls.hits), 0)).one()
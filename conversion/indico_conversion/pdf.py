@@ -0,0 +1,174 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import re
+import shutil
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import IO
+from urllib.parse import parse_qs, urlsplit
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, TextStringObject
+
+from indico_conversion.util import CHUNK_SIZE, MAX_MEMORY_SIZE
+
+
+GOOGLE_REDIRECT_PREFIX = 'https://www.google.com/url?q='
+
+
+def _serialize(obj):
+    buf = BytesIO()
+    obj.write_to_stream(buf)
+    return buf.getvalue()
+
+
+def _get_startxref(pdf):
+    pdf.seek(0, 2)
+    size = pdf.tell()
+    pdf.seek(max(0, size - 1024))
+    tail = pdf.read()
+    # there may be some garbage after the end of the file, which readers are supposed to ignore
+    if not (matches := re.findall(rb'startxref\s+(\d+)\s+%%EOF', tail)):
+        raise ValueError('Could not find the cross-reference offset')
+    startxref = int(matches[-1])
+    pdf.seek(startxref)
+    start = pdf.read(32)
+    if start.startswith(b'xref'):
+        return startxref, False
+    elif re.match(rb'\d+\s+\d+\s+obj\b', start):
+        return startxref, True
+    raise ValueError('Invalid cross-reference offset')
+
+
+def _find_google_links(reader):
+    """Replace Google redirect URLs in link annotations.
+
+    The annotations are modified in place, only loading the pages and
+    their annotations without decoding any content streams.
+
+    :return: A dict mapping the ``(idnum, generation)`` of all modified
+             indirect objects to the objects.
+    """
+    modified = {}
+    for page in reader.pages:
+        annots_ref = page.raw_get('/Annots') if '/Annots' in page else None
+        if annots_ref is None:
+            continue
+        for annot_ref in annots_ref.get_object():
+            annot = annot_ref.get_object()
+            if not isinstance(annot, DictionaryObject) or '/A' not in annot:
+                continue
+            link_ref = annot.raw_get('/A')
+            link = link_ref.get_object()
+            if not isinstance(link, DictionaryObject) or '/URI' not in link:
+                continue
+            uri = link['/URI']
+            if not isinstance(uri, str) or not uri.startswith(GOOGLE_REDIRECT_PREFIX):
+                continue
+            link[NameObject('/URI')] = TextStringObject(parse_qs(urlsplit(uri).query)['q'][0])
+            # the changed dictionary is written as part of the closest indirect object containing it
+            for ref, obj in ((link_ref, link), (annot_ref, annot), (annots_ref, annots_ref.get_object())):
+                if isinstance(ref, IndirectObject):
+                    modified[(ref.idnum, ref.generation)] = obj
+                    break
+            else:
+                modified[(page.indirect_reference.idnum, page.indirect_reference.generation)] = page
+    return modified
+
+
+def _write_xref_table(out, offsets, trailer, startxref):
+    # the free list head is not strictly needed in an update, but some readers expect it
+    out.write(b'xref\n0 1\n0000000000 65535 f\r\n')
+    for start, count in _get_blocks(sorted(offsets)):
+        out.write(f'{start} {count}\n'.encode())
+        for idnum in range(start, start + count):
+            offset, generation = offsets[idnum]
+            out.write(f'{offset:010} {generation:05} n\r\n'.encode())
+    trailer[NameObject('/Prev')] = NumberObject(startxref)
+    out.write(b'trailer\n' + _serialize(trailer) + b'\n')
+
+
+def _write_xref_stream(out, offsets, trailer, startxref):
+    xref_id = trailer['/Size']
+    position = out.tell()
+    offsets[xref_id] = (position, 0)
+    ids = sorted(offsets)
+    data = b''.join(b'\x01' + offsets[idnum][0].to_bytes(8, 'big') + offsets[idnum][1].to_bytes(2, 'big')
+                    for idnum in ids)
+    trailer.update({
+        NameObject('/Type'): NameObject('/XRef'),
+        NameObject('/Size'): NumberObject(xref_id + 1),
+        NameObject('/W'): ArrayObject([NumberObject(1), NumberObject(8), NumberObject(2)]),
+        NameObject('/Index'): ArrayObject([NumberObject(x) for block in _get_blocks(ids) for x in block]),
+        NameObject('/Prev'): NumberObject(startxref),
+        NameObject('/Length'): NumberObject(len(data)),
+    })
+    out.write(f'{xref_id} 0 obj\n'.encode() + _serialize(trailer) + b'\nstream\n' + data + b'\nendstream\nendobj\n')
+    return position
+
+
+def _get_blocks(ids):
+    blocks = []
+    for idnum in ids:
+        if blocks and blocks[-1][0] + blocks[-1][1] == idnum:
+            blocks[-1][1] += 1
+        else:
+            blocks.append([idnum, 1])
+    return blocks
+
+
+def _rewrite_pdf(reader):
+    out = SpooledTemporaryFile(max_size=MAX_MEMORY_SIZE)  # noqa: SIM115
+    writer = PdfWriter(clone_from=reader)
+    writer.write(out)
+    out.seek(0)
+    return out
+
+
+def strip_google_tracking(pdf: IO[bytes]) -> IO[bytes]:
+    """Replace Google redirect URLs in a PDF file with the actual URLs.
+
+    Only the annotations containing such links are rewritten, which are
+    appended to an unmodified copy of the original file as an incremental
+    update.  This avoids loading or re-encoding the whole document.  Files
+    whose cross-reference data cannot be located without parsing the whole
+    file are written again from scratch instead.
+
+    :return: A new temporary file containing the updated PDF file.
+    """
+    reader = PdfReader(pdf)
+    # we cannot add unencrypted objects to an encrypted file, but google never sends those anyway
+    modified = _find_google_links(reader) if not reader.is_encrypted else {}
+    if modified:
+        try:
+            startxref, uses_xref_stream = _get_startxref(pdf)
+        except ValueError:
+            return _rewrite_pdf(reader)
+    out = SpooledTemporaryFile(max_size=MAX_MEMORY_SIZE)  # noqa: SIM115
+    pdf.seek(0)
+    shutil.copyfileobj(pdf, out, CHUNK_SIZE)
+    if not modified:
+        out.seek(0)
+        return out
+    out.write(b'\n')
+    offsets = {}
+    for (idnum, generation), obj in sorted(modified.items()):
+        offsets[idnum] = (out.tell(), generation)
+        out.write(f'{idnum} {generation} obj\n'.encode() + _serialize(obj) + b'\nendobj\n')
+    # only keep the trailer entries which are not specific to the original cross-reference section
+    trailer = DictionaryObject({NameObject(key): reader.trailer.raw_get(key)
+                                for key in ('/Size', '/Root', '/Info', '/ID')
+                                if key in reader.trailer})
+    if uses_xref_stream:
+        xref_position = _write_xref_stream(out, offsets, trailer, startxref)
+    else:
+        xref_position = out.tell()
+        _write_xref_table(out, offsets, trailer, startxref)
+    out.write(f'startxref\n{xref_position}\n%%EOF\n'.encode())
+    out.seek(0)
+    return out
@@ -12,26 +12,27 @@ from urllib.parse import urlparse
 from flask import flash, g
 from flask_pluginengine import render_plugin_template, uses
 from markupsafe import Markup
-from wtforms.fields import BooleanField, EmailField, IntegerField, TextAreaField, URLField
+from wtforms.fields import BooleanField, EmailField, IntegerField, StringField, TextAreaField, URLField
 from wtforms.validators import DataRequired, NumberRange, Optional
 
 from indico.core import signals
 from indico.core.plugins import IndicoPlugin, plugin_engine, url_for_plugin
+from indico.core.settings.converters import TimedeltaConverter
 from indico.modules.attachments.forms import AddAttachmentFilesForm, AddAttachmentLinkForm
 from indico.modules.attachments.models.attachments import AttachmentType
 from indico.modules.events.views import WPSimpleEventDisplay
 from indico.util.date_time import now_utc
 from indico.util.string import render_markdown
 from indico.web.forms.base import IndicoForm
-from indico.web.forms.fields import IndicoPasswordField, TextListField
+from indico.web.forms.fields import IndicoPasswordField, TextListField, TimeDeltaField
 from indico.web.forms.validators import HiddenUnless
 from indico.web.forms.widgets import SwitchWidget
+from indico.web.menu import SideMenuItem
 
 from indico_conversion import _, pdf_state_cache
 from indico_conversion.blueprint import blueprint
-from indico_conversion.conversion import (request_pdf_from_googledrive, submit_attachment_cloudconvert,
-                                          submit_attachment_doconverter)
-from indico_conversion.util import get_pdf_title
+from indico_conversion.conversion import request_pdf_from_googledrive, submit_attachment
+from indico_conversion.util import get_event_pdf_states, get_pdf_title
 
 
 info_ttl = timedelta(hours=1)
@@ -42,7 +43,24 @@ class SettingsForm(IndicoForm):
                                description=_('Temporarily disable submitting files. The tasks will be kept and once '
                                              'this setting is disabled the files will be submitted.'))
     use_cloudconvert = BooleanField(_('Use CloudConvert'), widget=SwitchWidget(),
-                                    description=_('Use Cloudconvert instead of Doconverter for PDF conversion.'))
+                                    description=_('Use CloudConvert for PDF conversion. Doconverter is only used for '
+                                                  'files which cannot be submitted to CloudConvert.'))
+    use_local = BooleanField(_('Convert locally'), widget=SwitchWidget(),
+                             description=_('Convert files using LibreOffice on the Celery workers. Doconverter or '
+                                           'CloudConvert are only used for files which cannot be converted locally.'))
+    local_office_path = StringField(_('LibreOffice executable'),
+                                    [DataRequired(), HiddenUnless('use_local', preserve_data=True)],
+                                    description=_('The name or path of the LibreOffice executable on the Celery '
+                                                  'workers.'))
+    local_max_jobs = IntegerField(_('Local concurrent jobs'),
+                                  [DataRequired(), NumberRange(min=1), HiddenUnless('use_local', preserve_data=True)],
+                                  description=_('The maximum number of files being converted at the same time on '
+                                                'each Celery worker machine.'))
+    local_timeout = TimeDeltaField(_('Local conversion timeout'),
+                                   [DataRequired(), HiddenUnless('use_local', preserve_data=True)],
+                                   units=('seconds', 'minutes'),
+                                   description=_('Local conversions taking longer than this are aborted, and the '
+                                                 'file is converted remotely instead.'))
     server_url = URLField(_('Doconverter server URL'), [DataRequired()],
                           description=_("The URL to the conversion server's uploadFile.py script."))
     cloudconvert_api_key = IndicoPasswordField(_('CloudConvert API key'),
@@ -52,6 +70,12 @@ class SettingsForm(IndicoForm):
                                         [HiddenUnless('use_cloudconvert', preserve_data=True)],
                                         widget=SwitchWidget(),
                                         description=_('Use CloudConvert sandbox.'))
+    cloudconvert_max_jobs = IntegerField(_('Concurrent jobs'),
+                                         [DataRequired(), NumberRange(min=1),
+                                          HiddenUnless('use_cloudconvert', preserve_data=True)],
+                                         description=_('The maximum number of files being converted by CloudConvert '
+                                                       'at the same time. Any other files are queued and submitted '
+                                                       'once a conversion finished, smaller files first.'))
     cloudconvert_notify_threshold = IntegerField(_('CloudConvert credit threshold'),
                                                  [Optional(), NumberRange(min=0), HiddenUnless('use_cloudconvert',
                                                                                                preserve_data=True)],
@@ -68,8 +92,16 @@ class SettingsForm(IndicoForm):
                                      filters=[lambda exts: sorted({ext.lower().lstrip('.').strip() for ext in exts})],
                                      description=_('File extensions for which PDF conversion is supported. '
                                                    'One extension per line.'))
+    converted_pdf_retention = TimeDeltaField(_('Reuse converted PDFs'), [DataRequired()], units=('days',),
+                                             description=_('When a file with the same content as a previously '
+                                                           'converted one is uploaded, the existing PDF is copied '
+                                                           'instead of converting the file again. PDFs which have '
+                                                           'not been used for this time are no longer reused.'))
     googledrive_api_key = IndicoPasswordField(_('GoogleDrive API key'), toggle=True,
                                               description=_('API key used for converting files on Google Docs.'))
+    metrics_token = IndicoPasswordField(_('Metrics token'), toggle=True,
+                                        description=_('Bearer token Prometheus uses to scrape the conversion metrics. '
+                                                      'Leave empty to disable the metrics endpoint.'))
 
 
 @uses('owncloud')
@@ -82,15 +114,26 @@ class ConversionPlugin(IndicoPlugin):
     configurable = True
     settings_form = SettingsForm
     default_settings = {'use_cloudconvert': False,
+                        'use_local': False,
+                        'local_office_path': 'soffice',
+                        'local_max_jobs': 2,
+                        'local_timeout': timedelta(minutes=2),
                         'maintenance': False,
                         'server_url': '',
                         'cloudconvert_api_key': '',
                         'googledrive_api_key': '',
                         'cloudconvert_sandbox': False,
+                        'cloudconvert_max_jobs': 10,
                         'cloudconvert_notify_threshold': None,
                         'cloudconvert_notify_email': '',
                         'cloudconvert_conversion_notice': '',
+                        'converted_pdf_retention': timedelta(days=30),
+                        'metrics_token': None,
                         'valid_extensions': ['ppt', 'doc', 'pptx', 'docx', 'odp', 'sxi']}
+    settings_converters = {
+        'local_timeout': TimedeltaConverter,
+        'converted_pdf_retention': TimedeltaConverter,
+    }
 
     def init(self):
         super().init()
@@ -102,6 +145,7 @@ class ConversionPlugin(IndicoPlugin):
         self.connect(signals.core.form_validated, self._form_validated)
         self.connect(signals.attachments.attachment_created, self._attachment_created)
         self.connect(signals.core.after_commit, self._after_commit)
+        self.connect(signals.menu.items, self._extend_admin_menu, sender='admin-sidemenu')
         self.template_hook('event-display-after-attachment', self._event_display_after_attachment)
         self.inject_bundle('main.css', WPSimpleEventDisplay)
         self.inject_bundle('main.js', WPSimpleEventDisplay)
@@ -109,6 +153,10 @@ class ConversionPlugin(IndicoPlugin):
     def get_blueprints(self):
         return blueprint
 
+    def _extend_admin_menu(self, sender, **kwargs):
+        return SideMenuItem('conversion_metrics', _('PDF conversion'), url_for_plugin('conversion.metrics_admin'),
+                            section='integration')
+
     def get_vars_js(self):
         return {'urls': {'check': url_for_plugin('conversion.check')}}
 
@@ -172,6 +220,9 @@ class ConversionPlugin(IndicoPlugin):
         g.convert_attachments.add(attachment)
         # Set cache entry to show the pending attachment
         pdf_state_cache.set(str(attachment.id), 'pending', timeout=info_ttl)
+        if event := attachment.folder.event:
+            # lets the event pages skip looking up the state of each attachment when nothing is being converted
+            pdf_state_cache.set(f'event-{event.id}', True, timeout=info_ttl)
         if not g.get('attachment_conversion_msg_displayed'):
             g.attachment_conversion_msg_displayed = True
             if attachment.type == AttachmentType.file:
@@ -182,19 +233,17 @@ class ConversionPlugin(IndicoPlugin):
                         'automatically once the conversion is finished.'))
 
     def _after_commit(self, sender, **kwargs):
+        # looking for an existing PDF of the same file needs the database, so it happens in the task
         for attachment in g.get('convert_attachments', ()):
             if attachment.type == AttachmentType.file:
-                if self.settings.get('use_cloudconvert'):
-                    submit_attachment_cloudconvert.delay(attachment)
-                else:
-                    submit_attachment_doconverter.delay(attachment)
+                submit_attachment.delay(attachment)
             elif attachment.type == AttachmentType.link:
                 request_pdf_from_googledrive.delay(attachment)
 
     def _event_display_after_attachment(self, attachment, top_level, has_label, **kwargs):
         if attachment.file and (now_utc() - attachment.file.created_dt > info_ttl):
             return None
-        if pdf_state_cache.get(str(attachment.id)) != 'pending':
+        if get_event_pdf_states(attachment.folder.event_id).get(attachment.id) != 'pending':
             return None
         return render_plugin_template('pdf_attachment.html', attachment=attachment, top_level=top_level,
                                       has_label=has_label, title=get_pdf_title(attachment))
@@ -0,0 +1,95 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from indico_conversion import cloudconvert_queue_cache, redis_lock
+
+
+#: How long the queue may be locked by a single process
+LOCK_TIMEOUT = timedelta(seconds=10)
+#: How long a submitted job keeps its slot in case we never hear back from it.
+#: This needs to be longer than all retries of a failed submission together.
+SLOT_TIMEOUT = timedelta(days=2)
+
+
+@contextmanager
+def _locked_state():
+    with redis_lock('cloudconvert-queue', LOCK_TIMEOUT):
+        state = cloudconvert_queue_cache.get('state') or {'queued': {}, 'running': {}}
+        state.setdefault('polling', {})
+        yield state  # noqa: RUF075
+        cloudconvert_queue_cache.set('state', state)
+
+
+def queue_conversion(attachment):
+    """Add an attachment to the files waiting to be submitted to CloudConvert.
+
+    Smaller files and files in earlier events are submitted first.
+    """
+    # category attachments do not have an event
+    event = attachment.folder.event
+    priority = (attachment.file.size, event.start_dt.timestamp() if event else 0, attachment.id)
+    with _locked_state() as state:
+        state['queued'][str(attachment.id)] = priority
+
+
+def take_queued_conversions(max_jobs):
+    """Take the next attachments to submit while fewer than `max_jobs` are running.
+
+    :return: A list of attachment IDs which now have a slot.
+    """
+    now = time.time()
+    with _locked_state() as state:
+        running = state['running']
+        for attachment_id, started in list(running.items()):
+            if now - started > SLOT_TIMEOUT.total_seconds():
+                del running[attachment_id]
+        ids = sorted(state['queued'], key=state['queued'].get)[:max(0, max_jobs - len(running))]
+        for attachment_id in ids:
+            del state['queued'][attachment_id]
+            running[attachment_id] = now
+    return [int(id_) for id_ in ids]
+
+
+def release_slot(attachment_id):
+    """Release the slot of a finished conversion.
+
+    :return: Whether the slot was released and other attachments are
+             waiting for a free slot.
+    """
+    with _locked_state() as state:
+        if state['running'].pop(str(attachment_id), None) is None:
+            return False
+        return bool(state['queued'])
+
+
+def watch_task(attachment_id, export_task_id):
+    """Check the export task of a submitted conversion until it finished."""
+    with _locked_state() as state:
+        state['polling'][export_task_id] = (attachment_id, time.time())
+
+
+def get_watched_tasks():
+    """Get the export tasks which need to be checked.
+
+    :return: A dict mapping export task IDs to ``(attachment_id, submitted)``
+             tuples, where `submitted` is a UNIX timestamp.
+    """
+    with _locked_state() as state:
+        return dict(state['polling'])
+
+
+def unwatch_tasks(export_task_ids):
+    """Stop checking export tasks whose conversion has been handled."""
+    if not export_task_ids:
+        return
+    with _locked_state() as state:
+        for export_task_id in export_task_ids:
+            state['polling'].pop(export_task_id, None)
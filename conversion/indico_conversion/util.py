@@ -7,12 +7,25 @@
 
 import os
 from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+
+from flask import g
 
 from indico.core import signals
 from indico.core.db import db
 from indico.modules.attachments.models.attachments import Attachment, AttachmentFile, AttachmentType
+from indico.modules.attachments.models.folders import AttachmentFolder
+from indico.util.date_time import now_utc
 
 from indico_conversion import pdf_state_cache
+from indico_conversion.metrics import track_stage
+from indico_conversion.models.converted_pdfs import ConvertedPDF
+
+
+#: The size of the chunks in which converted files are downloaded
+CHUNK_SIZE = 1024 * 1024
+#: Files larger than this are buffered on disk instead of in memory
+MAX_MEMORY_SIZE = 4 * 1024 * 1024
 
 
 def get_pdf_title(attachment):
@@ -26,7 +39,58 @@ def get_pdf_title(attachment):
         return attachment.title
 
 
-def save_pdf(attachment, pdf):
+def get_event_pdf_states(event_id):
+    """Get the conversion states of all recent attachments in an event.
+
+    The states are loaded at most once per request and event, using a
+    single cache lookup for all attachments.  Events in which nothing has
+    been converted recently are skipped without loading any attachments.
+
+    :return: A dict mapping attachment IDs to their conversion state.
+    """
+    from indico_conversion.plugin import info_ttl
+    loaded = g.setdefault('event_pdf_states', {})
+    if event_id in loaded:
+        return loaded[event_id]
+    states = loaded[event_id] = {}
+    if not pdf_state_cache.get(f'event-{event_id}'):
+        return states
+    # the state of a conversion expires after `info_ttl` anyway, so we only need to check recent attachments
+    ids = [id_ for id_, in (db.session.query(Attachment.id)
+                            .join(AttachmentFolder)
+                            .filter(AttachmentFolder.event_id == event_id,
+                                    ~Attachment.is_deleted,
+                                    Attachment.modified_dt > now_utc() - info_ttl))]
+    if ids:
+        states.update(zip(ids, pdf_state_cache.get_many(*map(str, ids)), strict=True))
+    return states
+
+
+def buffer_response(response):
+    """Copy the body of a streamed response to a temporary file.
+
+    The body is read in chunks, and only small files are kept in memory.
+    The returned file is positioned at the beginning.
+    """
+    buf = SpooledTemporaryFile(max_size=MAX_MEMORY_SIZE)  # noqa: SIM115
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            buf.write(chunk)
+    except BaseException:
+        buf.close()
+        raise
+    buf.seek(0)
+    return buf
+
+
+def save_pdf(attachment, pdf, *, index=True):
+    """Attach a converted PDF file.
+
+    :param pdf: The content of the PDF file, either as bytes or as a
+                file-like object which is stored in chunks.
+    :param index: Whether to add the PDF to the index of converted files
+                  so it can be reused for files with the same content.
+    """
     from indico_conversion.plugin import ConversionPlugin
     if attachment.type == AttachmentType.file:
         name = os.path.splitext(attachment.file.filename)[0]
@@ -45,6 +109,9 @@ def save_pdf(attachment, pdf):
     pdf_attachment.file.save(pdf)
     db.session.add(pdf_attachment)
     db.session.flush()
+    if index and attachment.type == AttachmentType.file:
+        ConvertedPDF.create(attachment.file, pdf_attachment.file)
+    track_stage(attachment.id, 'saved')
     pdf_state_cache.set(str(attachment.id), 'finished', timeout=timedelta(minutes=15))
     ConversionPlugin.logger.info('Added PDF attachment %s for %s', pdf_attachment, attachment)
     signals.attachments.attachment_created.send(pdf_attachment, user=None)
@@ -0,0 +1,63 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+import requests
+from celery.exceptions import MaxRetriesExceededError
+
+from indico_conversion import redis_lock
+from indico_conversion.conversion import MAX_TRIES, poll_cloudconvert_tasks, retry_task
+from indico_conversion.engines import CloudConvertEngine, DoconverterEngine, LocalEngine, get_engines
+from indico_conversion.plugin import ConversionPlugin
+
+
+@pytest.mark.usefixtures('app')
+def test_poll_cloudconvert_tasks(mocker):
+    mocker.patch('indico_conversion.conversion.get_watched_tasks', return_value={'task': (1, 0)})
+    poll = mocker.patch('indico_conversion.conversion._poll_cloudconvert_tasks')
+    with redis_lock('cloudconvert-poll', timedelta(minutes=1)):
+        poll_cloudconvert_tasks()
+    assert not poll.called
+    poll_cloudconvert_tasks()
+    poll.assert_called_once_with({'task': (1, 0)})
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize(('use_local', 'use_cloudconvert', 'expected'), (
+    (False, False, [DoconverterEngine]),
+    (False, True, [CloudConvertEngine, DoconverterEngine]),
+    (True, True, [LocalEngine, CloudConvertEngine, DoconverterEngine]),
+))
+def test_get_engines(use_local, use_cloudconvert, expected):
+    ConversionPlugin.settings.set_multi({'use_local': use_local, 'use_cloudconvert': use_cloudconvert,
+                                         'server_url': 'https://doconverter.example.test/uploadFile.py'})
+    assert get_engines() == expected
+
+
+@pytest.mark.usefixtures('app')
+@pytest.mark.parametrize(('engine', 'next_after'), (
+    ('cloudconvert', CloudConvertEngine),
+    ('doconverter', DoconverterEngine),
+    ('googledrive', None),
+))
+def test_retry_task_gives_up(mocker, engine, next_after):
+    submit_attachments = mocker.patch('indico_conversion.engines.submit_attachments')
+    track_failure = mocker.patch('indico_conversion.conversion.track_failure')
+    task = mocker.Mock(request=SimpleNamespace(retries=MAX_TRIES - 1))
+    task.retry.side_effect = MaxRetriesExceededError
+    attachment = SimpleNamespace(id=1)
+    retry_task(task, attachment, requests.RequestException('Server unavailable'), engine)
+    if next_after is None:
+        assert not submit_attachments.called
+        track_failure.assert_called_once_with(1, engine, 'gave_up')
+    else:
+        # the file is passed on to the next engine, which gives up itself if there is none
+        submit_attachments.assert_called_once_with([attachment], after=next_after)
+        track_failure.assert_called_once_with(1, engine, 'gave_up', final=False)
@@ -0,0 +1,44 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import pytest
+
+from indico_conversion import get_redis_client
+from indico_conversion.metrics import (TOTALS_KEY, estimate_quantile, get_summary, get_totals, get_value, inc,
+                                       observe, render_prometheus)
+
+
+@pytest.fixture(autouse=True)
+def _clear_metrics(app):
+    get_redis_client().delete(TOTALS_KEY)
+
+
+def test_counters():
+    inc('conversion_retries_total', engine='cloudconvert')
+    inc('conversion_retries_total', engine='cloudconvert')
+    inc('conversion_retries_total', engine='local')
+    assert get_value(get_totals(), 'conversion_retries_total', engine='cloudconvert') == 2
+    assert render_prometheus() == (
+        '# HELP conversion_retries_total Number of retried submissions by engine\n'
+        '# TYPE conversion_retries_total counter\n'
+        'conversion_retries_total{engine="cloudconvert"} 2\n'
+        'conversion_retries_total{engine="local"} 1\n'
+    )
+
+
+def test_histogram():
+    for value in (0.5, 3, 3, 4000):
+        observe('conversion_duration_seconds', value, engine='local', ext='docx')
+    totals = get_totals()
+    assert get_value(totals, 'conversion_duration_seconds_bucket', engine='local', ext='docx', le='2.5') == 1
+    assert get_value(totals, 'conversion_duration_seconds_bucket', engine='local', ext='docx', le='+Inf') == 4
+    assert estimate_quantile(totals, 'conversion_duration_seconds', 0.5, engine='local', ext='docx') == 5
+    assert estimate_quantile(totals, 'conversion_duration_seconds', 0.95, engine='local', ext='docx') == 7200
+    assert estimate_quantile(totals, 'conversion_duration_seconds', 0.5, engine='cloudconvert', ext='docx') is None
+    assert get_summary()['durations'] == [
+        {'engine': 'local', 'ext': 'docx', 'count': 4, 'mean': 1001.625, 'p50': 5, 'p95': 7200}
+    ]
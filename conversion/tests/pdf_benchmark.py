@@ -0,0 +1,140 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+"""Compare stripping Google tracking links with re-writing the whole PDF.
+
+Run ``python tests/pdf_benchmark.py [PAGES] [PDF...]`` in an environment in
+which the plugin is installed.  Unless specific PDF files are given, one
+file with an image on each page and one with text on each page are
+generated, both containing three Google redirect links and one regular
+link per page.  Each implementation runs in a separate process to measure
+its peak memory usage.
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import parse_qs, urlsplit
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import Link
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject, TextStringObject
+
+
+def _make_page_content(writer, page, i, *, image):
+    resources = DictionaryObject()
+    if image:
+        img = DecodedStreamObject()
+        img.set_data(os.urandom(320 * 320 * 3))
+        img.update({NameObject('/Type'): NameObject('/XObject'), NameObject('/Subtype'): NameObject('/Image'),
+                    NameObject('/Width'): NumberObject(320), NameObject('/Height'): NumberObject(320),
+                    NameObject('/ColorSpace'): NameObject('/DeviceRGB'),
+                    NameObject('/BitsPerComponent'): NumberObject(8)})
+        resources[NameObject('/XObject')] = DictionaryObject({NameObject('/Im0'): writer._add_object(img)})
+        data = b'q 400 0 0 400 100 300 cm /Im0 Do Q'
+    else:
+        font = DictionaryObject({NameObject('/Type'): NameObject('/Font'), NameObject('/Subtype'): NameObject('/Type1'),
+                                 NameObject('/BaseFont'): NameObject('/Helvetica')})
+        resources[NameObject('/Font')] = DictionaryObject({NameObject('/F1'): writer._add_object(font)})
+        lines = [f'Page {i} line {j} ' + 'lorem ipsum dolor sit amet ' * 3 for j in range(60)]
+        data = b'BT /F1 9 Tf 40 760 Td 11 TL ' + b' '.join(f"({line}) '".encode() for line in lines) + b' ET'
+    contents = DecodedStreamObject()
+    contents.set_data(data)
+    page[NameObject('/Resources')] = resources
+    page[NameObject('/Contents')] = writer._add_object(contents)
+
+
+def make_pdf(path, pages, *, image):
+    writer = PdfWriter()
+    for i in range(pages):
+        page = writer.add_blank_page(612, 792)
+        _make_page_content(writer, page, i, image=image)
+        for k in range(3):
+            writer.add_annotation(i, Link(rect=(100, 100 + 20 * k, 200, 115 + 20 * k),
+                                          url=f'https://www.google.com/url?q=https://example.com/{i}/{k}&sa=D'))
+        writer.add_annotation(i, Link(rect=(300, 300, 400, 315), url='https://indico.cern.ch'))
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+def strip_google_tracking_rewrite(pdf):
+    """Strip the tracking links by writing all pages into a new PDF (the previous implementation)."""
+    reader = PdfReader(pdf)
+    writer = PdfWriter()
+    for page in reader.pages:
+        for annot in (page.annotations or ()):
+            obj = annot.get_object()
+            if (
+                (link := obj.get('/A'))
+                and (uri := link.get('/URI'))
+                and uri.startswith('https://www.google.com/url?q=')
+            ):
+                q = parse_qs(urlsplit(uri).query)['q'][0]
+                link[NameObject('/URI')] = TextStringObject(q)
+        writer.add_page(page)
+    buf = BytesIO()
+    writer.write(buf)
+    buf.seek(0)
+    return buf.getvalue()
+
+
+def _run(impl, path, output):
+    start = time.perf_counter()
+    if impl == 'rewrite':
+        data = strip_google_tracking_rewrite(BytesIO(Path(path).read_bytes()))
+        Path(output).write_bytes(data)
+    else:
+        from indico_conversion.pdf import strip_google_tracking
+        with open(path, 'rb') as f, strip_google_tracking(f) as stripped, open(output, 'wb') as dst:
+            shutil.copyfileobj(stripped, dst)
+    duration = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'duration': duration, 'rss': rss, 'google_links': _count_google_links(output)}))
+
+
+def _count_google_links(path):
+    reader = PdfReader(path)
+    return sum(annot.get_object()['/A']['/URI'].startswith('https://www.google.com/url?q=')
+               for page in reader.pages
+               for annot in page.get('/Annots', []))
+
+
+def main(pages, paths):
+    with TemporaryDirectory() as tmpdir:
+        if not paths:
+            paths = [os.path.join(tmpdir, 'images.pdf'), os.path.join(tmpdir, 'text.pdf')]
+            # the peak memory usage of a process is inherited by its children, so nothing which needs a
+            # lot of memory may run in the main process
+            for path, image in zip(paths, (True, False), strict=True):
+                subprocess.run([sys.executable, __file__, '--make', path, str(pages), str(int(image))], check=True)
+        for path in paths:
+            print(f'{os.path.basename(path)}: {os.path.getsize(path) / 1024 / 1024:.1f} MB')
+            for impl in ('rewrite', 'incremental'):
+                output = os.path.join(tmpdir, f'output-{impl}.pdf')
+                res = subprocess.run([sys.executable, __file__, '--run', impl, path, output],
+                                     check=True, capture_output=True, text=True)
+                result = json.loads(res.stdout.splitlines()[-1])
+                print(f'  {impl:<12} {result["duration"]:6.2f}s  peak RSS {result["rss"]:6.1f} MB  '
+                      f'output {os.path.getsize(output) / 1024 / 1024:.1f} MB  '
+                      f'Google links left {result["google_links"]}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        _run(*sys.argv[2:5])
+    elif sys.argv[1:2] == ['--make']:
+        make_pdf(sys.argv[2], int(sys.argv[3]), image=bool(int(sys.argv[4])))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, sys.argv[2:])
@@ -0,0 +1,62 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from io import BytesIO
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import Link
+
+from indico_conversion.pdf import strip_google_tracking
+
+
+def _make_pdf(*urls):
+    writer = PdfWriter()
+    writer.add_blank_page(width=200, height=200)
+    for i, url in enumerate(urls):
+        writer.add_annotation(0, Link(rect=(10, 10 + i * 20, 100, 20 + i * 20), url=url))
+    buf = BytesIO()
+    writer.write(buf)
+    buf.seek(0)
+    return buf
+
+
+def _get_urls(pdf):
+    page = PdfReader(pdf).pages[0]
+    return [annot.get_object()['/A']['/URI'] for annot in page.get('/Annots', [])]
+
+
+@pytest.mark.parametrize(('urls', 'expected'), (
+    ([], []),
+    (['https://indico.cern.ch/'], ['https://indico.cern.ch/']),
+    (['https://www.google.com/url?q=https://indico.cern.ch/event/1/%3Fa%3Db&sa=D&ust=123', 'https://home.cern/'],
+     ['https://indico.cern.ch/event/1/?a=b', 'https://home.cern/']),
+))
+def test_strip_google_tracking(urls, expected):
+    pdf = _make_pdf(*urls)
+    original = pdf.getvalue()
+    with strip_google_tracking(pdf) as stripped:
+        data = stripped.read()
+    assert _get_urls(BytesIO(data)) == expected
+    # the original file is kept as-is and only updated incrementally
+    assert data.startswith(original)
+    assert (data == original) == (urls == expected)
+
+
+@pytest.mark.parametrize(('trailer', 'incremental'), (
+    # some garbage after the end of the file is common and ignored by readers
+    (b'\r\n\x00\x00garbage\n', True),
+    # if there is too much of it we cannot find the cross-reference data without parsing the whole file
+    (b'\x00' * 2000, False),
+))
+def test_strip_google_tracking_trailing_data(trailer, incremental):
+    pdf = _make_pdf('https://www.google.com/url?q=https://indico.cern.ch/&sa=D', 'https://home.cern/')
+    original = pdf.getvalue() + trailer
+    with strip_google_tracking(BytesIO(original)) as stripped:
+        data = stripped.read()
+    assert _get_urls(BytesIO(data)) == ['https://indico.cern.ch/', 'https://home.cern/']
+    assert data.startswith(original) == incremental
@@ -0,0 +1,50 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from indico_conversion import cloudconvert_queue_cache, redis_lock
+from indico_conversion.conversion import DELAYS, MAX_TRIES
+from indico_conversion.scheduler import SLOT_TIMEOUT, queue_conversion, release_slot, take_queued_conversions
+
+
+@pytest.fixture(autouse=True)
+def _clear_queue(app):
+    cloudconvert_queue_cache.delete('state')
+
+
+def _make_attachment(id_, size):
+    return SimpleNamespace(id=id_, file=SimpleNamespace(size=size), folder=SimpleNamespace(event=None))
+
+
+def test_redis_lock():
+    with redis_lock('test', timedelta(seconds=10)) as locked:
+        assert locked
+        with redis_lock('test', timedelta(seconds=10), blocking=False) as locked_again:
+            assert not locked_again
+    with redis_lock('test', timedelta(seconds=10), blocking=False) as locked:
+        assert locked
+
+
+def test_take_queued_conversions():
+    for id_, size in ((1, 300), (2, 100), (3, 200)):
+        queue_conversion(_make_attachment(id_, size))
+    # smaller files first
+    assert take_queued_conversions(2) == [2, 3]
+    assert take_queued_conversions(2) == []
+    assert release_slot(2)
+    assert take_queued_conversions(2) == [1]
+    assert not release_slot(3)
+    assert not release_slot(3)
+
+
+def test_slot_timeout_outlives_retries():
+    retry_delays = [DELAYS[min(i, len(DELAYS) - 1)] for i in range(MAX_TRIES)]
+    assert SLOT_TIMEOUT.total_seconds() > sum(retry_delays)
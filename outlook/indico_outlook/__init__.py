@@ -5,16 +5,81 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
+from contextlib import contextmanager, suppress
+from functools import cache
+
 from celery.schedules import crontab
+from redis import Redis
+from redis.exceptions import LockNotOwnedError
 
+from indico.core.cache import make_scoped_cache
 from indico.core.celery import celery
+from indico.core.config import config
 from indico.util.i18n import make_bound_gettext
 
 
 _ = make_bound_gettext('outlook')
+category_task_cache = make_scoped_cache('outlook-category-tasks')
+circuit_breaker_cache = make_scoped_cache('outlook-circuit-breaker')
+
+
+@cache
+def get_redis_client():
+    """Get a client for the redis server used by the Indico cache."""
+    return Redis.from_url(config.REDIS_CACHE_URL)
+
+
+@contextmanager
+def redis_lock(name, timeout, *, wait=None):
+    """Hold a lock shared by all processes using the same redis server.
+
+    :param name: The name of the lock.
+    :param timeout: How long the lock may be held before it expires, in
+                    case the process holding it dies.
+    :param wait: How long to wait for the lock if it is already held, or
+                 `None` to wait until it is released or expires.
+    :return: A context manager yielding whether the lock was acquired.
+    """
+    lock = get_redis_client().lock(f'indico-plugin-outlook:{name}', timeout=timeout.total_seconds())
+    blocking_timeout = wait.total_seconds() if wait is not None else None
+    if not lock.acquire(blocking=(blocking_timeout is None or blocking_timeout > 0),
+                        blocking_timeout=blocking_timeout):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        # the lock may have expired in the meantime, in which case there is nothing to release
+        with suppress(LockNotOwnedError):
+            lock.release()
+
+
+#: When all pending calendar updates are processed
+UPDATE_SCHEDULE = crontab(minute='*/15')
+#: When only changes to events starting soon are processed.  A full run
+#: processes them first anyway, so this never runs at the same time.
+IMMINENT_UPDATE_SCHEDULE = crontab(minute='1-14,16-29,31-44,46-59')
 
 
-@celery.periodic_task(run_every=crontab(minute='*/15'))
+@celery.periodic_task(run_every=UPDATE_SCHEDULE)
 def scheduled_update():
     from indico_outlook.calendar import update_calendar
     update_calendar()
+
+
+@celery.periodic_task(run_every=IMMINENT_UPDATE_SCHEDULE)
+def scheduled_imminent_update():
+    from indico_outlook.calendar import update_calendar
+    update_calendar(imminent_only=True)
+
+
+@celery.task
+def process_favorite_category(entry_id):
+    from indico_outlook.calendar import process_favorite_category_addition
+    process_favorite_category_addition(entry_id)
+
+
+@celery.task
+def record_changes(changes, ids):
+    from indico_outlook.util import record_queue_entries
+    record_queue_entries(changes, ids)
@@ -0,0 +1,14 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from indico.core.plugins import IndicoPluginBlueprint
+
+from indico_outlook.controllers import RHMetrics
+
+
+blueprint = IndicoPluginBlueprint('outlook', __name__)
+blueprint.add_url_rule('/outlook/metrics', 'metrics', RHMetrics)
@@ -5,13 +5,18 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
+import time
 from collections import defaultdict
-from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import batched, islice
 from pprint import pformat
 
-import requests
 from markupsafe import Markup
 from requests.exceptions import RequestException, Timeout
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import joinedload, subqueryload
 from werkzeug.datastructures import MultiDict
 
@@ -19,18 +24,37 @@ from indico.core import signals
 from indico.core.db import db
 from indico.modules.events import Event
 from indico.modules.events.forms import EventLabel
+from indico.modules.users import User
 from indico.util.date_time import now_utc
 from indico.util.signals import values_from_signal
 from indico.util.string import strip_control_chars
 
+from indico_outlook import category_task_cache, process_favorite_category, redis_lock
+from indico_outlook.client import CircuitBreaker, CircuitOpen, OutlookClient
+from indico_outlook.metrics import metrics
 from indico_outlook.models.entry import OutlookCalendarEntry
 from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
-from indico_outlook.util import (check_config, get_users_to_add, is_event_excluded, is_user_cat_favorite,
-                                 is_user_favorite, is_user_registered)
+from indico_outlook.preferences import OutlookPreferences
+from indico_outlook.util import (can_skip_access_check, check_config, get_calendar_entries, get_calendar_reasons,
+                                 get_calendar_users, get_existing_calendar_entries, is_event_excluded)
 
 
-def update_calendar():
-    """Executes all pending calendar updates"""
+#: Number of calendar entry changes written to the database at once
+DB_BATCH_SIZE = 100
+#: How long a scheduled favorite category task is considered to be running
+CATEGORY_TASK_TIMEOUT = timedelta(hours=1)
+#: How long a run processing only changes to events starting soon may take
+IMMINENT_RUN_TIME = timedelta(minutes=1)
+
+
+def update_calendar(*, imminent_only=False):
+    """Executes all pending calendar updates
+
+    Changes to events starting soon are always processed first.
+
+    :param imminent_only: Whether to only process changes to events starting
+                          soon, which is done more frequently than a full run.
+    """
     from indico_outlook.plugin import OutlookPlugin
 
     if not check_config():
@@ -39,8 +63,56 @@ def update_calendar():
 
     settings = OutlookPlugin.settings.get_all()
     logger = OutlookPlugin.logger
-    ignore = _process_favorite_categories(settings, logger)
-    _process_events(ignore, settings, logger)
+    breaker = CircuitBreaker(settings, logger)
+    if breaker.is_open:
+        if not imminent_only:
+            logger.warning('Calendar service is unavailable, skipping run')
+        return
+    # runs must not overlap since they would process (and send) the same queue entries. imminent-only
+    # runs are not scheduled when a full run starts, but one which started earlier may still be running,
+    # so a full run waits for it to finish instead of being skipped
+    wait = timedelta(0) if imminent_only else IMMINENT_RUN_TIME
+    with redis_lock('update', settings['max_run_time'] * 2, wait=wait) as locked:
+        if not locked:
+            logger.info('Calendar update is already running, skipping run')
+            return
+        if imminent_only:
+            _update_imminent_events(settings, logger, breaker)
+        else:
+            _update_all_events(settings, logger, breaker)
+
+
+def _update_imminent_events(settings, logger, breaker):
+    deadline = now_utc() + min(settings['max_run_time'], IMMINENT_RUN_TIME)
+    try:
+        with metrics.timer('outlook_phase_duration_seconds', phase='imminent_events'):
+            _process_events(set(), settings, logger, breaker, deadline, imminent=True)
+    finally:
+        metrics.flush()
+
+
+def _update_all_events(settings, logger, breaker):
+    deadline = now_utc() + settings['max_run_time']
+    start = time.monotonic()
+    try:
+        with metrics.timer('outlook_phase_duration_seconds', phase='favorite_categories'):
+            ignore = _process_favorite_categories(settings, logger, breaker)
+        if breaker.is_open:
+            logger.warning('Calendar service is unavailable, aborting run')
+            return
+        with metrics.timer('outlook_phase_duration_seconds', phase='imminent_events'):
+            _process_events(ignore, settings, logger, breaker, deadline, imminent=True)
+        if breaker.is_open:
+            return
+        with metrics.timer('outlook_phase_duration_seconds', phase='events'):
+            _process_events(ignore, settings, logger, breaker, deadline)
+    finally:
+        duration = time.monotonic() - start
+        metrics.inc('outlook_runs_total')
+        metrics.observe('outlook_run_duration_seconds', duration)
+        metrics.set('outlook_last_run_duration_seconds', duration)
+        metrics.set('outlook_last_run_timestamp_seconds', time.time())
+        metrics.flush()
 
 
 def _delete_queue_entries(ids):
@@ -50,15 +122,42 @@ def _delete_queue_entries(ids):
     db.session.commit()
 
 
-def _process_favorite_categories(settings, logger):
+def _record_failed_queue_entries(ids, settings, logger):
+    if not ids:
+        return
+    for entry in OutlookQueueEntry.query.filter(OutlookQueueEntry.id.in_(ids)):
+        entry.record_failure(settings['retry_delay'], settings['max_attempts'])
+        if entry.is_dead_letter:
+            logger.warning('Giving up on %r after %d failed attempts', entry, entry.attempts)
+        else:
+            logger.info('Retrying %r after %s', entry, entry.next_attempt_dt)
+    db.session.commit()
+
+
+def _process_favorite_categories(settings, logger, breaker):
     # process the category queue
     query = (OutlookQueueEntry.query
              .options(joinedload(OutlookQueueEntry.category))
              .order_by(OutlookQueueEntry.user_id, OutlookQueueEntry.id)
-             .filter(OutlookQueueEntry.category_id.isnot(None)))
+             .filter(OutlookQueueEntry.category_id.isnot(None), ~OutlookQueueEntry.is_dead_letter))
     by_category = {}
     delete_ids = set()
+    # categories with an entry that is being processed by a task or waiting to be retried; any later
+    # changes to them must wait until that entry is done, since they would otherwise be applied out of
+    # order (e.g. a removal while the task is still adding the events)
+    busy = set()
+    now = now_utc()
     for entry in query:
+        if (entry.user_id, entry.category_id) in busy:
+            logger.debug('Postponing %r until earlier changes of the category have been processed', entry)
+            continue
+        if category_task_cache.get(str(entry.id)) is not None:
+            logger.debug('Favorite category addition is already being processed: %r', entry)
+            busy.add((entry.user_id, entry.category_id))
+            continue
+        if entry.next_attempt_dt is not None and entry.next_attempt_dt > now:
+            busy.add((entry.user_id, entry.category_id))
+            continue
         if (
             (existing := by_category.get(entry.category))
             and existing.action == OutlookAction.add
@@ -84,14 +183,19 @@ def _process_favorite_categories(settings, logger):
     for entry in by_category.values():
         by_user[entry.user].add(entry)
 
-    ignore = set()
+    dispatcher = CalendarDispatcher(settings, logger, breaker)
+    dispatcher.preferences.load(user.id for user in by_user)
+    # each tag is the set of queue entry ids that can be deleted once all requests with that tag succeeded
+    tags = set()
     for user, entries in by_user.items():
         delete_cat_entries = {x for x in entries if x.action == OutlookAction.remove}
-        add_cat_entries = {(x.category, x) for x in entries if x.action == OutlookAction.add}
+        add_cat_entries = {x for x in entries if x.action == OutlookAction.add}
         del entries
 
         if delete_cat_entries:
             logger.debug('Processing category favorite removals for %r', user)
+            tag = frozenset(x.id for x in delete_cat_entries)
+            tags.add(tag)
             # deletion is an easy case, we can simply get all future events within the deleted
             # category subtrees where the user has a calendar entry, unless it's also visible
             # in another favorite category...
@@ -101,171 +205,316 @@ def _process_favorite_categories(settings, logger):
                 Event.category_chain_overlaps({x.category_id for x in delete_cat_entries}),
                 Event.outlook_calendar_entries.any(OutlookCalendarEntry.user == user),
             ).all()
-            success = True
+            reasons = get_calendar_reasons((event, user) for event in events)
             for event in events:
-                if is_user_registered(event, user):
-                    logger.debug('Ignoring remove for %r; user is registered', event)
-                    continue
-                if is_user_favorite(event, user):
-                    logger.debug('Ignoring remove for %r; event is favorite', event)
-                    continue
-                if is_user_cat_favorite(event, user):
-                    logger.debug('Ignoring remove for %r; event is cat favorite', event)
+                if reason := reasons.get((event, user)):
+                    logger.debug('Ignoring remove for %r; %s', event, reason)
                     continue
                 logger.info('Removing event %r', event)
-                if not _update_calendar_entry(event, user, OutlookAction.remove, settings):
-                    success = False
-                else:
-                    ignore.add((event, user))
-
-            if success:
-                _delete_queue_entries({x.id for x in delete_cat_entries})
-
-        for cat, entry in add_cat_entries:
-            logger.info('Processing category favorite addition for %r: %r', user, cat)
-            query = (
-                Event.query.filter(
-                    Event.end_dt > now_utc(),
-                    Event.duration <= settings['max_event_duration'],
-                    ~Event.is_deleted,
-                    Event.is_visible_in(cat.id),
-                    ~Event.label.has(EventLabel.is_event_not_happening),
-                    ~Event.outlook_calendar_entries.any(OutlookCalendarEntry.user == user),
-                )
-                .options(subqueryload('acl_entries'))
-                .order_by(Event.start_dt, Event.id)
-            )
-            total_limit = settings['max_category_events']
-            limit = settings['max_accessible_category_events']
-            # bail out early if it's a ridiculously big category (e.g. root category)
-            if (count := query.count()) > total_limit:
-                logger.info('Ignoring favorite category %r: too many future events (%d > %d)', cat, count,
-                            total_limit)
-                delete_ids.add(entry.id)
-                continue
-            # get the events which the user can actually access
-            events = list(islice((e for e in query if e.can_access(user, allow_admin=False)), limit + 1))
-            if len(events) > limit:
-                logger.info('Ignoring favorite category %r: too many accessible future events (%d > %d)', cat,
-                            count, limit)
-                delete_ids.add(entry.id)
-                continue
-            logger.info('Adding %d events visible in favorite category %r', count, cat)
-            success = True
-            for event in events:
-                logger.info('Adding event %r', event)
-                if not _update_calendar_entry(event, user, OutlookAction.add, settings):
-                    success = False
-                else:
-                    ignore.add((event, user))
-            if success:
-                delete_ids.add(entry.id)
-                _delete_queue_entries(delete_ids)
-                delete_ids.clear()
-
-        # skipped large category entries may not have been deleted yet
-        if delete_ids:
-            _delete_queue_entries(delete_ids)
-            delete_ids.clear()
-
-    return ignore
-
-
-def _process_events(ignore, settings, logger):
-    # process the event queue, including any changes we may have created due to category changes
-    query = (OutlookQueueEntry.query
-             .options(joinedload(OutlookQueueEntry.event))
-             .order_by(OutlookQueueEntry.id)
-             .filter(OutlookQueueEntry.event_id.isnot(None)))
-    entries = MultiDict(((entry.user_id, entry.event_id), entry) for entry in query)
-    delete_ids = set()
+                dispatcher.update(event, user, OutlookAction.remove, tag=tag)
+
+        for entry in add_cat_entries:
+            # adding a favorite category may add many events, so this is done in a separate task
+            # to avoid delaying everything else in the queue
+            logger.info('Scheduling favorite category addition for %r: %r', user, entry.category)
+            category_task_cache.set(str(entry.id), {'cursor': None, 'success': True}, timeout=CATEGORY_TASK_TIMEOUT)
+            process_favorite_category.delay(entry.id)
+            metrics.inc('outlook_category_tasks_total', result='scheduled')
+
+    operations = dispatcher.run()
+    failed_tags = {op.tag for op in operations if op.success is False}
+    # requests not sent due to an unavailable calendar service are not counted as failed attempts
+    unsent_tags = {op.tag for op in operations if op.success is None}
+    for tag in tags - failed_tags - unsent_tags:
+        delete_ids |= tag
+    _delete_queue_entries(delete_ids)
+    _record_failed_queue_entries(set().union(*(failed_tags - unsent_tags)), settings, logger)
+    return {op.key for op in operations if op.success}
+
+
+def _get_favorite_category_events(category, user, settings, logger):
+    """Get the events to add to a user's calendar for a favorite category.
+
+    :return: A list of events sorted by start date, or `None` if there are
+             too many events in the category.
+    """
+    query = (
+        Event.query.filter(
+            Event.end_dt > now_utc(),
+            Event.duration <= settings['max_event_duration'],
+            ~Event.is_deleted,
+            Event.is_visible_in(category.id),
+            ~Event.label.has(EventLabel.is_event_not_happening),
+            ~Event.outlook_calendar_entries.any(OutlookCalendarEntry.user == user),
+        )
+        .options(subqueryload('acl_entries'))
+        .order_by(Event.start_dt, Event.id)
+    )
+    total_limit = settings['max_category_events']
+    limit = settings['max_accessible_category_events']
+    # bail out early if it's a ridiculously big category (e.g. root category)
+    if (count := query.count()) > total_limit:
+        logger.info('Ignoring favorite category %r: too many future events (%d > %d)', category, count, total_limit)
+        return None
+    # get the events which the user can actually access; public events do not need to be checked
+    # one by one, and the ACLs of all other events have already been loaded
+    events = list(islice((e for e in query if can_skip_access_check(e) or e.can_access(user, allow_admin=False)),
+                         limit + 1))
+    if len(events) > limit:
+        logger.info('Ignoring favorite category %r: too many accessible future events (%d > %d)', category, count,
+                    limit)
+        return None
+    return events
+
+
+def process_favorite_category_addition(entry_id):
+    """Add the events in a newly favorited category to the user's calendar.
+
+    The progress is stored in the cache after each chunk of events, so if
+    the task is interrupted, the next one picks up where it left off.
+    """
     try:
-        # entry_list is grouped by user+event
-        for entry_list in entries.listvalues():
-            entry_ids = {x.id for x in entry_list}
-            seen = set()
-            todo = []
-            # pick the latest entry for each action
-            for entry in reversed(entry_list):
-                if entry.action in seen:
-                    continue
-                seen.add(entry.action)
-                if is_event_excluded(entry.event):
-                    continue
-                if (entry.event, entry.user) in ignore:
-                    logger.debug('Ignoring %s due to favorite category change: %r', entry.action.name, entry)
-                    continue
-                todo.append(entry)
-            # execute those entries in the original order, so cases like
-            # "add, update, delete, add, update, update" are correctly
-            # handled as "delete, add, update" to handle edge cases where
-            # someone was removed from the registration and added back
-            # without processing entries in between
-            for entry in reversed(todo):
-                logger.info('Processing %s', entry)
-                if entry.user and not _update_calendar_entry(entry.event, entry.user, entry.action, settings):
-                    entry_ids.remove(entry.id)
-                elif not entry.user and not _update_bulk(entry.event, entry.action, settings):
-                    entry_ids.remove(entry.id)
-            # record all ids which didn't fail for deletion
-            delete_ids |= entry_ids
+        result = _process_favorite_category_addition(entry_id)
+        metrics.inc('outlook_category_tasks_total', result=result)
     finally:
-        _delete_queue_entries(delete_ids)
+        metrics.flush()
 
 
-def _update_bulk(event, action, settings):
-    if action == OutlookAction.remove:
-        success = True
-        for cal_entry in event.outlook_calendar_entries:
-            if not _update_calendar_entry(event, cal_entry.user, action, settings):
-                success = False
-        return success
-    elif action == OutlookAction.update:
-        success = True
-        users = {cal_entry.user for cal_entry in event.outlook_calendar_entries}
-        # in some cases a user may not have a calendar entry yet, e.g. if the event was created
-        # as invisible, and the visibility only got updated later
-        users |= get_users_to_add(event)
-        for user in users:
-            if not _update_calendar_entry(event, user, action, settings):
-                success = False
-        return success
-    elif action == OutlookAction.add:
-        success = True
-        for user in get_users_to_add(event):
-            if not _update_calendar_entry(event, user, action, settings):
-                success = False
-        return success
-
-
-def _get_status(user, event, settings):
+def _process_favorite_category_addition(entry_id):
     from indico_outlook.plugin import OutlookPlugin
-    status = OutlookPlugin.user_settings.get(user, 'status', settings['status'])
-    for override in OutlookPlugin.user_settings.get(user, 'overrides'):
-        if override['type'] == 'category' and override['id'] == event.category_id:
-            # we don't keep going for a specific category id match
-            return override['status']
-        elif override['type'] == 'category_tree' and override['id'] in event.category_chain:
-            # for category tree matches we keep going in case there's a specific match later.
-            # we don't try to see which one is more specific because that'd be overkill!
-            status = override['status']
-    return status
-
-
-def _get_reminder(user, event, settings):
+
+    logger = OutlookPlugin.logger
+    cache_key = str(entry_id)
+    state = category_task_cache.get(cache_key) or {'cursor': None, 'success': True}
+    entry = OutlookQueueEntry.query.filter(OutlookQueueEntry.id == entry_id,
+                                           OutlookQueueEntry.category_id.isnot(None),
+                                           OutlookQueueEntry.action == OutlookAction.add).first()
+    if entry is None:
+        logger.debug('Favorite category queue entry %d does not exist anymore', entry_id)
+        category_task_cache.delete(cache_key)
+        return 'gone'
+    if not check_config():
+        logger.error('Plugin is not configured properly')
+        category_task_cache.delete(cache_key)
+        return 'unconfigured'
+
+    settings = OutlookPlugin.settings.get_all()
+    breaker = CircuitBreaker(settings, logger)
+    user, category = entry.user, entry.category
+    logger.info('Processing favorite category addition for %r: %r', user, category)
+    if (events := _get_favorite_category_events(category, user, settings, logger)) is None:
+        _delete_queue_entries({entry_id})
+        category_task_cache.delete(cache_key)
+        return 'too_many_events'
+    if state['cursor']:
+        cursor = (datetime.fromisoformat(state['cursor'][0]), state['cursor'][1])
+        events = [e for e in events if (e.start_dt, e.id) > cursor]
+    logger.info('Adding %d events visible in favorite category %r', len(events), category)
+    for chunk in batched(events, settings['queue_chunk_size']):
+        dispatcher = CalendarDispatcher(settings, logger, breaker)
+        for event in chunk:
+            logger.info('Adding event %r', event)
+            dispatcher.update(event, user, OutlookAction.add)
+        operations = dispatcher.run()
+        if any(op.success is None for op in operations):
+            # the next run schedules a new task once the calendar service is available again
+            logger.warning('Calendar service is unavailable, aborting favorite category addition')
+            category_task_cache.delete(cache_key)
+            return 'aborted'
+        if not all(op.success for op in operations):
+            state['success'] = False
+        last = chunk[-1]
+        state['cursor'] = (last.start_dt.isoformat(), last.id)
+        category_task_cache.set(cache_key, state, timeout=CATEGORY_TASK_TIMEOUT)
+    # if anything failed we keep the queue entry so a later run retries the failed events
+    if state['success']:
+        _delete_queue_entries({entry_id})
+    else:
+        _record_failed_queue_entries({entry_id}, settings, logger)
+    category_task_cache.delete(cache_key)
+    return 'success' if state['success'] else 'failed'
+
+
+def _queue_group_key():
+    # `user_id` is NULL for entries affecting all users of an event; those are processed first
+    return OutlookQueueEntry.event_id, db.func.coalesce(OutlookQueueEntry.user_id, 0)
+
+
+def _get_queue_chunk(after, limit, *, imminent_until=None):
+    """Get the next chunk of (event_id, user_id) groups from the event queue.
+
+    This uses keyset pagination, so getting a chunk does not become slower
+    the more of the queue has already been processed.
+
+    :param imminent_until: If set, only get groups for events which did not
+                           end yet and start before this time.
+    """
+    key = _queue_group_key()
+    # skip groups with entries waiting to be retried to keep processing their actions in order
+    waiting = (db.session.query(*key)
+               .filter(OutlookQueueEntry.event_id.isnot(None),
+                       ~OutlookQueueEntry.is_dead_letter,
+                       OutlookQueueEntry.next_attempt_dt > now_utc()))
+    query = (db.session.query(*key)
+             .filter(OutlookQueueEntry.event_id.isnot(None),
+                     OutlookQueueEntry.is_due(),
+                     tuple_(*key).not_in(waiting))
+             .distinct()
+             .order_by(*key)
+             .limit(limit))
+    if after is not None:
+        query = query.filter(tuple_(*key) > after)
+    if imminent_until is not None:
+        query = query.filter(OutlookQueueEntry.event.has(db.and_(Event.start_dt <= imminent_until,
+                                                                 Event.end_dt > now_utc())))
+    return [tuple(row) for row in query]
+
+
+def _process_events(ignore, settings, logger, breaker, deadline, *, imminent=False):
+    # process the event queue, including any changes we may have created due to category changes.
+    # we do this in chunks of user+event groups and delete the processed entries after each chunk
+    # to avoid loading the whole queue at once and to keep the progress if something goes wrong
+    imminent_until = (now_utc() + settings['imminent_horizon']) if imminent else None
+    after = None
+    while chunk := _get_queue_chunk(after, settings['queue_chunk_size'], imminent_until=imminent_until):
+        if now_utc() >= deadline:
+            logger.warning('Run time limit reached, leaving remaining queue entries for the next run')
+            return
+        _process_events_chunk(chunk, ignore, settings, logger, breaker)
+        if breaker.is_open:
+            logger.warning('Calendar service is unavailable, aborting run')
+            return
+        after = chunk[-1]
+
+
+def _process_events_chunk(chunk, ignore, settings, logger, breaker):
+    query = (OutlookQueueEntry.query
+             .options(joinedload(OutlookQueueEntry.event))
+             .order_by(OutlookQueueEntry.id)
+             .filter(tuple_(*_queue_group_key()).in_(chunk), OutlookQueueEntry.is_due()))
+    entries = MultiDict(((entry.user_id, entry.event_id), entry) for entry in query)
+    dispatcher = CalendarDispatcher(settings, logger, breaker)
+    dispatcher.preferences.load(user_id for user_id, __ in entries if user_id is not None)
+    queued_ids = set()
+    # entry_list is grouped by user+event
+    for entry_list in entries.listvalues():
+        queued_ids |= {x.id for x in entry_list}
+        seen = set()
+        todo = []
+        # pick the latest entry for each action
+        for entry in reversed(entry_list):
+            if entry.action in seen:
+                continue
+            seen.add(entry.action)
+            if is_event_excluded(entry.event):
+                continue
+            if (entry.user_id, entry.event_id) in ignore:
+                logger.debug('Ignoring %s due to favorite category change: %r', entry.action.name, entry)
+                continue
+            todo.append(entry)
+        # execute those entries in the original order, so cases like
+        # "add, update, delete, add, update, update" are correctly
+        # handled as "delete, add, update" to handle edge cases where
+        # someone was removed from the registration and added back
+        # without processing entries in between
+        for entry in reversed(todo):
+            logger.info('Processing %s', entry)
+            if entry.user:
+                dispatcher.update(entry.event, entry.user, entry.action, tag=entry.id)
+            else:
+                dispatcher.update_bulk(entry.event, entry.action, tag=entry.id)
+    # delete all entries which didn't fail and retry the other ones later. requests which were
+    # not sent due to an unavailable calendar service are not counted as failed attempts
+    operations = dispatcher.run()
+    failed_ids = {op.tag for op in operations if op.success is False}
+    unsent_ids = {op.tag for op in operations if op.success is None}
+    _delete_queue_entries(queued_ids - failed_ids - unsent_ids)
+    _record_failed_queue_entries(failed_ids - unsent_ids, settings, logger)
+    metrics.inc('outlook_queue_entries_processed_total', len(queued_ids - failed_ids - unsent_ids), result='success')
+    metrics.inc('outlook_queue_entries_processed_total', len(failed_ids - unsent_ids), result='failed')
+    metrics.inc('outlook_queue_entries_processed_total', len(unsent_ids), result='unsent')
+
+
+@dataclass
+class ReconcileResult:
+    """The changes made while reconciling a batch of events."""
+
+    #: the number of checked events
+    events: int
+    #: the number of calendar entries to add
+    added: int
+    #: the number of calendar entries to remove
+    removed: int
+    #: the number of requests which failed or were not sent
+    failed: int = 0
+
+
+def reconcile_calendars(*, dispatch=False, dry_run=False):
+    """Add or remove calendar entries which do not match who should have an event.
+
+    All future events are checked in batches, comparing the users who should
+    have each event in their calendar with the existing calendar entries.
+    Anyone with a pending queue entry for an event is skipped, since their
+    calendar will be updated anyway.
+
+    :param dispatch: Whether to send the calendar requests immediately instead
+                     of adding them to the queue.
+    :param dry_run: Whether to only determine the changes without applying them.
+    :return: An iterator yielding a :class:`ReconcileResult` for each batch.
+    """
     from indico_outlook.plugin import OutlookPlugin
-    reminder = OutlookPlugin.user_settings.get(user, 'reminder', settings['reminder'])
-    reminder_minutes = OutlookPlugin.user_settings.get(user, 'reminder_minutes', settings['reminder_minutes'])
-    for override in OutlookPlugin.user_settings.get(user, 'overrides'):
-        if override['type'] == 'category' and override['id'] == event.category_id:
-            # we don't keep going for a specific category id match
-            return override.get('reminder', reminder), override.get('reminder_minutes', reminder_minutes)
-        elif override['type'] == 'category_tree' and override['id'] in event.category_chain:
-            # for category tree matches we keep going in case there's a specific match later.
-            # we don't try to see which one is more specific becauase that'd be overkill!
-            reminder = override.get('reminder', reminder)
-            reminder_minutes = override.get('reminder_minutes', reminder_minutes)
-    return reminder, reminder_minutes
+
+    settings = OutlookPlugin.settings.get_all()
+    logger = OutlookPlugin.logger
+    breaker = CircuitBreaker(settings, logger)
+    dispatcher = CalendarDispatcher(settings, logger, breaker) if dispatch and not dry_run else None
+    query = (Event.query
+             .filter(~Event.is_deleted,
+                     Event.end_dt > now_utc(),
+                     Event.end_dt - Event.start_dt <= settings['max_event_duration'])
+             .options(joinedload(Event.label))
+             .order_by(Event.id))
+    last_id = 0
+    while events := query.filter(Event.id > last_id).limit(settings['queue_chunk_size']).all():
+        last_id = events[-1].id
+        yield _reconcile_events(events, dispatcher, dry_run, logger)
+        if dispatcher and breaker.is_open:
+            logger.warning('Calendar service is unavailable, aborting reconciliation')
+            return
+
+
+def _reconcile_events(events, dispatcher, dry_run, logger):
+    events = {event.id: event for event in events}
+    desired = get_calendar_entries(events.values())
+    existing = get_existing_calendar_entries(events.values())
+    pending = {tuple(row) for row in (db.session.query(OutlookQueueEntry.user_id, OutlookQueueEntry.event_id)
+                                      .filter(OutlookQueueEntry.event_id.in_(events), ~OutlookQueueEntry.is_dead_letter)
+                                      .distinct())}
+    # entries which are not user-specific affect everyone who has the event in their calendar
+    pending_events = {event_id for user_id, event_id in pending if user_id is None}
+    changes = [(key, action)
+               for keys, action in ((existing - desired, OutlookAction.remove),
+                                    (desired - existing, OutlookAction.add))
+               for key in sorted(keys)
+               if key not in pending and key[1] not in pending_events]
+    result = ReconcileResult(events=len(events),
+                             added=sum(action == OutlookAction.add for __, action in changes),
+                             removed=sum(action == OutlookAction.remove for __, action in changes))
+    for (user_id, event_id), action in changes:
+        logger.debug('Reconciling calendar of user %d: %s event %d', user_id, action.name, event_id)
+    if dry_run or not changes:
+        return result
+    if dispatcher is None:
+        OutlookQueueEntry.record_many([{'user_id': user_id, 'event_id': event_id, 'action': action}
+                                       for (user_id, event_id), action in changes])
+        db.session.commit()
+        return result
+    users = User.query.filter(User.id.in_({key[0] for key, __ in changes})).all()
+    users = {user.id: user for user in users}
+    for (user_id, event_id), action in changes:
+        dispatcher.update(events[event_id], users[user_id], action)
+    result.failed = sum(op.success is not True for op in dispatcher.run())
+    return result
 
 
 def _make_calendar_id(event, user, settings):
@@ -274,113 +523,325 @@ def _make_calendar_id(event, user, settings):
     return f'{settings["id_prefix"]}{user.id}_{event.id}'
 
 
-def _update_calendar_entry(event, user, action, settings) -> bool:
-    """Execute a single calendar update.
+def _is_user_dependent(receiver):
+    return getattr(receiver, 'outlook_user_dependent', False)
+
+
+def _postprocess_calendar_data(event, data, user, *, user_dependent):
+    """Get the changes plugins want to make to the calendar data.
 
-    :return: `True` if the related queue entry should be removed.
+    Only receivers of the `metadata_postprocess` signal which declare their
+    results as user-dependent (by setting ``outlook_user_dependent = True``
+    on the receiver function) are called for each user.  All other ones are
+    called once per event without a user, just like for an anonymous iCal
+    export.
+    """
+    receivers = [r for r in signals.event.metadata_postprocess.receivers_for('ical-export')
+                 if _is_user_dependent(r) == user_dependent]
+    changes = {}
+    for update in values_from_signal(
+        [(r, r('ical-export', event=event, data=dict(data), user=user, html_fields={'description'}))
+         for r in receivers],
+        as_list=True
+    ):
+        changes.update(update)
+    return changes
+
+
+def _build_event_calendar_data(event):
+    """Build the part of the calendar payload which is the same for all users.
+
+    :return: A ``(data, changes)`` tuple containing the event data and the
+             changes from signal receivers which do not depend on the user.
+    """
+    location = (f'{event.room_name} ({event.venue_name})'
+                if event.venue_name and event.room_name
+                else (event.venue_name or event.room_name))
+
+    title = event.title
+    if event.label:
+        title = f'[{event.label.title}] {title}'
+
+    cal_description = []
+    if event.person_links:
+        speakers = [f'{x.full_name} ({x.affiliation})' if x.affiliation else x.full_name
+                    for x in event.person_links]
+        cal_description.append(Markup('<p>Speakers: {}</p>').format(', '.join(speakers)))
+    cal_description.append(event.description)
+    cal_description.append(f'<p><a href="{event.external_url}">{event.external_url}</a></p>')
+
+    data = {
+        'start': int(event.start_dt.timestamp()),
+        'end': int(event.end_dt.timestamp()),
+        'subject': strip_control_chars(title),
+        # XXX: the API expects 'body', we convert it when building the user-specific data
+        'description': strip_control_chars('\n'.join(cal_description)),
+        'location': strip_control_chars(location),
+    }
+    return data, _postprocess_calendar_data(event, data, None, user_dependent=False)
+
+
+def _build_calendar_data(event, user, event_data, preferences):
+    """Build the payload for adding/updating a calendar entry."""
+    data, event_changes = event_data
+    status, reminder, reminder_minutes = preferences.get_entry_settings(user, event)
+    data = {
+        **data,
+        'status': status,
+        'reminder_on': reminder,
+        'reminder_minutes': reminder_minutes,
+    }
+    # check whether the plugins want to add/override any data
+    data.update(event_changes)
+    data.update(_postprocess_calendar_data(event, data, user, user_dependent=True))
+    # the API expects the field to be named 'body', contrarily to our usage
+    data['body'] = data.pop('description')
+    return data
+
+
+@dataclass
+class CalendarOperation:
+    """A pending calendar request for a single user and event."""
+
+    user_id: int
+    event_id: int
+    email: str
+    action: OutlookAction
+    #: the calendar entry ID to use if there is no existing entry
+    calendar_id: str
+    #: the payload of an add/update request
+    data: dict | None = None
+    #: an arbitrary value identifying what caused the operation
+    tag: object = None
+    #: whether the request succeeded; `None` if it has not been sent
+    success: bool | None = None
+
+    @property
+    def key(self):
+        return self.user_id, self.event_id
+
+
+class CalendarDispatcher:
+    """Send calendar requests concurrently.
+
+    Operations are planned on the main thread, which is the only one
+    accessing the database.  All operations for the same user and event
+    are then sent in order by a single worker thread while different
+    user/event pairs are processed in parallel, and the resulting
+    calendar entry changes are written back in batches on the main
+    thread.
     """
-    from indico_outlook.plugin import OutlookPlugin
-    logger = OutlookPlugin.logger
 
-    if not OutlookPlugin.user_settings.get(user, 'enabled'):
-        logger.debug('User %s has disabled calendar entries', user)
-        return True
-
-    if existing := OutlookCalendarEntry.get(event, user):
-        logger.debug('Found existing calendar entry in DB: %s', existing.calendar_entry_id)
-    elif action == OutlookAction.update:
-        logger.info('No calendar entry found in DB for event=%s/user=%s during update', event.id, user.id)
-    elif action == OutlookAction.remove:
-        logger.debug('No calendar entry found in DB for event=%s/user=%s, ignoring remove', event.id, user.id)
-        return True
-
-    # Use common format for event calendar ID if the event was created after the cutoff event
-    unique_id = existing.calendar_entry_id if existing else _make_calendar_id(event, user, settings)
-    path = f'/api/v1/users/{user.email}/events/{unique_id}'
-    url = settings['service_url'].rstrip('/') + path
-    if action in {OutlookAction.add, OutlookAction.update}:
-        method = 'PUT'
-        if event.is_deleted:
-            logger.debug('Ignoring %s for deleted event %s', action.name, event.id)
-            return True
-        reminder, reminder_minutes = _get_reminder(user, event, settings)
-        location = (f'{event.room_name} ({event.venue_name})'
-                    if event.venue_name and event.room_name
-                    else (event.venue_name or event.room_name))
-
-        title = event.title
-        if event.label:
-            title = f'[{event.label.title}] {title}'
-
-        cal_description = []
-        if event.person_links:
-            speakers = [f'{x.full_name} ({x.affiliation})' if x.affiliation else x.full_name
-                        for x in event.person_links]
-            cal_description.append(Markup('<p>Speakers: {}</p>').format(', '.join(speakers)))
-        cal_description.append(event.description)
-        cal_description.append(f'<p><a href="{event.external_url}">{event.external_url}</a></p>')
-
-        data = {
-            'status': _get_status(user, event, settings),
-            'start': int(event.start_dt.timestamp()),
-            'end': int(event.end_dt.timestamp()),
-            'subject': strip_control_chars(title),
-            # XXX: the API expects 'body', we convert it below
-            'description': strip_control_chars('\n'.join(cal_description)),
-            'location': strip_control_chars(location),
-            'reminder_on': reminder,
-            'reminder_minutes': reminder_minutes,
-        }
-
-        # check whether the plugins want to add/override any data
-        for update in values_from_signal(
-            signals.event.metadata_postprocess.send('ical-export', event=event, data=data, user=user,
-                                                    html_fields={'description'}),
-            as_list=True
-        ):
-            data.update(update)
-        # the API expects the field to be named 'body', contrarily to our usage
-        data['body'] = data.pop('description')
-    elif action == OutlookAction.remove:
-        method = 'DELETE'
-        data = None
-    else:
-        raise ValueError(f'Unexpected action: {action}')
+    def __init__(self, settings, logger, breaker):
+        self.settings = settings
+        self.logger = logger
+        self.breaker = breaker
+        self.preferences = OutlookPreferences(settings)
+        #: the user-independent calendar data of each event
+        self._event_data = {}
+        self._reset()
+
+    def _reset(self):
+        #: the operations to send, grouped by (user_id, event_id)
+        self.operations = defaultdict(list)
+        #: the calendar entry IDs currently stored in the database
+        self._calendar_ids = {}
+        #: the users who will have a calendar entry once all planned operations succeeded
+        self._entry_users = defaultdict(dict)
+        self._loaded_events = set()
+
+    def _load_event_entries(self, event):
+        if event.id in self._loaded_events:
+            return
+        self._loaded_events.add(event.id)
+        for entry in event.outlook_calendar_entries.options(joinedload(OutlookCalendarEntry.user)):
+            key = (entry.user_id, entry.event_id)
+            if key in self._calendar_ids:
+                continue
+            self._calendar_ids[key] = entry.calendar_entry_id
+            self._entry_users[event.id][entry.user_id] = entry.user
+
+    def _load_entry(self, event, user):
+        key = (user.id, event.id)
+        if key in self._calendar_ids:
+            return
+        if event.id in self._loaded_events:
+            self._calendar_ids[key] = None
+            return
+        entry = OutlookCalendarEntry.get(event, user)
+        self._calendar_ids[key] = entry.calendar_entry_id if entry else None
+        if entry:
+            self._entry_users[event.id][user.id] = user
+
+    def get_entry_users(self, event):
+        """Get the users who have the event in their calendar once all planned operations ran."""
+        self._load_event_entries(event)
+        return set(self._entry_users[event.id].values())
+
+    def update(self, event, user, action, *, tag=None):
+        """Plan a calendar update for a single user."""
+        if not self.preferences.is_enabled(user):
+            self.logger.debug('User %s has disabled calendar entries', user)
+            return
+        if action in {OutlookAction.add, OutlookAction.update}:
+            if event.is_deleted:
+                self.logger.debug('Ignoring %s for deleted event %s', action.name, event.id)
+                return
+            if (event_data := self._event_data.get(event.id)) is None:
+                event_data = self._event_data[event.id] = _build_event_calendar_data(event)
+            data = _build_calendar_data(event, user, event_data, self.preferences)
+        elif action == OutlookAction.remove:
+            data = None
+        else:
+            raise ValueError(f'Unexpected action: {action}')
+
+        self._load_entry(event, user)
+        op = CalendarOperation(user.id, event.id, user.email, action, _make_calendar_id(event, user, self.settings),
+                               data, tag)
+        self.operations[op.key].append(op)
+        if action == OutlookAction.remove:
+            self._entry_users[event.id].pop(user.id, None)
+        else:
+            self._entry_users[event.id][user.id] = user
+
+    def update_bulk(self, event, action, *, tag=None):
+        """Plan a calendar update for all users affected by an event change."""
+        if action == OutlookAction.remove:
+            users = self.get_entry_users(event)
+        elif action == OutlookAction.update:
+            # in some cases a user may not have a calendar entry yet, e.g. if the event was created
+            # as invisible, and the visibility only got updated later
+            users = self.get_entry_users(event) | get_calendar_users(event)
+        elif action == OutlookAction.add:
+            users = get_calendar_users(event) - self.get_entry_users(event)
+        else:
+            raise ValueError(f'Unexpected action: {action}')
+        self.preferences.load(user.id for user in users)
+        for user in users:
+            self.update(event, user, action, tag=tag)
+
+    def run(self):
+        """Send all planned requests and store the resulting calendar entry changes.
+
+        :return: A list of all :class:`CalendarOperation` objects, with
+                 their ``success`` attribute set unless they were not sent
+                 because the calendar service is unavailable.
+        """
+        if not self.operations:
+            return []
+        changes = {}
+        try:
+            with (
+                OutlookClient(self.settings, self.breaker) as client,
+                ThreadPoolExecutor(max_workers=self.settings['workers'], thread_name_prefix='outlook') as executor,
+            ):
+                futures = {executor.submit(_send_calendar_requests, client, ops, self._calendar_ids[key],
+                                           self.settings['debug'], self.logger): key
+                           for key, ops in self.operations.items()}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    calendar_id = future.result()
+                    if calendar_id != self._calendar_ids[key]:
+                        changes[key] = calendar_id
+                    if len(changes) >= DB_BATCH_SIZE:
+                        # take the batch out first, so if storing it fails we do not try again (and hide
+                        # the original error) when storing the remaining changes below
+                        batch, changes = changes, {}
+                        self._save_changes(batch)
+        finally:
+            # the changes of all requests which were sent are stored even if something went wrong
+            self._save_changes(changes)
+        operations = [op for ops in self.operations.values() for op in ops]
+        self._reset()
+        return operations
+
+    def _save_changes(self, changes):
+        if not changes:
+            return
+        if delete := [key for key, calendar_id in changes.items() if calendar_id is None]:
+            (OutlookCalendarEntry.query
+             .filter(tuple_(OutlookCalendarEntry.user_id, OutlookCalendarEntry.event_id).in_(delete))
+             .delete(synchronize_session=False))
+        if create := [{'user_id': user_id, 'event_id': event_id, 'calendar_entry_id': calendar_id}
+                      for (user_id, event_id), calendar_id in changes.items()
+                      if calendar_id is not None]:
+            # a favorite category task may have added the same entry in the meantime
+            stmt = insert(OutlookCalendarEntry.__table__)
+            stmt = stmt.on_conflict_do_update(index_elements=[OutlookCalendarEntry.user_id,
+                                                              OutlookCalendarEntry.event_id],
+                                              set_={'calendar_entry_id': stmt.excluded.calendar_entry_id})
+            db.session.execute(stmt, create)
+        db.session.commit()
+        for key, calendar_id in changes.items():
+            self._calendar_ids[key] = calendar_id
+        self.logger.debug('Recorded %d calendar entry changes in DB', len(changes))
+
+
+def _send_calendar_requests(client, operations, calendar_id, debug, logger):
+    """Send the requests for a single user and event in order.
+
+    This runs in a worker thread and thus must not access the database.
+
+    :param calendar_id: The ID of the existing calendar entry or `None`.
+    :return: The ID of the calendar entry after sending all requests, or
+             `None` if there is no calendar entry anymore.
+    """
+    for op in operations:
+        if calendar_id:
+            logger.debug('Found existing calendar entry in DB: %s', calendar_id)
+        elif op.action == OutlookAction.update:
+            logger.info('No calendar entry found in DB for event=%s/user=%s during update', op.event_id, op.user_id)
+        elif op.action == OutlookAction.remove:
+            logger.debug('No calendar entry found in DB for event=%s/user=%s, ignoring remove', op.event_id,
+                         op.user_id)
+            op.success = True
+            continue
 
-    if settings['debug']:
-        logger.debug('Calendar update request:\nURL: %s\nData: %s', url, pformat(data))
-        return True
+        # Use common format for event calendar ID if the event was created after the cutoff event
+        unique_id = calendar_id or op.calendar_id
+        path = f'/api/v1/users/{op.email}/events/{unique_id}'
+        method = 'DELETE' if op.action == OutlookAction.remove else 'PUT'
+        if debug:
+            logger.debug('Calendar update request:\nURL: %s\nData: %s', client.base_url + path, pformat(op.data))
+            op.success = True
+            continue
 
-    token = settings['token']
-    try:
-        res = requests.request(method, url, json=data, headers={'Authorization': f'Bearer {token}'},
-                               timeout=settings['timeout'])
-    except Timeout:
-        logger.warning('Request timed out')
-        return False
-    except RequestException:
-        logger.exception('Request failed:\nURL: %s\nData: %s', url, pformat(data))
-        return False
-    else:
+        start = time.monotonic()
+        try:
+            res = client.request(method, path, op.data)
+        except CircuitOpen:
+            logger.debug('Not sending request to %s %s; calendar service is unavailable', method, path)
+            metrics.inc('outlook_requests_total', action=op.action.name, result='unsent')
+            # leave this and all following operations unsent to keep their order
+            break
+        except Timeout:
+            logger.warning('Request timed out')
+            metrics.observe('outlook_request_duration_seconds', time.monotonic() - start, action=op.action.name)
+            metrics.inc('outlook_requests_total', action=op.action.name, result='timeout')
+            op.success = False
+            continue
+        except RequestException:
+            logger.exception('Request failed:\nURL: %s\nData: %s', client.base_url + path, pformat(op.data))
+            metrics.observe('outlook_request_duration_seconds', time.monotonic() - start, action=op.action.name)
+            metrics.inc('outlook_requests_total', action=op.action.name, result='error')
+            op.success = False
+            continue
+
+        metrics.observe('outlook_request_duration_seconds', time.monotonic() - start, action=op.action.name)
         logger.info('Request to %s %s finished with status %r and body %r', method, path, res.status_code, res.text)
-        if res.ok and not existing and action in {OutlookAction.add, OutlookAction.update}:
+        if res.ok and not calendar_id and op.action in {OutlookAction.add, OutlookAction.update}:
             # successfully added or updated w/ no reference to existing entry
-            OutlookCalendarEntry.create(event, user, unique_id)
-            logger.debug('Recorded calendar entry in DB')
-            db.session.commit()
-        elif (res.ok or res.status_code == 404) and action == OutlookAction.remove:
+            calendar_id = unique_id
+        elif (res.ok or res.status_code == 404) and op.action == OutlookAction.remove:
             # successfully removed or nothing to remove
-            db.session.delete(existing)
-            db.session.commit()
-            logger.debug('Removed calendar entry from DB')
-        elif res.status_code == 404 and action == OutlookAction.update and existing:
+            calendar_id = None
+        elif res.status_code == 404 and op.action == OutlookAction.update and calendar_id:
             # tried to update but nothing to update
-            db.session.delete(existing)
-            db.session.commit()
-            logger.debug('Removed calendar entry from DB')
+            calendar_id = None
         # 404 is "already deleted" or "user has no mailbox" - both cases we consider a success
-        if res.ok or res.status_code == 404:
-            return True
-        logger.error('Request unsuccessful:\nURL: %s\nData: %s\nCode: %s\nResponse: %s',
-                     url, pformat(data), res.status_code, res.text)
-        return False
+        op.success = res.ok or res.status_code == 404
+        metrics.inc('outlook_requests_total', action=op.action.name, result='success' if op.success else 'failed')
+        if not op.success:
+            logger.error('Request unsuccessful:\nURL: %s\nData: %s\nCode: %s\nResponse: %s',
+                         client.base_url + path, pformat(op.data), res.status_code, res.text)
+    return calendar_id
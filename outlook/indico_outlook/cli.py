@@ -0,0 +1,149 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import time
+from collections import Counter
+from dataclasses import asdict
+from datetime import datetime
+
+import click
+
+from indico.cli.core import cli_group
+from indico.core.db import db
+from indico.util.date_time import now_utc
+
+from indico_outlook.calendar import reconcile_calendars, update_calendar
+from indico_outlook.client import CircuitBreaker
+from indico_outlook.metrics import estimate_quantile, get_current_values, get_totals, get_value
+from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
+from indico_outlook.util import check_config
+
+
+@cli_group(name='outlook')
+def cli():
+    """Synchronizes Outlook calendars."""
+
+
+@cli.command()
+@click.option('--imminent', is_flag=True, help='Only process changes to events starting soon')
+def sync(imminent):
+    """Execute all pending calendar updates."""
+    update_calendar(imminent_only=imminent)
+
+
+@cli.command()
+@click.option('--dispatch', is_flag=True, help='Send the calendar requests immediately instead of queuing them')
+@click.option('--dry-run', '-n', is_flag=True, help='Only show how many calendar entries would be changed')
+def reconcile(dispatch, dry_run):
+    """Fix calendar entries which do not match who should have an event.
+
+    By default the necessary changes are added to the queue and performed
+    during the next calendar update.
+    """
+    if dispatch and not dry_run and not check_config():
+        click.secho('Plugin is not configured properly', fg='red')
+        return
+    totals = Counter()
+    start = time.monotonic()
+    for result in reconcile_calendars(dispatch=dispatch, dry_run=dry_run):
+        totals.update(asdict(result))
+        elapsed = time.monotonic() - start
+        click.echo(f'{totals["events"]} events checked ({totals["events"] / elapsed:.1f}/s), '
+                   f'{totals["added"]} calendar entries to add, {totals["removed"]} to remove')
+    if dry_run:
+        click.secho('Dry run, nothing has been changed', fg='yellow')
+    elif not dispatch:
+        click.secho(f'Queued {totals["added"] + totals["removed"]} calendar updates', fg='green')
+    elif totals['failed']:
+        click.secho(f'{totals["failed"]} calendar updates failed or were not sent', fg='red')
+    else:
+        click.secho('Calendar entries have been reconciled', fg='green')
+
+
+@cli.command()
+def status():
+    """Show the status of the calendar synchronization."""
+    from indico_outlook.plugin import OutlookPlugin
+
+    if (state := CircuitBreaker.get_state()) is None:
+        click.secho('Calendar service: available', fg='green')
+    else:
+        probe_dt = state['opened_dt'] + OutlookPlugin.settings.get('circuit_breaker_cooldown')
+        click.secho(f'Calendar service: unavailable since {state["opened_dt"]:%Y-%m-%d %H:%M:%S} '
+                    f'({state["failures"]} failures)', fg='red')
+        if probe_dt > now_utc():
+            click.echo(f'Next probe after {probe_dt:%Y-%m-%d %H:%M:%S}')
+        else:
+            click.echo('Next run will probe the calendar service')
+
+    values = get_current_values()
+    click.echo('Queue entries: {} due, {} waiting for a retry, {} failed permanently'.format(
+        values['outlook_queue_entries{state="due"}'],
+        values['outlook_queue_entries{state="retry"}'],
+        values['outlook_queue_entries{state="dead"}'],
+    ))
+
+
+@cli.command()
+def requeue():
+    """Retry the queue entries which failed permanently.
+
+    The entries are processed again during the next calendar update, e.g.
+    after the calendar service was unavailable for a long time.  If many
+    calendars changed since then, use `reconcile` instead and `purge` the
+    failed entries.
+    """
+    count = (OutlookQueueEntry.query
+             .filter(OutlookQueueEntry.is_dead_letter)
+             .update({OutlookQueueEntry.is_dead_letter: False,
+                      OutlookQueueEntry.attempts: 0,
+                      OutlookQueueEntry.next_attempt_dt: None}, synchronize_session=False))
+    db.session.commit()
+    click.secho(f'Requeued {count} failed queue entries', fg='green')
+
+
+@cli.command()
+@click.confirmation_option(prompt='Do you really want to delete all queue entries which failed permanently?')
+def purge():
+    """Delete the queue entries which failed permanently."""
+    count = OutlookQueueEntry.query.filter(OutlookQueueEntry.is_dead_letter).delete(synchronize_session=False)
+    db.session.commit()
+    click.secho(f'Deleted {count} failed queue entries', fg='green')
+
+
+def _format_seconds(value):
+    if value is None:
+        return '-'
+    elif value == float('inf'):
+        return 'too long'
+    return f'{value:.2f}s'
+
+
+@cli.command()
+def metrics():
+    """Show a summary of the calendar synchronization metrics."""
+    totals = get_totals()
+    if not (runs := totals.get('outlook_runs_total')):
+        click.echo('No calendar update runs recorded yet')
+        return
+    click.echo(f'Runs: {runs:g}, average duration: '
+               f'{_format_seconds(totals["outlook_run_duration_seconds_sum"] / runs)}, '
+               f'95th percentile: {_format_seconds(estimate_quantile(totals, "outlook_run_duration_seconds", 0.95))}')
+    if (last_run := totals.get('outlook_last_run_timestamp_seconds')) is not None:
+        click.echo(f'Last run: {datetime.fromtimestamp(last_run):%Y-%m-%d %H:%M:%S}, took '
+                   f'{_format_seconds(totals["outlook_last_run_duration_seconds"])}')
+    click.echo()
+    click.echo('Requests:')
+    for action in OutlookAction:
+        count = get_value(totals, 'outlook_request_duration_seconds_count', action=action.name)
+        results = {result: get_value(totals, 'outlook_requests_total', action=action.name, result=result)
+                   for result in ('success', 'failed', 'timeout', 'error', 'unsent')}
+        results = ', '.join(f'{result} {value:g}' for result, value in results.items())
+        p50 = estimate_quantile(totals, 'outlook_request_duration_seconds', 0.5, action=action.name)
+        p95 = estimate_quantile(totals, 'outlook_request_duration_seconds', 0.95, action=action.name)
+        click.echo(f'  {action.name}: {count:g} sent ({results}), '
+                   f'p50 {_format_seconds(p50)}, p95 {_format_seconds(p95)}')
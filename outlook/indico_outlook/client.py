@@ -0,0 +1,169 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from datetime import datetime
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from indico.util.date_time import now_utc
+
+from indico_outlook import circuit_breaker_cache, get_redis_client
+
+
+#: The redis key claimed by whoever sends the probe request after the cooldown
+PROBE_KEY = 'indico-plugin-outlook:circuit-breaker-probe'
+
+
+class CircuitOpen(RequestException):
+    """Raised instead of sending a request while the calendar service is down."""
+
+
+class CircuitBreaker:
+    """Stop sending requests to the calendar service while it appears to be down.
+
+    After too many consecutive timeouts, connection errors or server errors
+    the circuit is opened and no requests are sent anymore.  This state is
+    stored in the cache, so it is shared with other runs and processes.
+    Once the cooldown has passed, a single request acts as a probe: if it
+    fails the circuit is opened again right away, otherwise it is closed.
+    The probe is claimed atomically in redis, so no matter how many runs
+    and threads are sending requests, all others are rejected until the
+    probe has finished.  If its sender dies, the claim expires after
+    another cooldown.
+    """
+
+    def __init__(self, settings, logger):
+        self.threshold = settings['circuit_breaker_threshold']
+        self.cooldown = settings['circuit_breaker_cooldown']
+        self.logger = logger
+        self._failures = 0
+        self._open = False
+        self._probing = False
+        self._lock = Lock()
+
+    @staticmethod
+    def get_state():
+        """Get the state of the circuit breaker.
+
+        :return: A dict containing the time the circuit was opened and the
+                 number of failures which caused it, or `None` if the
+                 circuit is closed.
+        """
+        if (state := circuit_breaker_cache.get('state')) is None:
+            return None
+        return {'opened_dt': datetime.fromisoformat(state['opened_dt']), 'failures': state['failures']}
+
+    def _is_cooling_down(self, state):
+        return state is not None and now_utc() < state['opened_dt'] + self.cooldown
+
+    @property
+    def is_open(self):
+        """Whether requests are rejected right now.
+
+        Unlike :meth:`allow_request` this never claims the probe, so it
+        can be used to decide whether to start or continue a run.
+        """
+        # once we opened the circuit during this run we don't bother probing again
+        if self._open:
+            return True
+        if (state := self.get_state()) is None:
+            return False
+        if self._is_cooling_down(state):
+            return True
+        return not self._probing and bool(get_redis_client().exists(PROBE_KEY))
+
+    def allow_request(self):
+        """Check whether a request may be sent, claiming the probe if needed.
+
+        If this returns `True` after the cooldown, the caller sends the
+        probe and must report its result using :meth:`record_success` or
+        :meth:`record_failure`.
+        """
+        with self._lock:
+            # our own probe is still running
+            if self._open or self._probing:
+                return False
+        if (state := self.get_state()) is None:
+            return True
+        if self._is_cooling_down(state):
+            return False
+        if not get_redis_client().set(PROBE_KEY, 1, nx=True, ex=self.cooldown):
+            return False
+        with self._lock:
+            self._probing = True
+        self.logger.info('Cooldown has passed, probing the calendar service')
+        return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if not self._probing:
+                return
+            self._probing = False
+        circuit_breaker_cache.delete('state')
+        get_redis_client().delete(PROBE_KEY)
+        self.logger.info('Calendar service is available again, closing circuit')
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            # a failed probe after the cooldown opens the circuit again immediately
+            if self._open or (self._failures < self.threshold and not self._probing):
+                return
+            self._open = True
+            probing, self._probing = self._probing, False
+            failures = self._failures
+        circuit_breaker_cache.set('state', {'opened_dt': now_utc().isoformat(), 'failures': failures},
+                                  timeout=self.cooldown * 10)
+        if probing:
+            get_redis_client().delete(PROBE_KEY)
+        self.logger.error('Calendar service appears to be down after %d failures, opening circuit for %s',
+                          failures, self.cooldown)
+
+
+class OutlookClient:
+    """Client for the CERN calendar service.
+
+    The underlying session keeps connections alive and is shared by all
+    threads sending calendar requests during a run.
+    """
+
+    def __init__(self, settings, breaker):
+        self.breaker = breaker
+        self.base_url = settings['service_url'].rstrip('/')
+        self.timeout = settings['timeout']
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {settings["token"]}'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['workers'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, method, path, data=None):
+        if not self.breaker.allow_request():
+            raise CircuitOpen('Calendar service is unavailable')
+        try:
+            res = self.session.request(method, self.base_url + path, json=data, timeout=self.timeout)
+        except (requests.Timeout, requests.ConnectionError):
+            self.breaker.record_failure()
+            raise
+        if res.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return res
+
+    def close(self):
+        self.session.close()
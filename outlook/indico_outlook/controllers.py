@@ -0,0 +1,32 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from secrets import compare_digest
+
+from flask import Response, request
+from werkzeug.exceptions import Forbidden, NotFound
+
+from indico.web.rh import RH
+
+from indico_outlook.metrics import render_prometheus
+
+
+class RHMetrics(RH):
+    """Expose the calendar synchronization metrics in the Prometheus format."""
+
+    # the token is not an Indico OAuth token, so we must not let the core authentication reject it
+    _DISABLE_CORE_AUTH = True
+
+    def _check_access(self):
+        from indico_outlook.plugin import OutlookPlugin
+        if not (token := OutlookPlugin.settings.get('metrics_token')):
+            raise NotFound
+        if not compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            raise Forbidden
+
+    def _process(self):
+        return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
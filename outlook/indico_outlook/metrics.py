@@ -0,0 +1,168 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+from indico.core.db import db
+from indico.util.date_time import now_utc
+
+from indico_outlook import get_redis_client
+from indico_outlook.models.queue import OutlookQueueEntry
+
+
+#: The redis hash containing the aggregated metrics
+TOTALS_KEY = 'indico-plugin-outlook:metrics'
+
+#: Upper bounds of the latency histogram buckets (in seconds)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+#: All metrics with their type and description
+METRICS = {
+    'outlook_runs_total': ('counter', 'Number of finished calendar update runs'),
+    'outlook_run_duration_seconds': ('histogram', 'Duration of calendar update runs'),
+    'outlook_phase_duration_seconds': ('histogram', 'Duration of the individual phases of a calendar update run'),
+    'outlook_last_run_timestamp_seconds': ('gauge', 'When the last calendar update run finished'),
+    'outlook_last_run_duration_seconds': ('gauge', 'Duration of the last calendar update run'),
+    'outlook_queue_entries_processed_total': ('counter', 'Number of processed queue entries by result'),
+    'outlook_category_tasks_total': ('counter', 'Number of favorite category tasks by result'),
+    'outlook_requests_total': ('counter', 'Number of calendar service requests by action and result'),
+    'outlook_request_duration_seconds': ('histogram', 'Latency of calendar service requests'),
+    'outlook_queue_entries': ('gauge', 'Number of queue entries by state'),
+    'outlook_circuit_open': ('gauge', 'Whether requests to the calendar service are currently suspended'),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(f'{k}="{v}"' for k, v in sorted(labels.items())))
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else f'{bound:g}'
+
+
+def _parse_value(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class OutlookMetrics:
+    """Collect metrics of the calendar synchronization.
+
+    Values are collected in memory (from any thread) and added to the
+    totals stored in redis when calling :meth:`flush`, so they are
+    aggregated over all processes running calendar updates.
+    """
+
+    def __init__(self):
+        self._counters = Counter()
+        self._gauges = {}
+        self._lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name + _format_labels(labels)] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[name + _format_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            for bound in (*LATENCY_BUCKETS, float('inf')):
+                if value <= bound:
+                    self._counters[f'{name}_bucket' + _format_labels(labels | {'le': _format_bound(bound)})] += 1
+            self._counters[f'{name}_sum' + _format_labels(labels)] += value
+            self._counters[f'{name}_count' + _format_labels(labels)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def flush(self):
+        """Add the collected values to the totals stored in redis."""
+        with self._lock:
+            counters, self._counters = self._counters, Counter()
+            gauges, self._gauges = self._gauges, {}
+        if not counters and not gauges:
+            return
+        # the values are incremented atomically since other processes may flush their metrics at the same time
+        with get_redis_client().pipeline() as pipe:
+            for key, value in counters.items():
+                pipe.hincrbyfloat(TOTALS_KEY, key, value)
+            if gauges:
+                pipe.hset(TOTALS_KEY, mapping=gauges)
+            pipe.execute()
+
+
+#: The metrics collected in this process
+metrics = OutlookMetrics()
+
+
+def get_totals():
+    """Get the aggregated metrics from all calendar update runs."""
+    return {key.decode(): _parse_value(value) for key, value in get_redis_client().hgetall(TOTALS_KEY).items()}
+
+
+def get_value(totals, name, **labels):
+    """Get the value of a metric with the given labels."""
+    return totals.get(name + _format_labels(labels), 0)
+
+
+def get_current_values():
+    """Get the metrics describing the current state."""
+    from indico_outlook.client import CircuitBreaker
+
+    waiting = ~OutlookQueueEntry.is_dead_letter & (OutlookQueueEntry.next_attempt_dt > now_utc())
+    due, retry, dead = db.session.query(
+        db.func.count().filter(OutlookQueueEntry.is_due()),
+        db.func.count().filter(waiting),
+        db.func.count().filter(OutlookQueueEntry.is_dead_letter),
+    ).select_from(OutlookQueueEntry).one()
+    return {
+        'outlook_queue_entries{state="due"}': due,
+        'outlook_queue_entries{state="retry"}': retry,
+        'outlook_queue_entries{state="dead"}': dead,
+        'outlook_circuit_open': int(CircuitBreaker.get_state() is not None),
+    }
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format."""
+    values = get_totals() | get_current_values()
+    lines = []
+    for name, (type_, help_) in METRICS.items():
+        samples = sorted((key, value) for key, value in values.items()
+                         if key.partition('{')[0] in {name, f'{name}_bucket', f'{name}_sum', f'{name}_count'})
+        if not samples:
+            continue
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {type_}')
+        lines.extend(f'{key} {value}' for key, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def estimate_quantile(totals, name, quantile, **labels):
+    """Estimate a quantile of a histogram from its buckets.
+
+    :return: The upper bound of the bucket containing the quantile, or
+             `None` if there are no observations.
+    """
+    if not (count := totals.get(f'{name}_count' + _format_labels(labels))):
+        return None
+    for bound in LATENCY_BUCKETS:
+        if totals.get(f'{name}_bucket' + _format_labels(labels | {'le': _format_bound(bound)}), 0) >= quantile * count:
+            return bound
+    return float('inf')
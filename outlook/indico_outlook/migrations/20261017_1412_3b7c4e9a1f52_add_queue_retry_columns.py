@@ -0,0 +1,35 @@
+"""Add queue retry columns
+
+Revision ID: 3b7c4e9a1f52
+Revises: f166c1593d5e
+Create Date: 2026-10-17 14:12:37.204519
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from indico.core.db.sqlalchemy import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7c4e9a1f52'
+down_revision = 'f166c1593d5e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('queue', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+                  schema='plugin_outlook')
+    op.alter_column('queue', 'attempts', server_default=None, schema='plugin_outlook')
+    op.add_column('queue', sa.Column('next_attempt_dt', UTCDateTime, nullable=True), schema='plugin_outlook')
+    op.add_column('queue', sa.Column('is_dead_letter', sa.Boolean(), nullable=False, server_default='false'),
+                  schema='plugin_outlook')
+    op.alter_column('queue', 'is_dead_letter', server_default=None, schema='plugin_outlook')
+    op.create_index(None, 'queue', ['next_attempt_dt'], unique=False, schema='plugin_outlook')
+
+
+def downgrade():
+    op.drop_column('queue', 'is_dead_letter', schema='plugin_outlook')
+    op.drop_column('queue', 'next_attempt_dt', schema='plugin_outlook')
+    op.drop_column('queue', 'attempts', schema='plugin_outlook')
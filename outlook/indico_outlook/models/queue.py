@@ -5,11 +5,21 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
-from indico.core.db.sqlalchemy import PyIntEnum, db
+from datetime import timedelta
+
+from sqlalchemy import tuple_
+
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime, db
+from indico.modules.categories import Category
+from indico.util.date_time import now_utc
 from indico.util.enum import IndicoIntEnum
 from indico.util.string import format_repr
 
 
+#: The maximum delay before retrying a failed queue entry
+MAX_RETRY_DELAY = timedelta(days=1)
+
+
 class OutlookAction(IndicoIntEnum):
     add = 1
     update = 2
@@ -54,6 +64,24 @@ class OutlookQueueEntry(db.Model):
         PyIntEnum(OutlookAction),
         nullable=False
     )
+    #: The number of failed attempts to process the entry
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+    #: When to try processing the entry again after a failed attempt
+    next_attempt_dt = db.Column(
+        UTCDateTime,
+        index=True,
+        nullable=True
+    )
+    #: Whether the entry failed too often and is no longer retried
+    is_dead_letter = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False
+    )
 
     #: The user associated with the queue entry
     user = db.relationship(
@@ -85,11 +113,95 @@ class OutlookQueueEntry(db.Model):
 
     def __repr__(self):
         action = OutlookAction(self.action).name
-        return format_repr(self, 'event_id', 'category_id', 'user_id', _text=action)
+        return format_repr(self, 'event_id', 'category_id', 'user_id', attempts=0, is_dead_letter=False, _text=action)
 
     @classmethod
-    def record(cls, event_or_category, user, action):
-        """Record a new calendar action."""
-        # It would be nice to delete matching records first, but this sometimes results in very weird deadlocks
+    def is_due(cls):
+        """Return a filter criterion for entries which should be processed now."""
+        return ~cls.is_dead_letter & ((cls.next_attempt_dt.is_(None)) | (cls.next_attempt_dt <= now_utc()))
+
+    def record_failure(self, retry_delay, max_attempts):
+        """Schedule the entry to be retried after a failed attempt.
+
+        The delay doubles with each failed attempt.  Once the maximum number
+        of attempts is reached, the entry is no longer retried.
+        """
+        self.attempts += 1
+        if self.attempts >= max_attempts:
+            self.is_dead_letter = True
+            self.next_attempt_dt = None
+        else:
+            self.next_attempt_dt = now_utc() + min(retry_delay * 2 ** (self.attempts - 1), MAX_RETRY_DELAY)
+
+    @classmethod
+    def record(cls, event_or_category, user, action, *, coalesce=False):
+        """Record a new calendar action.
+
+        :param coalesce: Whether to delete older entries with the same action
+                         for the same user and event/category.  This keeps
+                         only the latest entry of each action in its original
+                         order, just like the queue processing does.
+        """
+        if coalesce:
+            cls._delete_older(event_or_category, user, action)
         event_or_category.outlook_queue_entries.append(cls(user=user, action=action))
         db.session.flush()
+
+    @classmethod
+    def reserve_ids(cls, count):
+        """Reserve IDs for queue entries which are recorded later.
+
+        Entries are processed in the order of their IDs, so reserving them
+        when a change happens keeps that order even if the entries are only
+        added to the queue later on (e.g. in a background task).
+
+        :return: A sorted list of `count` unused IDs.
+        """
+        seq = db.func.pg_get_serial_sequence(cls.__table__.fullname, 'id')
+        query = db.select(db.func.nextval(seq)).select_from(db.func.generate_series(1, count))
+        return sorted(db.session.execute(query).scalars())
+
+    @classmethod
+    def record_many(cls, entries, *, coalesce=False):
+        """Record many calendar actions for events at once.
+
+        All entries are inserted using a single ``INSERT`` statement.
+
+        :param entries: A list of dicts containing the `event_id`, `user_id`
+                        and `action` of each entry, in the order in which
+                        they should be processed.  They may also contain
+                        an `id` obtained from :meth:`reserve_ids`.
+        :param coalesce: Whether to delete older entries with the same action
+                         for the same user and event (see :meth:`record`).
+        """
+        if not entries:
+            return
+        if coalesce:
+            keys = {(entry['event_id'], entry['user_id'], entry['action']) for entry in entries}
+            user_keys = {key for key in keys if key[1] is not None}
+            event_keys = {(event_id, action) for event_id, user_id, action in keys if user_id is None}
+            criteria = []
+            if user_keys:
+                criteria.append(tuple_(cls.event_id, cls.user_id, cls.action).in_(user_keys))
+            if event_keys:
+                criteria.append(cls.user_id.is_(None) & tuple_(cls.event_id, cls.action).in_(event_keys))
+            # see _delete_older for why we skip locked rows
+            older = db.select(cls.id).where(db.or_(*criteria)).with_for_update(skip_locked=True)
+            if ids := [entry['id'] for entry in entries if 'id' in entry]:
+                # entries with higher IDs were reserved for later changes and thus must be kept
+                older = older.where(cls.id < min(ids))
+            cls.query.filter(cls.id.in_(older)).delete(synchronize_session=False)
+        db.session.execute(cls.__table__.insert().values(entries))
+
+    @classmethod
+    def _delete_older(cls, event_or_category, user, action):
+        # Simply deleting matching records sometimes results in very weird deadlocks, so we skip
+        # any rows locked by another transaction (e.g. while the queue is being processed). This
+        # never waits for a lock, and anything we skip is still deduplicated during processing.
+        column = cls.category_id if isinstance(event_or_category, Category) else cls.event_id
+        older = (db.select(cls.id)
+                 .where(column == event_or_category.id,
+                        cls.user_id == user.id if user is not None else cls.user_id.is_(None),
+                        cls.action == action)
+                 .with_for_update(skip_locked=True))
+        cls.query.filter(cls.id.in_(older)).delete(synchronize_session=False)
@@ -5,7 +5,6 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
-from collections import defaultdict
 from datetime import timedelta
 
 from flask import g
@@ -13,7 +12,6 @@ from wtforms.fields import BooleanField, FloatField, IntegerField, SelectField,
 from wtforms.fields.simple import StringField
 from wtforms.validators import URL, DataRequired, InputRequired, NumberRange
 
-from indico.cli.core import cli_command
 from indico.core import signals
 from indico.core.plugins import IndicoPlugin
 from indico.core.settings.converters import TimedeltaConverter
@@ -25,11 +23,11 @@ from indico.web.forms.fields import IndicoPasswordField, MultipleItemsField, Tim
 from indico.web.forms.validators import HiddenUnless
 from indico.web.forms.widgets import SwitchWidget
 
-from indico_outlook import _
-from indico_outlook.calendar import update_calendar
+from indico_outlook import _, record_changes
+from indico_outlook.blueprint import blueprint
+from indico_outlook.cli import cli
 from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
-from indico_outlook.util import (is_event_excluded, is_user_cat_favorite, is_user_favorite, is_user_registered,
-                                 latest_actions_only)
+from indico_outlook.util import clear_visible_category_cache
 
 
 _status_choices = [('free', _('Free')),
@@ -57,6 +55,38 @@ class SettingsForm(IndicoForm):
                                     description=_('Last event ID before switching to new calendar item ID format. '
                                                   'Set to -1 to keep the old format for all calendar items.'))
     timeout = FloatField(_('Request timeout'), [NumberRange(min=0.25)], description=_('Request timeout in seconds'))
+    queue_chunk_size = IntegerField(_('Queue chunk size'), [InputRequired(), NumberRange(min=1)],
+                                    description=_('The number of user/event combinations processed at once. The '
+                                                  'processed queue entries are deleted after each chunk.'))
+    max_run_time = TimeDeltaField(_('Maximum run time'), [DataRequired()], units=('minutes',),
+                                  description=_('No new chunks of the queue are processed once a run took longer '
+                                                'than this. It should be shorter than the interval between runs.'))
+    imminent_horizon = TimeDeltaField(_('Imminent events'), [DataRequired()], units=('hours', 'days'),
+                                      description=_('Changes to events starting within this time are processed '
+                                                    'first and checked every minute instead of every 15 minutes.'))
+    retry_delay = TimeDeltaField(_('Retry delay'), [DataRequired()], units=('minutes', 'hours'),
+                                 description=_('How long to wait before retrying a failed queue entry. The delay '
+                                               'doubles with each failed attempt.'))
+    max_attempts = IntegerField(_('Maximum attempts'), [InputRequired(), NumberRange(min=1)],
+                                description=_('Queue entries which failed this many times are no longer retried'))
+    circuit_breaker_threshold = IntegerField(
+        _('Failure threshold'), [InputRequired(), NumberRange(min=1)],
+        description=_('Stop sending requests after this many consecutive timeouts or server errors, since the '
+                      'calendar service is most likely down')
+    )
+    circuit_breaker_cooldown = TimeDeltaField(
+        _('Failure cooldown'), [DataRequired()], units=('minutes', 'hours'),
+        description=_('How long to wait before trying to send requests again after the calendar service went down. '
+                      'Use "indico outlook status" to check whether the service is considered down.')
+    )
+    metrics_token = IndicoPasswordField(_('Metrics token'), toggle=True,
+                                        description=_('The token needed to access the metrics endpoint. If empty, '
+                                                      'the metrics are not available via HTTP.'))
+    coalesce_queue = BooleanField(_('Coalesce queue'), widget=SwitchWidget(),
+                                  description=_('Remove older queue entries with the same action for the same '
+                                                'event and user when recording a change'))
+    workers = IntegerField(_('Concurrent requests'), [InputRequired(), NumberRange(min=1)],
+                           description=_('The number of requests sent to the calendar service in parallel'))
     max_event_duration = TimeDeltaField(_('Maximum Duration'), [DataRequired()], units=('days',),
                                         description=_('Events lasting longer will not be sent to Exchange'))
     max_category_events = IntegerField(
@@ -189,16 +219,30 @@ class OutlookPlugin(IndicoPlugin):
         'id_prefix': 'indico_',
         'event_id_cutoff': -1,
         'timeout': 3,
+        'workers': 10,
+        'queue_chunk_size': 500,
+        'max_run_time': timedelta(minutes=10),
+        'imminent_horizon': timedelta(days=1),
+        'retry_delay': timedelta(minutes=15),
+        'max_attempts': 8,
+        'circuit_breaker_threshold': 10,
+        'circuit_breaker_cooldown': timedelta(minutes=5),
+        'coalesce_queue': True,
+        'metrics_token': None,
         'max_event_duration': timedelta(days=30),
         'max_category_events': 1000,
         'max_accessible_category_events': 100,
     }
     settings_converters = {
-        'max_event_duration': TimedeltaConverter
+        'max_event_duration': TimedeltaConverter,
+        'max_run_time': TimedeltaConverter,
+        'imminent_horizon': TimedeltaConverter,
+        'retry_delay': TimedeltaConverter,
+        'circuit_breaker_cooldown': TimedeltaConverter,
     }
     default_user_settings = {
-        'enabled': True,  # XXX: if the default value ever changes, adapt `_query_registered_users`
-        'registered': True,  # XXX: if the default value ever changes, adapt `_query_registered_users`
+        'enabled': True,  # XXX: if the default value ever changes, adapt the `_has_user_setting` filters
+        'registered': True,  # XXX: if the default value ever changes, adapt `_query_registrations`
         'favorite_events': True,  # XXX: if the default value ever changes, adapt `_query_favorite_users`
         'favorite_categories': False,
         'status': None,
@@ -219,19 +263,21 @@ class OutlookPlugin(IndicoPlugin):
         self.connect(signals.event.created, self.event_created)
         self.connect(signals.event.restored, self.event_created)
         self.connect(signals.event.deleted, self.event_deleted)
-        self.connect(signals.core.after_process, self._apply_changes)
+        self.connect(signals.core.after_process, self._reserve_queue_ids)
+        self.connect(signals.core.after_commit, self._apply_changes)
         self.connect(signals.users.merged, self._merge_users)
         self.connect(signals.users.favorite_event_added, self.favorite_event_added)
         self.connect(signals.users.favorite_event_removed, self.favorite_event_removed)
         self.connect(signals.users.favorite_category_added, self.favorite_category_added)
         self.connect(signals.users.favorite_category_removed, self.favorite_category_removed)
+        self.connect(signals.category.moved, self._category_tree_changed)
+        self.connect(signals.category.updated, self._category_updated)
 
     def _extend_indico_cli(self, sender, **kwargs):
-        @cli_command()
-        def outlook():
-            """Synchronizes Outlook calendars."""
-            update_calendar()
-        return outlook
+        return cli
+
+    def get_blueprints(self):
+        return blueprint
 
     def extend_user_preferences(self, user, **kwargs):
         return OutlookUserPreferences
@@ -257,6 +303,13 @@ class OutlookPlugin(IndicoPlugin):
         self.logger.info('Favorite event removed: removing %s in %r', user, event)
         self._record_change(event, user, OutlookAction.remove)
 
+    def _category_tree_changed(self, category, **kwargs):
+        clear_visible_category_cache()
+
+    def _category_updated(self, category, changes, **kwargs):
+        if 'visibility' in changes:
+            clear_visible_category_cache()
+
     def favorite_category_added(self, user, category, **kwargs):
         if not self._user_tracks_favorite_categories(user):
             return
@@ -299,9 +352,6 @@ class OutlookPlugin(IndicoPlugin):
             self.logger.info('Registration removed (form deleted): removing %s in %s', registration.user, event)
             self._record_change(event, registration.user, OutlookAction.remove)
 
-    def _is_event_not_happening(self, event):
-        return event.label is not None and event.label.is_event_not_happening
-
     def event_location_changed(self, obj_type, obj, changes, **kwargs):
         # this is a bit of a hack because we do not receive full location_data in this signal,
         # but since `event_updated` does not care about the actual change to the data we can
@@ -359,43 +409,31 @@ class OutlookPlugin(IndicoPlugin):
         # category changes are limited to adding/removing favorite categories, so these
         # signals are called exactly one during a request so we do not need to do any
         # queueing until the end of the request
-        OutlookQueueEntry.record(category, user, action)
+        OutlookQueueEntry.record(category, user, action, coalesce=self.settings.get('coalesce_queue'))
 
     def _record_change(self, event, user, action, *, force_remove=False):
-        if is_event_excluded(event, self.logger):
-            return
         if 'outlook_changes' not in g:
             g.outlook_changes = []
-
-        if action == OutlookAction.remove and not force_remove and user is not None:
-            # Only remove an event if the user *really* shouldn't have it in their calendar
-            if is_user_registered(event, user):
-                self.logger.debug('Ignoring remove for %r; user is registered', user)
-                return
-            if is_user_favorite(event, user):
-                self.logger.debug('Ignoring remove for %r; event is favorite', user)
-                return
-            if is_user_cat_favorite(event, user):
-                self.logger.debug('Ignoring remove for %r; event is cat favorite', user)
-                return
-
-        g.outlook_changes.append((event, user, action))
+        # Only remove an event if the user *really* shouldn't have it in their calendar; like any
+        # other (more expensive) checks this is done when the changes are added to the queue
+        check = action == OutlookAction.remove and not force_remove and user is not None
+        g.outlook_changes.append((event.id, user.id if user else None, int(action), check))
+
+    def _reserve_queue_ids(self, sender, **kwargs):
+        # the changes are added to the queue in a background task, and tasks of different requests may
+        # run in any order. reserving the IDs of their queue entries during the request keeps them in the
+        # order of the requests
+        if changes := g.get('outlook_changes'):
+            g.outlook_queue_ids = OutlookQueueEntry.reserve_ids(len(changes))
 
     def _apply_changes(self, sender, **kwargs):
-        # we are using after_request to avoid unnecessary db deletes+inserts for the same entry since
-        # especially event_data_changes is often triggered more than once e.g. for most date changes
-        if 'outlook_changes' not in g:
+        # we are collecting changes until the end of the request to avoid unnecessary db deletes+inserts
+        # for the same entry since especially event_data_changes is often triggered more than once e.g. for
+        # most date changes. adding them to the queue happens in a background task once they have been
+        # committed, so requests with many changes (e.g. bulk registration imports) are not slowed down by it
+        if 'outlook_queue_ids' not in g:
             return
-        user_events = defaultdict(list)
-        for event, user, action in g.outlook_changes:
-            user_events[(user, event)].append(action)
-        for (user, event), data in user_events.items():
-            for action in latest_actions_only(data):
-                if action != OutlookAction.remove and self._is_event_not_happening(event):
-                    self.logger.debug(f'Event cancelled via label, ignoring {action.name}')  # noqa: G004
-                    # ignore additions/updates when the event is not happening
-                    continue
-                OutlookQueueEntry.record(event, user, action)
+        record_changes.delay(g.pop('outlook_changes'), g.pop('outlook_queue_ids'))
 
     def _merge_users(self, target, source, **kwargs):
         OutlookQueueEntry.query.filter_by(user_id=source.id).update({OutlookQueueEntry.user_id: target.id})
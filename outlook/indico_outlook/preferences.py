@@ -0,0 +1,97 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from dataclasses import dataclass, field
+
+from indico.modules.users import UserSetting
+
+
+_preference_names = ('enabled', 'status', 'reminder', 'reminder_minutes', 'overrides')
+
+
+@dataclass
+class _Preferences:
+    enabled: bool
+    status: str
+    reminder: bool
+    reminder_minutes: int
+    #: category ID -> (status, reminder, reminder_minutes) for single-category overrides
+    category_overrides: dict = field(default_factory=dict)
+    #: category ID -> (position, (status, reminder, reminder_minutes)) for category tree overrides
+    tree_overrides: dict = field(default_factory=dict)
+
+    def resolve(self, event):
+        """Get the (status, reminder, reminder_minutes) to use for an event."""
+        # a specific category id match always wins
+        if (override := self.category_overrides.get(event.category_id)) is not None:
+            return override
+        # for category tree matches the last matching override wins; we don't try to see which
+        # one is more specific because that'd be overkill!
+        matches = [self.tree_overrides[id_] for id_ in event.category_chain if id_ in self.tree_overrides]
+        if matches:
+            return max(matches)[1]
+        return self.status, self.reminder, self.reminder_minutes
+
+
+class OutlookPreferences:
+    """Snapshot of the Outlook preferences of users.
+
+    The settings of many users are loaded at once and category overrides
+    are compiled into lookup tables, so getting the preferences for a
+    calendar entry does not need any database queries.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._preferences = {}
+
+    def load(self, user_ids):
+        """Load the preferences of the given users unless already loaded."""
+        from indico_outlook.plugin import OutlookPlugin
+        if not (user_ids := set(user_ids) - self._preferences.keys()):
+            return
+        values = {user_id: {} for user_id in user_ids}
+        query = UserSetting.query.filter(UserSetting.module == 'plugin_outlook',
+                                         UserSetting.name.in_(_preference_names),
+                                         UserSetting.user_id.in_(user_ids))
+        for setting in query:
+            values[setting.user_id][setting.name] = setting.value
+        defaults = OutlookPlugin.default_user_settings
+        for user_id, user_values in values.items():
+            self._preferences[user_id] = self._compile(
+                enabled=user_values.get('enabled', defaults['enabled']),
+                # for these settings the global plugin settings take precedence over the user defaults
+                status=user_values.get('status', self.settings['status']),
+                reminder=user_values.get('reminder', self.settings['reminder']),
+                reminder_minutes=user_values.get('reminder_minutes', self.settings['reminder_minutes']),
+                overrides=user_values.get('overrides', defaults['overrides']),
+            )
+
+    def _compile(self, overrides, **kwargs):
+        prefs = _Preferences(**kwargs)
+        for pos, override in enumerate(overrides):
+            value = (override['status'],
+                     override.get('reminder', prefs.reminder),
+                     override.get('reminder_minutes', prefs.reminder_minutes))
+            if override['type'] == 'category':
+                # only the first override for a specific category is ever used
+                prefs.category_overrides.setdefault(override['id'], value)
+            elif override['type'] == 'category_tree':
+                prefs.tree_overrides[override['id']] = (pos, value)
+        return prefs
+
+    def _get(self, user):
+        self.load({user.id})
+        return self._preferences[user.id]
+
+    def is_enabled(self, user):
+        """Check whether the user enabled calendar entries."""
+        return self._get(user).enabled
+
+    def get_entry_settings(self, user, event):
+        """Get the (status, reminder, reminder_minutes) for a user's calendar entry."""
+        return self._get(user).resolve(event)
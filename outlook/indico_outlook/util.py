@@ -5,17 +5,34 @@
 # them and/or modify them under the terms of the MIT License; see
 # the LICENSE file for more details.
 
-from sqlalchemy.orm import joinedload
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import tuple_
 
 from indico.cli.event import User
+from indico.core import signals
 from indico.core.db import db
+from indico.core.db.sqlalchemy.protection import ProtectionMode
+from indico.modules.events import Event
 from indico.modules.events.registration.models.forms import RegistrationForm
 from indico.modules.events.registration.models.registrations import Registration
 from indico.modules.users import UserSetting
-from indico.modules.users.models.favorites import favorite_event_table
+from indico.modules.users.models.favorites import favorite_category_table, favorite_event_table
 from indico.util.date_time import now_utc
 
 from indico_outlook.models.entry import OutlookCalendarEntry
+from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
+
+
+#: How long the visible categories of events are cached.  Changes to the
+#: category tree only clear the cache in the process where they happened,
+#: so this limits how long other processes may use outdated categories.
+VISIBLE_CATEGORIES_TTL = timedelta(minutes=10)
+
+#: (category ID, event visibility) -> (expiry, visible category IDs)
+_visible_category_ids = {}
 
 
 def check_config():
@@ -40,117 +57,219 @@ def is_event_excluded(event, logger=None):
     return False
 
 
-def _query_registered_users(event):
-    return (Registration.query
-            .filter(Registration.is_active,
-                    ~RegistrationForm.is_deleted,
-                    Registration.user_id.isnot(None),
-                    RegistrationForm.event_id == event.id)
-            .filter(~UserSetting.query
-                    .filter(UserSetting.user_id == Registration.user_id,
-                            UserSetting.module == 'plugin_outlook',
-                            UserSetting.name == 'enabled',
-                            UserSetting.value == db.func.to_jsonb(False))
-                    .correlate(Registration)
-                    .exists())
-            .filter(~UserSetting.query
-                    .filter(UserSetting.user_id == Registration.user_id,
-                            UserSetting.module == 'plugin_outlook',
-                            UserSetting.name == 'registered',
-                            UserSetting.value == db.func.to_jsonb(False))
-                    .correlate(Registration)
-                    .exists())
-            .join(Registration.registration_form)
-            .options(joinedload(Registration.user)))
-
-
-def is_user_registered(event, user):
-    """Check if the user is registered in the event and wants it in their calendar."""
-    return _query_registered_users(event).filter(Registration.user == user).has_rows()
-
-
-def get_registered_users(event):
-    """Return participating users of an event who did not disable calendar updates."""
-    return {reg.user for reg in _query_registered_users(event)}
-
-
-def _query_favorite_users(event):
-    return (User.query
-            .join(favorite_event_table, favorite_event_table.c.user_id == User.id)
-            .filter(favorite_event_table.c.target_id == event.id)
-            .filter(~UserSetting.query
-                    .filter(UserSetting.user_id == User.id,
-                            UserSetting.module == 'plugin_outlook',
-                            UserSetting.name == 'enabled',
-                            UserSetting.value == db.func.to_jsonb(False))
-                    .correlate(User)
-                    .exists())
-            .filter(~UserSetting.query
-                    .filter(UserSetting.user_id == User.id,
-                            UserSetting.module == 'plugin_outlook',
-                            UserSetting.name == 'favorite_events',
-                            UserSetting.value == db.func.to_jsonb(False))
-                    .correlate(User)
-                    .exists()))
-
-
-def is_user_favorite(event, user):
-    """Check if the user favorited the event and wants it in their calendar."""
-    return _query_favorite_users(event).filter(User.id == user.id).has_rows()
-
-
-def get_favorite_users(event):
-    """Return users who favorited an event and did not disable calendar updates."""
-    return set(_query_favorite_users(event))
-
-
-def _iter_visible_categories(event):
+def is_event_not_happening(event):
+    """Check if an event is labelled as not happening (e.g. cancelled)"""
+    return event.label is not None and event.label.is_event_not_happening
+
+
+def _has_user_setting(user_id, correlate, name, value):
+    return (UserSetting.query
+            .filter(UserSetting.user_id == user_id,
+                    UserSetting.module == 'plugin_outlook',
+                    UserSetting.name == name,
+                    UserSetting.value == db.func.to_jsonb(value))
+            .correlate(correlate)
+            .exists())
+
+
+def _query_registrations(event=None):
+    query = (Registration.query
+             .filter(Registration.is_active,
+                     ~RegistrationForm.is_deleted,
+                     Registration.user_id.isnot(None))
+             .filter(~_has_user_setting(Registration.user_id, Registration, 'enabled', False))
+             .filter(~_has_user_setting(Registration.user_id, Registration, 'registered', False))
+             .join(Registration.registration_form))
+    if event is not None:
+        query = query.filter(RegistrationForm.event_id == event.id)
+    return query
+
+
+def _query_favorite_users(event=None):
+    query = (User.query
+             .join(favorite_event_table, favorite_event_table.c.user_id == User.id)
+             .filter(~_has_user_setting(User.id, User, 'enabled', False))
+             .filter(~_has_user_setting(User.id, User, 'favorite_events', False)))
+    if event is not None:
+        query = query.filter(favorite_event_table.c.target_id == event.id)
+    return query
+
+
+def get_visible_category_ids(event):
+    """Get the IDs of the categories in which an event is visible.
+
+    This only depends on the category and visibility of the event, so the
+    result is cached in the current process until the category tree changes.
+    """
     if event.visibility == 0:
-        return
+        return frozenset()
+    key = (event.category_id, event.visibility)
+    now = time.monotonic()
+    if (cached := _visible_category_ids.get(key)) is not None and cached[0] > now:
+        return cached[1]
+    category_ids = set()
     horizon = event.category.real_visibility_horizon
     for i, cat in enumerate(reversed(event.category.chain_query.all()), 1):
-        yield cat
+        category_ids.add(cat.id)
         # Stop if we reach the visibility horizon of the event
         if i == event.visibility:
-            return
+            break
         # Stop if we reach the visibility horizon of the category
         if cat == horizon:
-            return
+            break
+    category_ids = frozenset(category_ids)
+    _visible_category_ids[key] = (now + VISIBLE_CATEGORIES_TTL.total_seconds(), category_ids)
+    return category_ids
 
 
-def is_user_cat_favorite(event, user):
-    """Check if the event is in a favorite category of the user and tracks favorite categories."""
-    from indico_outlook.plugin import OutlookPlugin
-    if not OutlookPlugin.user_settings.get(user, 'favorite_categories'):
-        return False
-    if event.is_unlisted:
-        return False
-    return any(cat in user.favorite_categories for cat in _iter_visible_categories(event))
+def clear_visible_category_cache():
+    """Clear the cached visible categories after a change in the category tree."""
+    _visible_category_ids.clear()
 
 
-def get_cat_favorite_users(event):
-    """Return users who have the event in a favorite category and did not disable calendar updates."""
-    from indico_outlook.plugin import OutlookPlugin
-    plugin = OutlookPlugin.instance
-    if event.is_unlisted:
-        return set()
-    return {
-        user
-        for cat in _iter_visible_categories(event)
-        for user in cat.favorite_of
-        if plugin._user_tracks_favorite_categories(user) and event.can_access(user, allow_admin=False)
-    }
-
-
-def get_users_to_add(event):
-    """Get users who should have the event in their calendar but currently don't have it."""
-    users_to_add = set()
-    users_to_add |= get_registered_users(event)
-    users_to_add |= get_favorite_users(event)
-    users_to_add |= get_cat_favorite_users(event)
-    # Skip users who already have calendar entries
-    existing_users = {x.user for x in event.outlook_calendar_entries.options(joinedload(OutlookCalendarEntry.user))}
-    return users_to_add - existing_users
+def _query_cat_favorite_user_ids(category_ids, user_ids=None):
+    user_id = favorite_category_table.c.user_id
+    query = (db.session.query(user_id)
+             .filter(favorite_category_table.c.target_id.in_(category_ids))
+             .filter(~_has_user_setting(user_id, favorite_category_table, 'enabled', False))
+             # XXX: tracking favorite categories is disabled by default
+             .filter(_has_user_setting(user_id, favorite_category_table, 'favorite_categories', True)))
+    if user_ids is not None:
+        query = query.filter(user_id.in_(user_ids))
+    return query
+
+
+def can_skip_access_check(event):
+    """Check whether everyone can access an event without checking each user."""
+    # public events are accessible by everyone, unless a plugin restricts access
+    return (event.effective_protection_mode == ProtectionMode.public
+            and not signals.acl.can_access.has_receivers_for(type(event)))
+
+
+def get_calendar_users(event, *, skip_existing=False):
+    """Get users who should have the event in their calendar.
+
+    This resolves registered users, users who favorited the event and users
+    who have it in a favorite category (including their opt-out settings) in
+    a few queries.  Only category favorites of protected events need to be
+    checked in Python, since their access cannot be checked in SQL.
+
+    :param skip_existing: Whether to exclude users who already have a
+                          calendar entry for the event.
+    """
+    registered = _query_registrations(event).with_entities(Registration.user_id)
+    favorite = _query_favorite_users(event).with_entities(User.id)
+    existing = db.session.query(OutlookCalendarEntry.user_id).filter(OutlookCalendarEntry.event_id == event.id)
+    query = User.query.filter(db.or_(User.id.in_(registered), User.id.in_(favorite)))
+    if skip_existing:
+        query = query.filter(~User.id.in_(existing))
+    users = set(query)
+    if event.is_unlisted or not (category_ids := get_visible_category_ids(event)):
+        return users
+    cat_query = User.query.filter(User.id.in_(_query_cat_favorite_user_ids(category_ids)),
+                                  ~User.id.in_(registered),
+                                  ~User.id.in_(favorite))
+    if skip_existing:
+        cat_query = cat_query.filter(~User.id.in_(existing))
+    if can_skip_access_check(event):
+        users.update(cat_query)
+    else:
+        users.update(user for user in cat_query if event.can_access(user, allow_admin=False))
+    return users
+
+
+def get_calendar_entries(events):
+    """Get the (user_id, event_id) pairs of everyone who should have the events in their calendar.
+
+    This is the bulk version of :func:`get_calendar_users`, which needs
+    the same number of queries regardless of the number of events.
+    Only category favorites of protected events are checked in Python.
+    Events which are not happening should not be in anyone's calendar.
+    """
+    events = {event.id: event for event in events if not is_event_not_happening(event)}
+    registered = (_query_registrations()
+                  .filter(RegistrationForm.event_id.in_(events))
+                  .with_entities(Registration.user_id, RegistrationForm.event_id))
+    favorite = (_query_favorite_users()
+                .filter(favorite_event_table.c.target_id.in_(events))
+                .with_entities(User.id, favorite_event_table.c.target_id))
+    entries = {tuple(row) for row in registered.union(favorite)}
+    event_categories = {event.id: get_visible_category_ids(event)
+                        for event in events.values()
+                        if not event.is_unlisted}
+    category_ids = {cat_id for cat_ids in event_categories.values() for cat_id in cat_ids}
+    if not category_ids:
+        return entries
+    category_users = defaultdict(set)
+    query = (_query_cat_favorite_user_ids(category_ids)
+             .add_columns(favorite_category_table.c.target_id))
+    for user_id, category_id in query:
+        category_users[category_id].add(user_id)
+    users = {}
+    for event_id, cat_ids in event_categories.items():
+        event = events[event_id]
+        user_ids = {user_id for cat_id in cat_ids for user_id in category_users[cat_id]}
+        user_ids -= {user_id for user_id in user_ids if (user_id, event_id) in entries}
+        if not user_ids:
+            continue
+        if not can_skip_access_check(event):
+            if missing := user_ids - users.keys():
+                users.update((user.id, user) for user in User.query.filter(User.id.in_(missing)))
+            user_ids = {user_id for user_id in user_ids if event.can_access(users[user_id], allow_admin=False)}
+        entries.update((user_id, event_id) for user_id in user_ids)
+    return entries
+
+
+def get_existing_calendar_entries(events):
+    """Get the (user_id, event_id) pairs of the existing calendar entries of events.
+
+    Entries of users who disabled calendar updates are skipped, since
+    they are neither updated nor removed anymore.
+    """
+    query = (db.session.query(OutlookCalendarEntry.user_id, OutlookCalendarEntry.event_id)
+             .filter(OutlookCalendarEntry.event_id.in_({event.id for event in events}),
+                     ~_has_user_setting(OutlookCalendarEntry.user_id, OutlookCalendarEntry, 'enabled', False)))
+    return {tuple(row) for row in query}
+
+
+def get_calendar_reasons(pairs):
+    """Get why users should (still) have events in their calendar.
+
+    This checks the same conditions as :func:`get_calendar_users` (i.e.
+    the queries built by :func:`_query_registrations`,
+    :func:`_query_favorite_users` and :func:`_query_cat_favorite_user_ids`)
+    for many events and users in a single round of queries.
+
+    :param pairs: An iterable of ``(event, user)`` tuples.
+    :return: A dict mapping the ``(event, user)`` tuples of users who
+             should have the event in their calendar to the reason
+             (``'registered'``, ``'favorite'`` or ``'cat favorite'``).
+    """
+    pairs = {(event.id, user.id): (event, user) for event, user in pairs}
+    if not pairs:
+        return {}
+    reasons = {}
+    registered = (_query_registrations()
+                  .filter(tuple_(RegistrationForm.event_id, Registration.user_id).in_(pairs))
+                  .with_entities(RegistrationForm.event_id, Registration.user_id))
+    reasons.update((tuple(key), 'registered') for key in registered)
+    favorite = (_query_favorite_users()
+                .filter(tuple_(favorite_event_table.c.target_id, User.id).in_(pairs.keys() - reasons.keys()))
+                .with_entities(favorite_event_table.c.target_id, User.id))
+    reasons.update((tuple(key), 'favorite') for key in favorite)
+    event_categories = {key: get_visible_category_ids(event)
+                        for key, (event, __) in pairs.items()
+                        if key not in reasons and not event.is_unlisted}
+    if category_ids := {cat_id for cat_ids in event_categories.values() for cat_id in cat_ids}:
+        user_ids = {user_id for __, user_id in event_categories}
+        query = (_query_cat_favorite_user_ids(category_ids, user_ids)
+                 .add_columns(favorite_category_table.c.target_id))
+        user_categories = defaultdict(set)
+        for user_id, category_id in query:
+            user_categories[user_id].add(category_id)
+        reasons.update((key, 'cat favorite') for key, cat_ids in event_categories.items()
+                       if user_categories[key[1]].intersection(cat_ids))
+    return {pairs[key]: reason for key, reason in reasons.items()}
 
 
 def latest_actions_only(items):
@@ -162,3 +281,44 @@ def latest_actions_only(items):
             res.append(item)
             used.add(item)
     return reversed(res)
+
+
+def record_queue_entries(changes, ids):
+    """Add the calendar changes recorded during a request to the queue.
+
+    :param changes: A list of ``(event_id, user_id, action, check)`` tuples
+                    in the order they were recorded.  `check` indicates a
+                    removal which is ignored if the user should still have
+                    the event in their calendar.
+    :param ids: The queue entry IDs reserved for the changes, which keep
+                them in order with the changes from other requests.
+    """
+    from indico_outlook.plugin import OutlookPlugin
+    logger = OutlookPlugin.logger
+    events = Event.query.filter(Event.id.in_({event_id for event_id, __, __, __ in changes})).all()
+    events = {event.id: event for event in events if not is_event_excluded(event, logger)}
+    users = User.query.filter(User.id.in_({user_id for __, user_id, __, __ in changes if user_id is not None})).all()
+    users = {user.id: user for user in users}
+    reasons = get_calendar_reasons((events[event_id], users[user_id])
+                                   for event_id, user_id, __, check in changes
+                                   if check and event_id in events and user_id in users)
+    user_events = defaultdict(list)
+    for event_id, user_id, action, check in changes:
+        if (event := events.get(event_id)) is None or (user_id is not None and user_id not in users):
+            continue
+        if check and (reason := reasons.get((event, users[user_id]))):
+            logger.debug('Ignoring remove for %r; %s', users[user_id], reason)
+            continue
+        user_events[(user_id, event)].append(OutlookAction(action))
+    entries = []
+    for (user_id, event), actions in user_events.items():
+        for action in latest_actions_only(actions):
+            if action != OutlookAction.remove and is_event_not_happening(event):
+                logger.debug('Event cancelled via label, ignoring %s', action.name)
+                # ignore additions/updates when the event is not happening
+                continue
+            entries.append({'event_id': event.id, 'user_id': user_id, 'action': action})
+    for entry, id_ in zip(entries, ids, strict=False):
+        entry['id'] = id_
+    OutlookQueueEntry.record_many(entries, coalesce=OutlookPlugin.settings.get('coalesce_queue'))
+    db.session.commit()
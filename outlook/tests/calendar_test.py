@@ -0,0 +1,130 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import threading
+from datetime import timedelta
+
+import pytest
+
+from indico.modules.events.forms import EventLabel
+from indico.util.date_time import now_utc
+
+from indico_outlook import (IMMINENT_UPDATE_SCHEDULE, UPDATE_SCHEDULE, category_task_cache, get_redis_client,
+                            process_favorite_category, redis_lock)
+from indico_outlook.calendar import (CalendarDispatcher, _process_favorite_categories, reconcile_calendars,
+                                     update_calendar)
+from indico_outlook.client import CircuitBreaker
+from indico_outlook.models.entry import OutlookCalendarEntry
+from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
+from indico_outlook.plugin import OutlookPlugin
+
+
+@pytest.fixture
+def update_mocks(db, mocker):
+    mocker.patch('indico_outlook.calendar.check_config', return_value=True)
+    full = mocker.patch('indico_outlook.calendar._update_all_events')
+    imminent = mocker.patch('indico_outlook.calendar._update_imminent_events')
+    return full, imminent
+
+
+@pytest.fixture
+def run_args(db):
+    settings = OutlookPlugin.settings.get_all()
+    return settings, OutlookPlugin.logger, CircuitBreaker(settings, OutlookPlugin.logger)
+
+
+def test_redis_lock(app):
+    with redis_lock('test', timedelta(seconds=10)) as locked:
+        assert locked
+        with redis_lock('test', timedelta(seconds=10), wait=timedelta(0)) as locked_again:
+            assert not locked_again
+    with redis_lock('test', timedelta(seconds=10), wait=timedelta(0)) as locked:
+        assert locked
+
+
+def test_update_calendar(update_mocks):
+    full, imminent = update_mocks
+    update_calendar()
+    assert full.call_count == 1
+    update_calendar(imminent_only=True)
+    assert imminent.call_count == 1
+    # the lock is released after each run
+    update_calendar()
+    assert full.call_count == 2
+
+
+def test_update_calendar_no_overlap(update_mocks):
+    full, imminent = update_mocks
+    full.side_effect = lambda *args: update_calendar(imminent_only=True)
+    update_calendar()
+    assert full.call_count == 1
+    assert imminent.call_count == 0
+    update_calendar(imminent_only=True)
+    assert imminent.call_count == 1
+
+
+def test_update_schedules():
+    # an imminent-only run never starts together with a full run
+    assert UPDATE_SCHEDULE.minute.isdisjoint(IMMINENT_UPDATE_SCHEDULE.minute)
+    assert UPDATE_SCHEDULE.minute | IMMINENT_UPDATE_SCHEDULE.minute == set(range(60))
+
+
+def test_update_calendar_waits_for_imminent_run(update_mocks):
+    full = update_mocks[0]
+    # an imminent-only run which is still running when a full run starts
+    lock = get_redis_client().lock('indico-plugin-outlook:update', timeout=10, thread_local=False)
+    assert lock.acquire(blocking=False)
+    threading.Timer(0.5, lock.release).start()
+    update_calendar()
+    assert full.call_count == 1
+
+
+@pytest.mark.parametrize('in_progress', (False, True))
+def test_favorite_category_add_remove(mocker, run_args, dummy_event, dummy_user, in_progress):
+    delay = mocker.patch.object(process_favorite_category, 'delay')
+    OutlookQueueEntry.record(dummy_event.category, dummy_user, OutlookAction.add)
+    OutlookQueueEntry.record(dummy_event.category, dummy_user, OutlookAction.remove)
+    entries = OutlookQueueEntry.query.order_by(OutlookQueueEntry.id).all()
+    if in_progress:
+        category_task_cache.set(str(entries[0].id), {'cursor': None, 'success': True})
+    try:
+        _process_favorite_categories(*run_args)
+    finally:
+        category_task_cache.delete(str(entries[0].id))
+    # an addition which is being processed by a task may have added events already, so the
+    # removal must not be ignored but wait until the task is done
+    assert OutlookQueueEntry.query.order_by(OutlookQueueEntry.id).all() == (entries if in_progress else [])
+    assert not delay.called
+
+
+def test_save_changes_existing_entry(db, run_args, dummy_event, dummy_user):
+    # e.g. added by a favorite category task while the run was sending its requests
+    OutlookCalendarEntry.create(dummy_event, dummy_user, 'indico_task')
+    db.session.flush()
+    dispatcher = CalendarDispatcher(*run_args)
+    key = (dummy_user.id, dummy_event.id)
+    dispatcher._calendar_ids[key] = None
+    dispatcher._save_changes({key: 'indico_run'})
+    db.session.expire_all()
+    assert OutlookCalendarEntry.get(dummy_event, dummy_user).calendar_entry_id == 'indico_run'
+
+
+def test_reconcile_calendars(db, dummy_event, create_user):
+    dummy_event.start_dt = now_utc() + timedelta(days=1)
+    dummy_event.end_dt = dummy_event.start_dt + timedelta(hours=1)
+    disabled = create_user(1001, email='user1001@example.test')
+    OutlookPlugin.user_settings.set(disabled, 'enabled', False)
+    OutlookCalendarEntry.create(dummy_event, disabled, 'indico_1001')
+    favorite = create_user(1002, email='user1002@example.test')
+    favorite.favorite_events.add(dummy_event)
+    dummy_event.label = EventLabel(title='Cancelled', color='red', is_event_not_happening=True)
+    db.session.flush()
+    # cancelled events are not added, and calendars of users who disabled the sync are left alone
+    assert [(res.added, res.removed) for res in reconcile_calendars(dry_run=True)] == [(0, 0)]
+    dummy_event.label = None
+    db.session.flush()
+    assert [(res.added, res.removed) for res in reconcile_calendars(dry_run=True)] == [(1, 0)]
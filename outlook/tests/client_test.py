@@ -0,0 +1,100 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from threading import Barrier
+
+import pytest
+
+from indico_outlook import circuit_breaker_cache, get_redis_client
+from indico_outlook.client import PROBE_KEY, CircuitBreaker
+
+
+SETTINGS = {'circuit_breaker_threshold': 3, 'circuit_breaker_cooldown': timedelta(minutes=5)}
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def _clear_state(app):
+    circuit_breaker_cache.delete('state')
+    get_redis_client().delete(PROBE_KEY)
+
+
+@pytest.fixture
+def now(mocker):
+    now = mocker.patch('indico_outlook.client.now_utc')
+    now.return_value = datetime(2026, 1, 1, 12, 0, tzinfo=UTC)
+    return now
+
+
+def test_circuit_breaker_opens(now):
+    breaker = CircuitBreaker(SETTINGS, logger)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    # a success resets the number of consecutive failures
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    assert breaker.allow_request()
+    assert CircuitBreaker.get_state() is None
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow_request()
+    assert CircuitBreaker.get_state() == {'opened_dt': now.return_value, 'failures': 3}
+    # other runs see the open circuit while it is cooling down
+    assert CircuitBreaker(SETTINGS, logger).is_open
+
+
+def test_circuit_breaker_probe(now):
+    breaker = CircuitBreaker(SETTINGS, logger)
+    for __ in range(3):
+        breaker.record_failure()
+    now.return_value += timedelta(minutes=6)
+    # a failed probe opens the circuit again right away
+    probe = CircuitBreaker(SETTINGS, logger)
+    assert not probe.is_open
+    assert probe.allow_request()
+    probe.record_failure()
+    assert probe.is_open
+    assert CircuitBreaker.get_state() == {'opened_dt': now.return_value, 'failures': 1}
+    # a successful probe closes it
+    now.return_value += timedelta(minutes=6)
+    probe = CircuitBreaker(SETTINGS, logger)
+    assert probe.allow_request()
+    probe.record_success()
+    assert CircuitBreaker.get_state() is None
+    assert not CircuitBreaker(SETTINGS, logger).is_open
+    assert probe.allow_request()
+
+
+def test_circuit_breaker_single_probe(now):
+    breaker = CircuitBreaker(SETTINGS, logger)
+    for __ in range(3):
+        breaker.record_failure()
+    now.return_value += timedelta(minutes=6)
+    # once the cooldown has passed, several runs with several threads each try to send requests at once
+    breakers = [CircuitBreaker(SETTINGS, logger) for __ in range(4)]
+    callers = breakers * 4
+    barrier = Barrier(len(callers))
+
+    def _allow_request(breaker):
+        barrier.wait()
+        return breaker.allow_request()
+
+    with ThreadPoolExecutor(max_workers=len(callers)) as executor:
+        allowed = list(executor.map(_allow_request, callers))
+    assert allowed.count(True) == 1
+    probe = callers[allowed.index(True)]
+    # everyone else keeps waiting for the result of the probe
+    assert not probe.is_open
+    assert all(b.is_open for b in breakers if b is not probe)
+    assert not any(b.allow_request() for b in breakers)
+    probe.record_success()
+    assert all(b.allow_request() for b in breakers)
@@ -0,0 +1,48 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import pytest
+
+from indico_outlook import get_redis_client
+from indico_outlook.metrics import TOTALS_KEY, OutlookMetrics, estimate_quantile, get_totals, get_value
+
+
+@pytest.fixture(autouse=True)
+def _clear_metrics(app):
+    get_redis_client().delete(TOTALS_KEY)
+
+
+def test_flush():
+    metrics = OutlookMetrics()
+    metrics.inc('outlook_requests_total', action='add', result='success')
+    metrics.set('outlook_last_run_duration_seconds', 12.5)
+    metrics.flush()
+    # values collected in another process are added to the totals
+    other = OutlookMetrics()
+    other.inc('outlook_requests_total', 2, action='add', result='success')
+    other.set('outlook_last_run_duration_seconds', 3)
+    other.flush()
+    totals = get_totals()
+    assert get_value(totals, 'outlook_requests_total', action='add', result='success') == 3
+    assert get_value(totals, 'outlook_last_run_duration_seconds') == 3
+    # flushing again does not add the same values twice
+    other.flush()
+    assert get_totals() == totals
+
+
+def test_histogram():
+    metrics = OutlookMetrics()
+    for value in (0.2, 0.2, 0.7, 50):
+        metrics.observe('outlook_request_duration_seconds', value, action='remove')
+    metrics.flush()
+    totals = get_totals()
+    assert get_value(totals, 'outlook_request_duration_seconds_bucket', action='remove', le='0.25') == 2
+    assert get_value(totals, 'outlook_request_duration_seconds_bucket', action='remove', le='+Inf') == 4
+    assert get_value(totals, 'outlook_request_duration_seconds_count', action='remove') == 4
+    assert estimate_quantile(totals, 'outlook_request_duration_seconds', 0.5, action='remove') == pytest.approx(0.25)
+    assert estimate_quantile(totals, 'outlook_request_duration_seconds', 0.95, action='remove') == 60
+    assert estimate_quantile(totals, 'outlook_request_duration_seconds', 0.5, action='add') is None
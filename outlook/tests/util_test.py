@@ -0,0 +1,138 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2026 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from indico.core.db import db
+from indico.modules.categories import Category
+from indico.modules.events import Event
+from indico.modules.events.registration.models.registrations import Registration
+from indico.modules.users import User, UserSetting
+from indico.modules.users.models.favorites import favorite_category_table, favorite_event_table
+from indico.util.date_time import now_utc
+
+from indico_outlook.models.queue import OutlookAction, OutlookQueueEntry
+from indico_outlook.plugin import OutlookPlugin
+from indico_outlook.util import (_query_favorite_users, _query_registrations, get_calendar_users,
+                                 get_visible_category_ids, record_queue_entries)
+
+
+@contextmanager
+def _count_queries():
+    queries = []
+
+    def _before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+@pytest.mark.usefixtures('db')
+def test_get_calendar_users_queries(dummy_event, create_user):
+    """The number of queries does not depend on the number of users."""
+    def _add_category_favoriters(first_id, count):
+        for user_id in range(first_id, first_id + count):
+            user = create_user(user_id, email=f'user{user_id}@example.test')
+            user.favorite_categories.add(dummy_event.category)
+            OutlookPlugin.user_settings.set(user, 'favorite_categories', True)
+        db.session.flush()
+
+    counts = {}
+    for first_id, count in ((1000, 10), (2000, 90), (3000, 400)):
+        _add_category_favoriters(first_id, count)
+        # warm up the cached visible categories
+        get_calendar_users(dummy_event)
+        with _count_queries() as queries:
+            users = get_calendar_users(dummy_event)
+        counts[len(users)] = len(queries)
+    assert list(counts) == [10, 100, 500]
+    assert len(set(counts.values())) == 1
+
+
+def _get_users_to_add_old(event):
+    # how the users were resolved before: the category favoriters are checked one by one
+    registered = {reg.user for reg in _query_registrations(event).options(joinedload(Registration.user))}
+    favorite = set(_query_favorite_users(event))
+    cat_favorite = {user
+                    for cat in Category.query.filter(Category.id.in_(get_visible_category_ids(event)))
+                    for user in cat.favorite_of
+                    if OutlookPlugin.user_settings.get(user, 'favorite_categories')
+                    and event.can_access(user, allow_admin=False)}
+    existing = {entry.user for entry in event.outlook_calendar_entries}
+    return (registered | favorite | cat_favorite) - existing
+
+
+@pytest.mark.usefixtures('db')
+def test_get_calendar_users_many_favoriters(dummy_event, record_property):
+    """Compare the set-based queries with the previous implementation for an event with 12k favoriters.
+
+    The durations and query counts of both are recorded as properties (use
+    ``--junitxml`` to get them).
+    """
+    users = [User(first_name='Guinea', last_name=f'Pig {i}') for i in range(12000)]
+    db.session.add_all(users)
+    db.session.flush()
+    event_favoriters = [u.id for u in users[:2000]]
+    category_favoriters = [u.id for u in users[2000:]]
+    db.session.execute(favorite_event_table.insert(),
+                       [{'user_id': user_id, 'target_id': dummy_event.id} for user_id in event_favoriters])
+    db.session.execute(favorite_category_table.insert(),
+                       [{'user_id': user_id, 'target_id': dummy_event.category_id}
+                        for user_id in category_favoriters])
+    db.session.execute(UserSetting.__table__.insert(),
+                       [{'user_id': user_id, 'module': 'plugin_outlook', 'name': 'favorite_categories', 'value': True}
+                        for user_id in category_favoriters])
+    event_id = dummy_event.id
+    get_visible_category_ids(dummy_event)
+
+    results = {}
+    query_counts = {}
+    for name, func in (('old', _get_users_to_add_old),
+                       ('new', lambda event: get_calendar_users(event, skip_existing=True))):
+        # start with an empty session so neither implementation benefits from objects the other one loaded
+        db.session.expunge_all()
+        event = Event.get(event_id)
+        start = time.perf_counter()
+        with _count_queries() as queries:
+            result = func(event)
+        results[name] = {u.id for u in result}
+        record_property(f'{name}_duration', time.perf_counter() - start)
+        record_property(f'{name}_queries', len(queries))
+        query_counts[name] = len(queries)
+
+    assert results['new'] == results['old']
+    assert len(results['new']) == 12000
+    # the previous implementation needed at least one query for each category favoriter
+    assert query_counts['old'] > 10000
+    assert query_counts['new'] < 10
+
+
+@pytest.mark.usefixtures('db')
+def test_record_queue_entries_order(dummy_event, dummy_user):
+    dummy_event.start_dt = now_utc() + timedelta(days=1)
+    dummy_event.end_dt = dummy_event.start_dt + timedelta(hours=1)
+    first = [(dummy_event.id, dummy_user.id, int(OutlookAction.update), False),
+             (dummy_event.id, dummy_user.id, int(OutlookAction.remove), True)]
+    second = [(dummy_event.id, dummy_user.id, int(OutlookAction.update), False)]
+    first_ids = OutlookQueueEntry.reserve_ids(len(first))
+    second_ids = OutlookQueueEntry.reserve_ids(len(second))
+    # the task of the later request runs first, but its entries are still processed last
+    record_queue_entries(second, second_ids)
+    record_queue_entries(first, first_ids)
+    entries = OutlookQueueEntry.query.order_by(OutlookQueueEntry.id).all()
+    assert [entry.action for entry in entries] == [OutlookAction.update, OutlookAction.remove, OutlookAction.update]
+    assert [entry.id for entry in entries] == [*first_ids, *second_ids]